@@ -129,6 +129,81 @@ STATICFILES_DIRS = [
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Face recognition settings
+# Maximum distance between two encodings for them to count as the same person
+FACE_MATCH_TOLERANCE = 0.6
+# Storage format of Students.face_encoding (see myapp/encoding_format.py).
+# Existing rows are rewritten with manage.py convert_face_encodings
+FACE_ENCODING_DTYPE = 'float32'  # 'float32', 'float16' or 'float64'
+FACE_ENCODING_NORMALIZE = False  # L2-normalize stored and query encodings (retune FACE_MATCH_TOLERANCE)
+# In-process LRU cache of packed per-TSA encoding matrices
+FACE_ENCODING_CACHE_MAX_BYTES = 64 * 1024 * 1024
+FACE_ENCODING_CACHE_TTL = 300  # seconds
+# Multi-image group photo endpoint
+FACE_BATCH_MAX_IMAGES = 10
+FACE_BATCH_MAX_WORKERS = 4
+# Process pool running dlib face detection/encoding (0 runs it inline).
+# Every web server worker process (gunicorn/uwsgi worker) starts its own pool,
+# so the host runs <web workers> x FACE_WORKER_PROCESSES dlib processes. Keep
+# that product at or below the CPU count, e.g. cores // web workers.
+FACE_WORKER_PROCESSES = 2
+# Images handed to the workers at once, and requests allowed to wait for a slot
+FACE_WORKER_CONCURRENCY = FACE_WORKER_PROCESSES
+FACE_WORKER_QUEUE_SIZE = 32
+FACE_WORKER_TIMEOUT = 120  # seconds
+# Working resolution for face detection on group photos. Faces are located on
+# a copy shrunk until the smallest expected face is about TARGET_FACE_PX wide,
+# then encoded on the full-resolution photo. Small photos whose faces are
+# below that are upsampled up to MAX_UPSAMPLE times, staying within
+# MAX_PIXELS; larger working images may be tiled (FACE_TILING_POLICY).
+FACE_DETECTION_POLICY = {
+    'MIN_FACE_FRACTION': 0.02,
+    'TARGET_FACE_PX': 80,
+    'MAX_PIXELS': 12_000_000,
+    'UPSAMPLE': 0,
+    'MAX_UPSAMPLE': 1,
+}
+# Working images above MIN_PIXELS are split into overlapping tiles searched in
+# parallel on the worker pool, when it has at least MIN_PROCESSES workers
+# (tiles cost extra CPU); OVERLAP must exceed the largest face in pixels
+FACE_TILING_POLICY = {
+    'MIN_PIXELS': 12_000_000,
+    'MIN_PROCESSES': 3,
+    'TILE_SIZE': 1600,
+    'OVERLAP': 256,
+    'NMS_THRESHOLD': 0.5,
+}
+# Keep a copy of every decoded group photo under MEDIA_ROOT for audit
+GROUP_PHOTO_ARCHIVE = False
+GROUP_PHOTO_ARCHIVE_DIR = 'group_photo_archive'
+# Opt-in gallery of confirmed matches (see myapp/gallery.py). Faces matched
+# within MAX_DISTANCE and confirmed present by mark_attendance or
+# correct_attendance within CONFIRM_WINDOW become extra reference encodings,
+# at most SIZE per student. Unconfirmed candidates expire after CONFIRM_WINDOW
+# and each student keeps the MAX_CANDIDATES closest per TSA
+FACE_GALLERY_ENABLED = False
+FACE_GALLERY_MAX_DISTANCE = 0.4
+FACE_GALLERY_SIZE = 5
+FACE_GALLERY_MAX_CANDIDATES = 3
+FACE_GALLERY_CONFIRM_WINDOW = 6 * 60 * 60  # seconds
+# Memory-mapped face store shared by all workers, also used as the index for
+# open-roster recognition (manage.py build_face_index). Queries scan the
+# NPROBE closest clusters; deltas are merged after MAX_DELTAS updates
+FACE_INDEX_DIR = BASE_DIR / 'face_index'
+FACE_INDEX_NPROBE = 8
+FACE_INDEX_TOP_K = 5
+FACE_INDEX_MAX_DELTAS = 64
+# Stricter than FACE_MATCH_TOLERANCE: thousands of candidates instead of a class
+FACE_OPEN_ROSTER_TOLERANCE = 0.5
+# Asynchronous recognition jobs (see manage.py process_recognition_jobs)
+FACE_JOB_THREADS = 2
+FACE_JOB_STALE_AFTER = 600  # seconds
+
+# Responses of mark_attendance submissions with an Idempotency-Key are kept in
+# the default cache for replays. Use a cache shared by all workers (database,
+# Redis, Memcached) when running more than one process.
+ATTENDANCE_IDEMPOTENCY_TTL = 24 * 60 * 60  # seconds
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -179,6 +254,7 @@ JAZZMIN_SETTINGS = {
         "myapp.TimeTables": "fas fa-calendar-alt",
         "myapp.Attendance": "fas fa-clipboard-check",
         "myapp.Users": "fas fa-user-shield",
+        "myapp.Recognition_Job": "fas fa-camera",
     },
     
     # Icons that are used when one is not manually specified
@@ -214,6 +290,7 @@ JAZZMIN_SETTINGS = {
         "myapp.RoomNum",
         "myapp.Branch",
         "myapp.Users",
+        "myapp.Recognition_Job",
     ],
     
     # Group models in the admin sidebar
@@ -221,6 +298,7 @@ JAZZMIN_SETTINGS = {
         "Attendance & Timetable": [
             "myapp.Attendance",
             "myapp.TimeTables",
+            "myapp.Recognition_Job",
         ],
         "Academic Management": [
             "myapp.Student_TSA_Enrollment",
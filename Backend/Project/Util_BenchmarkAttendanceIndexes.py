@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Util_BenchmarkAttendanceIndexes.py
+
+Benchmarks the Attendance read paths of myapp/views.py and
+myapp/attendance_summary.py with and without the composite indexes declared
+in Attendance.Meta.indexes.
+
+A synthetic college is generated into a separate SQLite file (the project
+database is never touched): classes of 60 students, 6 TSAs per class and one
+row per student per lecture. "Before" is the old schema, with the single
+TSA_ID foreign key index and no composite indexes; "after" is the current
+model. For each query the script prints the SQLite query plan and the median
+run time in both states.
+
+Usage:
+    python Util_BenchmarkAttendanceIndexes.py [--rows 2000000] [--db attendance_benchmark.sqlite3]
+                                              [--repeat 5] [--reuse]
+"""
+
+import argparse
+import os
+import random
+import statistics
+import time
+from datetime import date, time as clock, timedelta
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--rows', type=int, default=2_000_000, help='Approximate number of Attendance rows')
+parser.add_argument('--db', default='attendance_benchmark.sqlite3', help='SQLite file for the generated data')
+parser.add_argument('--repeat', type=int, default=5, help='Runs per query; the median is reported')
+parser.add_argument('--reuse', action='store_true', help='Reuse data already generated in --db')
+args = parser.parse_args()
+
+# Setup Django against the benchmark database
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Project.settings')
+from django.conf import settings  # noqa: E402
+
+settings.DATABASES['default'] = {
+    'ENGINE': 'django.db.backends.sqlite3',
+    'NAME': os.path.abspath(args.db),
+}
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.core.management import call_command  # noqa: E402
+from django.db import connection, transaction  # noqa: E402
+from django.db.models import Count, F, Q, Window  # noqa: E402
+from django.db.models.functions import DenseRank  # noqa: E402
+
+from myapp.models import (  # noqa: E402
+    Attendance, Branch, Classes, Session, Students, Subjects, Teachers,
+    Teacher_Subject_Assignment, TimeSlots,
+)
+
+STUDENTS_PER_CLASS = 60
+TSAS_PER_CLASS = 6
+LECTURES_PER_TSA = 120
+DAYS = ['MONDAY', 'TUESDAY', 'WEDNESDAY', 'THURSDAY', 'FRIDAY', 'SATURDAY']
+OLD_TSA_INDEX = 'Attendance_TSA_ID_benchmark'
+
+
+def generate(rows):
+    """Create the schema and fill it with about `rows` attendance rows."""
+    if os.path.exists(args.db):
+        os.remove(args.db)
+    call_command('migrate', run_syncdb=True, verbosity=0)
+
+    rows_per_class = STUDENTS_PER_CLASS * TSAS_PER_CLASS * LECTURES_PER_TSA
+    class_count = max(1, rows // rows_per_class)
+    random.seed(0)
+
+    with transaction.atomic():
+        branch = Branch.objects.create(Branch_ID='BM', Branch_Name='Benchmark')
+        TimeSlots.objects.bulk_create([
+            TimeSlots(TimeSlot_ID=f'S{slot}', Start_Time=clock(8 + slot), End_Time=clock(9 + slot))
+            for slot in range(TSAS_PER_CLASS)
+        ])
+        Session.objects.bulk_create([
+            Session(Session_ID=f'{day[:3]}{slot}', Day=day, TimeSlot_ID_id=f'S{slot}', ExtraClass=False)
+            for day in DAYS for slot in range(TSAS_PER_CLASS)
+        ])
+        teacher = Teachers.objects.create(
+            Teacher_ID='BM_T', Teacher_Name='Benchmark', Initials='BM', Branch_ID=branch, Teacher_Email='bm@example.com'
+        )
+        Subjects.objects.bulk_create([
+            Subjects(Scheme=2022, Semester=1, Subject_Code=f'BM{k}', Subject_Name=f'Subject {k}', Credits=3)
+            for k in range(TSAS_PER_CLASS)
+        ])
+        Classes.objects.bulk_create([
+            Classes(Class_ID=f'BM{c}', Branch_ID=branch, Semester=1, Section='A')
+            for c in range(class_count)
+        ])
+        Students.objects.bulk_create([
+            Students(
+                Student_ID=f'BM{c:03d}{s:02d}', Student_Name=f'Student {c}-{s}', Branch_ID=branch,
+                Graduation_Batch=2026, Student_Email=f'bm{c}_{s}@example.com'
+            )
+            for c in range(class_count) for s in range(STUDENTS_PER_CLASS)
+        ], batch_size=1000)
+        tsas = Teacher_Subject_Assignment.objects.bulk_create([
+            Teacher_Subject_Assignment(
+                Teacher_ID=teacher, Subject_Code_id=f'BM{k}', Semester=1, IsElective='NO', IsLab='NO',
+                Class_ID_id=f'BM{c}', Teaching_Graduation_Batch=2026
+            )
+            for c in range(class_count) for k in range(TSAS_PER_CLASS)
+        ], batch_size=1000)
+        tsa_ids = [tsa.TSA_ID for tsa in Teacher_Subject_Assignment.objects.order_by('TSA_ID')]
+        assert len(tsa_ids) == len(tsas)
+
+    # Slot k of a class always belongs to its TSA k, so every class has one
+    # lecture per TSA per day and (Date, Session_ID, Student_ID) stays unique.
+    start = date(2025, 1, 6)
+    insert = (
+        'INSERT INTO "Attendance" ("Date", "Day", "Student_ID", "Session_ID", "Class_ID", "TSA_ID", "Status") '
+        'VALUES (%s, %s, %s, %s, %s, %s, %s)'
+    )
+    written = 0
+    started = time.perf_counter()
+    with connection.cursor() as cursor:
+        for c in range(class_count):
+            batch = []
+            for lecture in range(LECTURES_PER_TSA):
+                day = start + timedelta(days=lecture + lecture // len(DAYS))  # skip Sundays
+                day_name = DAYS[day.weekday()]
+                for k in range(TSAS_PER_CLASS):
+                    tsa_id = tsa_ids[c * TSAS_PER_CLASS + k]
+                    session_id = f'{day_name[:3]}{k}'
+                    for s in range(STUDENTS_PER_CLASS):
+                        batch.append((
+                            day.isoformat(), day_name, f'BM{c:03d}{s:02d}', session_id, f'BM{c}', tsa_id,
+                            random.random() < 0.75
+                        ))
+            with transaction.atomic():
+                cursor.executemany(insert, batch)
+            written += len(batch)
+            print(f'\rGenerated {written:,} rows', end='', flush=True)
+    print(f' in {time.perf_counter() - started:.1f}s')
+
+
+def use_old_indexes():
+    with connection.schema_editor() as editor:
+        for index in Attendance._meta.indexes:
+            editor.execute(f'DROP INDEX IF EXISTS "{index.name}"')
+        editor.execute(f'CREATE INDEX IF NOT EXISTS "{OLD_TSA_INDEX}" ON "Attendance" ("TSA_ID")')
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE')
+
+
+def use_new_indexes():
+    started = time.perf_counter()
+    with connection.schema_editor() as editor:
+        editor.execute(f'DROP INDEX IF EXISTS "{OLD_TSA_INDEX}"')
+        for index in Attendance._meta.indexes:
+            editor.execute(f'DROP INDEX IF EXISTS "{index.name}"')
+            editor.add_index(Attendance, index)
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE')
+    print(f'Built {len(Attendance._meta.indexes)} composite index(es) in {time.perf_counter() - started:.1f}s')
+
+
+def sample_keys():
+    """Pick a TSA, one of its lectures and one of its students."""
+    random.seed(1)
+    last_pk = Attendance.objects.order_by('-pk').values_list('pk', flat=True).first()
+    return Attendance.objects.filter(pk__gte=random.randint(1, last_pk)).values_list(
+        'TSA_ID', 'Session_ID', 'Date', 'Student_ID'
+    ).first()
+
+
+def queries(tsa_id, session_id, lecture_date, student_id):
+    """The Attendance queries issued by the views, built the same way."""
+    lecture_rows = Attendance.objects.filter(TSA_ID=tsa_id, Session_ID=session_id)
+    return [
+        ('register: dates of a TSA',
+         Attendance.objects.filter(TSA_ID=tsa_id).values('Date').distinct().order_by('Date')),
+        ('register: one student in a TSA',
+         Attendance.objects.filter(TSA_ID=tsa_id, Student_ID=student_id).values('Date', 'Status')),
+        ('schedule: lectures of a TSA session',
+         lecture_rows.values('Date').distinct()),
+        ('schedule: present count of a TSA session',
+         lecture_rows.filter(Status=True).values('pk')),
+        ('schedule: last 5 lectures of a TSA session',
+         Attendance.objects.filter(id__in=lecture_rows.annotate(
+             recency=Window(DenseRank(), partition_by=[F('TSA_ID'), F('Session_ID')], order_by=F('Date').desc())
+         ).filter(recency__lte=5).values('id')).values('TSA_ID', 'Session_ID', 'Date').annotate(
+             present_count=Count('id', filter=Q(Status=True)), total_count=Count('id')
+         ).order_by('TSA_ID', 'Session_ID', '-Date')),
+        ('summary upkeep: rows of one lecture',
+         Attendance.objects.filter(TSA_ID=tsa_id, Date=lecture_date, Session_ID=session_id).values(
+             'TSA_ID', 'Date', 'Session_ID'
+         ).annotate(rows=Count('pk'))),
+        ('summary rebuild: one TSA per student',
+         Attendance.objects.filter(TSA_ID=tsa_id).values('TSA_ID', 'Student_ID').annotate(
+             rows=Count('pk'), present=Count('pk', filter=Q(Status=True))
+         ).order_by()),
+    ]
+
+
+def measure(queryset):
+    timings = []
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        list(queryset.all())
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+def run(label, keys):
+    results = []
+    for name, queryset in queries(*keys):
+        results.append((name, queryset.explain(), measure(queryset)))
+    print(f'\n=== {label} ===')
+    for name, plan, elapsed in results:
+        print(f'\n{name}: {elapsed:.2f} ms')
+        for line in plan.splitlines():
+            print(f'    {line}')
+    return results
+
+
+if __name__ == '__main__':
+    if not (args.reuse and os.path.exists(args.db)):
+        generate(args.rows)
+    print(f'{Attendance.objects.count():,} attendance rows in {args.db}')
+
+    keys = sample_keys()
+    use_old_indexes()
+    before = run('Before: TSA_ID index only', keys)
+    use_new_indexes()
+    after = run('After: composite indexes', keys)
+
+    print('\n=== Summary (median ms) ===')
+    print(f"{'query':<45}{'before':>12}{'after':>12}{'speedup':>10}")
+    for (name, _, old), (_, _, new) in zip(before, after):
+        print(f'{name:<45}{old:>12.2f}{new:>12.2f}{old / new if new else float("inf"):>9.1f}x')
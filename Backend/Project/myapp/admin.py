@@ -2,9 +2,13 @@ from django.contrib import admin
 from .models import (
     TimeSlots, Session, Branch, Classes, RoomNum, Subjects, 
     Teachers, Students, Students_Current_Class, Teacher_Subject_Assignment,
-    Student_TSA_Enrollment, TimeTables, Attendance, Users
+    Student_TSA_Enrollment, TimeTables, Attendance, Users, Recognition_Job,
+    Student_Face_Encoding
 )
+from django.db import transaction
 from django.utils.html import format_html
+from .attendance_summary import discount_attendance
+from .jobs import enqueue_face_encoding
 
 @admin.register(TimeSlots)
 class TimeSlotsAdmin(admin.ModelAdmin):
@@ -60,13 +64,22 @@ class TeachersAdmin(admin.ModelAdmin):
     ordering = ('Teacher_ID',)
 
 
+class StudentFaceEncodingInline(admin.TabularInline):
+    model = Student_Face_Encoding
+    extra = 0
+    fields = ('Image', 'Source', 'Status', 'Error', 'Created_At')
+    readonly_fields = ('Status', 'Error', 'Created_At')
+
+
 @admin.register(Students)
 class StudentsAdmin(admin.ModelAdmin):
-    list_display = ('Student_ID', 'Student_Name', 'Branch_ID', 'Graduation_Batch', 'Student_Email', 'Parents_Contact', 'get_image', 'get_face_encoding_status')
+    list_display = ('Student_ID', 'Student_Name', 'Branch_ID', 'Graduation_Batch', 'Student_Email', 'Parents_Contact', 'get_image', 'face_encoding_status')
     search_fields = ('Student_ID', 'Student_Name', 'Student_Email')
-    list_filter = ('Branch_ID', 'Graduation_Batch')
+    list_filter = ('Branch_ID', 'Graduation_Batch', 'face_encoding_status')
     ordering = ('Student_ID',)
-    readonly_fields = ('get_face_encoding_status',)
+    readonly_fields = ('get_face_encoding_status', 'face_encoding_status', 'face_encoding_error')
+    inlines = [StudentFaceEncodingInline]
+    actions = ['retry_face_encoding']
     
     def get_image(self, obj):
         if obj.ImagePath:
@@ -78,6 +91,14 @@ class StudentsAdmin(admin.ModelAdmin):
         return obj.get_face_encoding_status()
     get_face_encoding_status.short_description = 'Face Encoding Status'
 
+    @admin.action(description='Retry face encoding for selected students')
+    def retry_face_encoding(self, request, queryset):
+        student_ids = list(queryset.exclude(ImagePath__isnull=True).exclude(ImagePath='').values_list('Student_ID', flat=True))
+        Students.objects.filter(Student_ID__in=student_ids).update(face_encoding_status='PENDING', face_encoding_error=None)
+        for student_id in student_ids:
+            enqueue_face_encoding(student_id)
+        self.message_user(request, f"Queued face encoding for {len(student_ids)} student(s).")
+
 
 @admin.register(Students_Current_Class)
 class StudentsCurrentClassAdmin(admin.ModelAdmin):
@@ -118,6 +139,12 @@ class AttendanceAdmin(admin.ModelAdmin):
     search_fields = ('Student_ID__Student_ID', 'Student_ID__Student_Name', 'Session_ID__Session_ID')
     ordering = ('-Date', 'Session_ID__TimeSlot_ID__Start_Time')
 
+    # Queryset deletes skip Attendance.delete(); keep the summaries in step
+    def delete_queryset(self, request, queryset):
+        with transaction.atomic():
+            discount_attendance(queryset)
+            queryset.delete()
+
 
 @admin.register(Users)
 class UsersAdmin(admin.ModelAdmin):
@@ -127,3 +154,10 @@ class UsersAdmin(admin.ModelAdmin):
     ordering = ('User_ID',)
 
 
+@admin.register(Recognition_Job)
+class RecognitionJobAdmin(admin.ModelAdmin):
+    list_display = ('Job_ID', 'TSA_ID', 'Status', 'Progress', 'Created_At', 'Updated_At')
+    list_filter = ('Status',)
+    search_fields = ('Job_ID', 'TSA_ID__TSA_ID')
+    ordering = ('-Created_At',)
+    readonly_fields = ('Result', 'Error', 'Created_At', 'Updated_At')
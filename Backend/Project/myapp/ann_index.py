@@ -0,0 +1,518 @@
+"""
+Shared on-disk store and approximate nearest-neighbour index of the
+encodings of every student.
+
+The store holds every student's matrix rows (see
+recognition.student_encoding_rows) as flat float32 .npy files that each
+worker process memory-maps read-only, so all WSGI workers share one
+page-cache copy and a cold worker starts without decoding any database
+blobs. load_tsa_encodings reads per-TSA matrices from it through the
+student ID index, and the open-roster mode of the group photo endpoint
+searches it as an inverted file (IVF): rows are clustered with k-means and
+stored grouped by cluster, and a query only scans the FACE_INDEX_NPROBE
+clusters whose centroids are closest to the face.
+
+Layout of FACE_INDEX_DIR:
+
+    CURRENT              name of the active base directory
+    base-<stamp>/        one full build, never modified after CURRENT points at it
+        student_ids.npy  sorted student IDs
+        branches.npy     branch of each student
+        student_offsets.npy, student_rows.npy
+                         rows of student i are
+                         student_rows[student_offsets[i]:student_offsets[i + 1]]
+        centroids.npy, offsets.npy
+                         IVF clusters; rows offsets[c]:offsets[c + 1] are cluster c
+        vectors.npy      (rows, 128) float32, grouped by cluster
+        owners.npy       student index of every row
+    delta-<stamp>.npz    rows of students changed since the base was built
+    stale_students.txt   students whose delta could not be written; retried
+                         with the next delta and cleared by a rebuild
+
+Whenever a student's encodings change a delta with their new rows is
+written, shadowing the student's rows in the base; once
+FACE_INDEX_MAX_DELTAS deltas have accumulated the base is rebuilt in the
+background. A rebuild writes a new base directory and then atomically
+replaces CURRENT, so readers switch over on their next query and never see
+a partial build.
+
+The store is opt-in: nothing is written until `python manage.py
+build_face_index` has created the directory.
+"""
+import os
+import shutil
+import threading
+import time
+import traceback
+import uuid
+
+import numpy as np
+from django.conf import settings
+
+from .encoding_format import prepare_query
+from .models import Students
+from .recognition import (
+    ENCODING_SIZE, EnrolledEncodings, assign_faces, face_distance_matrix, read_stored_encodings,
+)
+
+
+FACE_INDEX_DIR = str(getattr(settings, 'FACE_INDEX_DIR', os.path.join(settings.BASE_DIR, 'face_index')))
+FACE_INDEX_NPROBE = getattr(settings, 'FACE_INDEX_NPROBE', 8)
+FACE_INDEX_TOP_K = getattr(settings, 'FACE_INDEX_TOP_K', 5)
+FACE_INDEX_MAX_DELTAS = getattr(settings, 'FACE_INDEX_MAX_DELTAS', 64)
+FACE_OPEN_ROSTER_TOLERANCE = getattr(settings, 'FACE_OPEN_ROSTER_TOLERANCE', 0.5)
+
+CURRENT_FILE = 'CURRENT'
+BASE_PREFIX = 'base-'
+BASE_ARRAYS = (
+    'student_ids', 'branches', 'student_offsets', 'student_rows',
+    'centroids', 'offsets', 'vectors', 'owners',
+)
+DELTA_PREFIX = 'delta-'
+LOCK_FILE = 'rebuild.lock'
+STALE_FILE = 'stale_students.txt'
+# A rebuild lock older than this belongs to a dead process
+LOCK_STALE_AFTER = 3600  # seconds
+
+
+def kmeans(vectors, n_clusters, iterations=10, seed=0):
+    """Lloyd's k-means. Returns the (n_clusters, dim) centroids."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        labels = nearest_centroids(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, vectors)
+        counts = np.bincount(labels, minlength=n_clusters)
+        filled = counts > 0
+        # Empty clusters keep their previous centroid
+        centroids[filled] = sums[filled] / counts[filled, np.newaxis]
+    return centroids
+
+
+def nearest_centroids(vectors, centroids, chunk=4096):
+    labels = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), chunk):
+        distances = face_distance_matrix(vectors[start:start + chunk], centroids)
+        labels[start:start + chunk] = np.argmin(distances, axis=1)
+    return labels
+
+
+def collect_student_rows(student_ids=None):
+    """
+    Read the matrix rows of the given students (default: all students).
+
+    Returns (student_ids, branches, vectors, owners) where vectors[i] belongs
+    to student_ids[owners[i]]. Requested students without a usable encoding
+    are still listed, with no rows, so they shadow older index entries.
+    """
+    stored = read_stored_encodings(student_ids)
+
+    ids = sorted(student_ids if student_ids is not None else stored)
+    rows = []
+    owners = []
+    for owner, student_id in enumerate(ids):
+        _, encodings = stored.get(student_id, ('', []))
+        rows.extend(encodings)
+        owners.extend([owner] * len(encodings))
+
+    vectors = np.asarray(rows, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+    return (
+        np.asarray(ids, dtype=str),
+        np.asarray([stored.get(student_id, ('', []))[0] for student_id in ids], dtype=str),
+        vectors,
+        np.asarray(owners, dtype=np.int32),
+    )
+
+
+def _write_atomic(directory, name, **arrays):
+    temp_path = os.path.join(directory, f'.{name}.{uuid.uuid4().hex}.tmp')
+    with open(temp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(temp_path, os.path.join(directory, name))
+
+
+def _write_base(directory, **arrays):
+    """Write a new base directory and switch CURRENT to it."""
+    name = f'{BASE_PREFIX}{time.time_ns():020d}'
+    path = os.path.join(directory, name)
+    os.makedirs(path)
+    for key, array in arrays.items():
+        np.save(os.path.join(path, f'{key}.npy'), array)
+
+    temp_path = os.path.join(directory, f'.{CURRENT_FILE}.{uuid.uuid4().hex}.tmp')
+    with open(temp_path, 'w') as f:
+        f.write(name)
+    os.replace(temp_path, os.path.join(directory, CURRENT_FILE))
+
+    # Keep the previous base for workers still mapping it; older ones go
+    bases = sorted(entry.name for entry in os.scandir(directory) if entry.name.startswith(BASE_PREFIX))
+    for old in bases[:-2]:
+        shutil.rmtree(os.path.join(directory, old), ignore_errors=True)
+
+
+def _delta_names(directory):
+    return sorted(
+        entry.name for entry in os.scandir(directory)
+        if entry.name.startswith(DELTA_PREFIX) and entry.name.endswith('.npz')
+    )
+
+
+def _stale_students(directory):
+    try:
+        with open(os.path.join(directory, STALE_FILE)) as f:
+            return {line.strip() for line in f if line.strip()}
+    except FileNotFoundError:
+        return set()
+
+
+def _mark_stale(directory, student_ids):
+    with open(os.path.join(directory, STALE_FILE), 'a') as f:
+        f.write(''.join(f'{student_id}\n' for student_id in student_ids))
+
+
+def _clear_stale(directory, student_ids):
+    """Forget the given stale students; students marked meanwhile stay marked."""
+    remaining = _stale_students(directory) - set(student_ids)
+    path = os.path.join(directory, STALE_FILE)
+    if not remaining:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return
+    temp_path = os.path.join(directory, f'.{STALE_FILE}.{uuid.uuid4().hex}.tmp')
+    with open(temp_path, 'w') as f:
+        f.write(''.join(f'{student_id}\n' for student_id in sorted(remaining)))
+    os.replace(temp_path, path)
+
+
+def _acquire_lock(directory):
+    path = os.path.join(directory, LOCK_FILE)
+    try:
+        if time.time() - os.path.getmtime(path) > LOCK_STALE_AFTER:
+            os.remove(path)
+    except OSError:
+        pass
+    try:
+        os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return True
+    except FileExistsError:
+        return False
+
+
+def _release_lock(directory):
+    try:
+        os.remove(os.path.join(directory, LOCK_FILE))
+    except OSError:
+        pass
+
+
+def build_index(directory=FACE_INDEX_DIR, nlist=None):
+    """
+    Rebuild the base index from the database and drop the merged deltas.
+
+    Returns the number of indexed rows, or None if another process is
+    already rebuilding.
+    """
+    os.makedirs(directory, exist_ok=True)
+    if not _acquire_lock(directory):
+        return None
+    try:
+        # Deltas written after this point may describe changes made after the
+        # database is read below, so only these are safe to delete
+        merged = _delta_names(directory)
+        stale = _stale_students(directory)
+        student_ids, branches, vectors, owners = collect_student_rows()
+
+        if len(vectors):
+            nlist = nlist or int(np.clip(np.sqrt(len(vectors)), 1, 1024))
+            nlist = min(nlist, len(vectors))
+            centroids = kmeans(vectors, nlist).astype(np.float32)
+            labels = nearest_centroids(vectors, centroids)
+        else:
+            centroids = np.empty((0, ENCODING_SIZE), dtype=np.float32)
+            labels = np.empty(0, dtype=np.int32)
+
+        # Store rows grouped by cluster; offsets[c]:offsets[c + 1] is cluster c
+        order = np.argsort(labels, kind='stable')
+        offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=len(centroids)), out=offsets[1:])
+
+        # Per-student row lists for load_tsa_encodings
+        owners = owners[order]
+        student_rows = np.argsort(owners, kind='stable')
+        student_offsets = np.zeros(len(student_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(owners, minlength=len(student_ids)), out=student_offsets[1:])
+
+        _write_base(
+            directory,
+            student_ids=student_ids,
+            branches=branches,
+            student_offsets=student_offsets,
+            student_rows=student_rows,
+            centroids=centroids,
+            offsets=offsets,
+            vectors=vectors[order],
+            owners=owners,
+        )
+        for name in merged:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+        if stale:
+            _clear_stale(directory, stale)
+        return len(vectors)
+    finally:
+        _release_lock(directory)
+
+
+def update_students(student_ids, directory=FACE_INDEX_DIR):
+    """Write a delta with the current rows of the given students."""
+    student_ids, branches, vectors, owners = collect_student_rows(student_ids)
+    name = f'{DELTA_PREFIX}{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.npz'
+    _write_atomic(directory, name, student_ids=student_ids, branches=branches, vectors=vectors, owners=owners)
+
+    if len(_delta_names(directory)) > FACE_INDEX_MAX_DELTAS:
+        from .jobs import submit_background
+        submit_background(build_index, directory)
+
+
+def refresh_students(student_ids):
+    """
+    Keep the index in sync after student encodings changed. A no-op until the
+    index has been built; failures are never raised to the caller. Students
+    whose update failed are marked stale and retried with the next update
+    (or picked up by build_face_index).
+    """
+    if not os.path.isdir(FACE_INDEX_DIR):
+        return
+    student_ids = list(student_ids)
+    stale = _stale_students(FACE_INDEX_DIR)
+    try:
+        update_students(sorted(set(student_ids) | stale), FACE_INDEX_DIR)
+    except Exception:
+        print(f"ERROR updating face index for {student_ids}, marked stale:\n{traceback.format_exc()}")
+        try:
+            _mark_stale(FACE_INDEX_DIR, student_ids)
+        except OSError:
+            print(f"ERROR marking {student_ids} stale in the face index:\n{traceback.format_exc()}")
+        return
+    if stale:
+        _clear_stale(FACE_INDEX_DIR, stale)
+
+
+class FaceIndex:
+    """
+    Read side of the on-disk index. Reloads the base and any new deltas when
+    the files in the index directory change.
+    """
+
+    def __init__(self, directory=FACE_INDEX_DIR, nprobe=FACE_INDEX_NPROBE):
+        self.directory = directory
+        self.nprobe = nprobe
+        self._lock = threading.Lock()
+        self._base_stamp = None
+        self._deltas = {}
+        self._state = None
+
+    def available(self):
+        """Whether a base has been built in the index directory."""
+        return os.path.exists(os.path.join(self.directory, CURRENT_FILE))
+
+    def _load_base(self):
+        """Map the current base read-only if CURRENT has changed. Returns True on a switch."""
+        path = os.path.join(self.directory, CURRENT_FILE)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return False
+        stamp = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        if stamp == self._base_stamp:
+            return False
+
+        with open(path) as f:
+            base_dir = os.path.join(self.directory, f.read().strip())
+        self._base = {
+            key: np.load(os.path.join(base_dir, f'{key}.npy'), mmap_mode='r')
+            for key in BASE_ARRAYS
+        }
+        self._base_stamp = stamp
+        return True
+
+    def _refresh(self):
+        if not os.path.isdir(self.directory):
+            raise FileNotFoundError('Face index has not been built; run manage.py build_face_index')
+
+        with self._lock:
+            changed = self._load_base()
+            names = _delta_names(self.directory)
+            if changed or set(names) != set(self._deltas):
+                for name in names:
+                    if name not in self._deltas:
+                        try:
+                            with np.load(os.path.join(self.directory, name)) as data:
+                                self._deltas[name] = {key: data[key] for key in data.files}
+                        except FileNotFoundError:
+                            continue  # merged by a rebuild meanwhile
+                for name in set(self._deltas) - set(names):
+                    del self._deltas[name]
+                self._state = self._merge()
+            if self._state is None:
+                raise FileNotFoundError('Face index has not been built; run manage.py build_face_index')
+            return self._state
+
+    def _merge(self):
+        """Overlay the deltas on the base: later deltas replace a student's rows."""
+        if self._base_stamp is None:
+            return None
+        base = self._base
+
+        latest = {}
+        for name in sorted(self._deltas):
+            delta = self._deltas[name]
+            for owner, student_id in enumerate(delta['student_ids']):
+                latest[str(student_id)] = (str(delta['branches'][owner]), delta['vectors'][delta['owners'] == owner])
+
+        alive = ~np.isin(base['student_ids'], list(latest)) if latest else np.ones(len(base['student_ids']), dtype=bool)
+        # The base has no rows for students without a usable encoding
+        alive &= np.diff(base['student_offsets']) > 0
+        overlay = [(student_id, branch, vectors) for student_id, (branch, vectors) in latest.items() if len(vectors)]
+        return {
+            'base': base,
+            'alive': alive,
+            'latest': latest,
+            'overlay_ids': np.asarray([item[0] for item in overlay], dtype=str),
+            'overlay_branches': np.asarray([item[1] for item in overlay], dtype=str),
+            'overlay_vectors': np.vstack([item[2] for item in overlay]).astype(np.float32) if overlay else np.empty((0, ENCODING_SIZE), dtype=np.float32),
+            'overlay_owners': np.concatenate([np.full(len(item[2]), i, dtype=np.int32) for i, item in enumerate(overlay)]) if overlay else np.empty(0, dtype=np.int32),
+        }
+
+    def student_count(self, branch=None):
+        """Number of indexed students, optionally in one branch."""
+        state = self._refresh()
+        if branch is None:
+            return int(np.sum(state['alive'])) + len(state['overlay_ids'])
+        return (
+            int(np.sum(state['alive'] & (state['base']['branches'] == branch)))
+            + int(np.sum(state['overlay_branches'] == branch))
+        )
+
+    def student_rows(self, student_ids):
+        """
+        Matrix rows of the given students, as {student_id: (k, 128) float32
+        array}. Students without a usable encoding are left out.
+        """
+        state = self._refresh()
+        base = state['base']
+        latest = state['latest']
+
+        ids = np.asarray(student_ids, dtype=str)
+        positions = np.searchsorted(base['student_ids'], ids)
+        positions[positions >= len(base['student_ids'])] = 0
+
+        found = {}
+        for student_id, position in zip(ids, positions):
+            student_id = str(student_id)
+            if student_id in latest:
+                vectors = latest[student_id][1]
+            elif len(base['student_ids']) and base['student_ids'][position] == student_id:
+                start, end = base['student_offsets'][position], base['student_offsets'][position + 1]
+                vectors = base['vectors'][base['student_rows'][start:end]]
+            else:
+                continue
+            if len(vectors):
+                found[student_id] = vectors
+        return found
+
+    def search(self, face_encodings, branch=None, k=FACE_INDEX_TOP_K):
+        """
+        Find the k closest students of every face.
+
+        Returns one list per face of (student_id, distance) pairs, closest
+        first, optionally restricted to one branch.
+        """
+        state = self._refresh()
+        base = state['base']
+        faces = prepare_query(np.asarray(face_encodings).reshape(-1, ENCODING_SIZE))
+
+        if len(base['centroids']):
+            probe = np.argsort(face_distance_matrix(faces, base['centroids']), axis=1)[:, :self.nprobe]
+        else:
+            probe = np.empty((len(faces), 0), dtype=np.intp)
+        overlay_distances = face_distance_matrix(faces, state['overlay_vectors'])
+        overlay_mask = np.ones(len(state['overlay_owners']), dtype=bool)
+        if branch is not None:
+            overlay_mask = state['overlay_branches'][state['overlay_owners']] == branch
+
+        results = []
+        for face_index, clusters in enumerate(probe):
+            rows = np.concatenate([
+                np.arange(base['offsets'][c], base['offsets'][c + 1]) for c in clusters
+            ]) if len(clusters) else np.empty(0, dtype=np.int64)
+            owners = base['owners'][rows]
+            keep = state['alive'][owners]
+            if branch is not None:
+                keep &= base['branches'][owners] == branch
+            rows, owners = rows[keep], owners[keep]
+
+            distances = np.concatenate([
+                face_distance_matrix(faces[face_index:face_index + 1], base['vectors'][rows])[0],
+                overlay_distances[face_index][overlay_mask],
+            ])
+            # Overlay students are numbered after the base students
+            owners = np.concatenate([owners, state['overlay_owners'][overlay_mask] + len(base['student_ids'])])
+
+            # Each student's closest row, then the k closest students
+            order = np.argsort(distances, kind='stable')
+            _, first = np.unique(owners[order], return_index=True)
+            best = order[np.sort(first)[:k]]
+            results.append([(self._student_id(state, owners[i]), float(distances[i])) for i in best])
+        return results
+
+    @staticmethod
+    def _student_id(state, owner):
+        count = len(state['base']['student_ids'])
+        if owner < count:
+            return str(state['base']['student_ids'][owner])
+        return str(state['overlay_ids'][owner - count])
+
+
+face_index = FaceIndex()
+
+
+def match_open_roster(face_encodings, branch=None, tolerance=FACE_OPEN_ROSTER_TOLERANCE):
+    """
+    Identify faces against every indexed student (of one branch).
+
+    Returns (matches, enrolled) shaped like match_faces and get_tsa_encodings,
+    so build_recognition_result can be used on the result. enrolled only lists
+    the candidate students found for these faces.
+    """
+    candidates = face_index.search(face_encodings, branch=branch)
+
+    candidate_ids = sorted({student_id for face in candidates for student_id, _ in face})
+    column = {student_id: i for i, student_id in enumerate(candidate_ids)}
+    distances = np.full((len(candidates), len(candidate_ids)), np.inf)
+    for row, face in enumerate(candidates):
+        for student_id, distance in face:
+            distances[row, column[student_id]] = distance
+
+    details = {
+        student_id: {'id': student_id, 'name': name, 'branch': branch_id, 'batch': batch}
+        for student_id, name, branch_id, batch in Students.objects.filter(
+            Student_ID__in=candidate_ids
+        ).values_list('Student_ID', 'Student_Name', 'Branch_ID', 'Graduation_Batch')
+    }
+    # Students deleted since the index was written cannot be reported
+    for student_id in candidate_ids:
+        if student_id not in details:
+            distances[:, column[student_id]] = np.inf
+    students = [details.get(student_id, {'id': student_id, 'name': None, 'branch': None, 'batch': None}) for student_id in candidate_ids]
+
+    enrolled = EnrolledEncodings(
+        None, np.empty((0, ENCODING_SIZE), dtype=np.float32), students,
+        face_index.student_count(branch), candidate_ids,
+    )
+    return assign_faces(distances, tolerance), enrolled
@@ -0,0 +1,179 @@
+"""
+Precomputed attendance totals.
+
+Attendance_Summary holds the totals of every (TSA, student) pair and
+TSA_Attendance_Summary those of every TSA, so dashboards read a few rows
+instead of scanning Attendance. Every write to Attendance is described as
+(tsa_id, student_id, date, session_id, old_status, new_status) tuples, with
+old_status None for created rows and new_status None for deleted ones.
+Bulk writers send them through the attendance_written signal and single-row
+saves through the model signals (see myapp.signals);
+apply_attendance_changes() folds them into both tables with a constant number
+of queries. Rows about to be deleted are subtracted set-wise by
+discount_attendance(). `python manage.py rebuild_attendance_summary`
+recomputes both tables from scratch.
+"""
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Count, F, Q
+
+from .models import Attendance, Attendance_Summary, TSA_Attendance_Summary
+
+
+def apply_attendance_changes(changes):
+    """Add the effect of a batch of attendance changes to the summary tables."""
+    student_deltas = defaultdict(lambda: [0, 0])  # (tsa, student) -> [rows, present]
+    lectures = defaultdict(lambda: [0, 0])  # (tsa, date, session) -> [created, deleted]
+    for tsa_id, student_id, date, session_id, old_status, new_status in changes:
+        tsa_id = int(tsa_id)
+        rows = (new_status is not None) - (old_status is not None)
+        present = bool(new_status) - bool(old_status)
+        if rows == 0 and present == 0:
+            continue
+        delta = student_deltas[(tsa_id, student_id)]
+        delta[0] += rows
+        delta[1] += present
+        if rows:
+            lectures[(tsa_id, str(date), session_id)][0 if rows > 0 else 1] += 1
+
+    tsa_deltas = defaultdict(lambda: [0, 0, 0])  # tsa -> [sessions, rows, present]
+    for (tsa_id, _), (rows, present) in student_deltas.items():
+        tsa_deltas[tsa_id][1] += rows
+        tsa_deltas[tsa_id][2] += present
+    if not tsa_deltas:
+        return
+
+    with transaction.atomic():
+        # A lecture counts once its first row exists and stops counting with
+        # its last one; compare the rows left now with those before the write.
+        if lectures:
+            condition = Q()
+            for tsa_id, date, session_id in lectures:
+                condition |= Q(TSA_ID=tsa_id, Date=date, Session_ID=session_id)
+            remaining = {
+                (row['TSA_ID'], str(row['Date']), row['Session_ID']): row['rows']
+                for row in Attendance.objects.filter(condition).values(
+                    'TSA_ID', 'Date', 'Session_ID'
+                ).annotate(rows=Count('pk'))
+            }
+            for key, (created, deleted) in lectures.items():
+                rows_now = remaining.get(key, 0)
+                rows_before = rows_now - created + deleted
+                tsa_deltas[key[0]][0] += (rows_now > 0) - (rows_before > 0)
+
+        _apply_deltas(student_deltas, tsa_deltas)
+
+
+def discount_attendance(rows):
+    """
+    Subtract a queryset of Attendance rows that is about to be deleted from
+    the summary tables, with two grouped queries and one UPDATE per distinct
+    delta. Call it inside the transaction that deletes the rows.
+    """
+    student_deltas = {}
+    tsa_deltas = defaultdict(lambda: [0, 0, 0])  # tsa -> [sessions, rows, present]
+    for row in rows.values('TSA_ID', 'Student_ID').annotate(
+        rows=Count('pk'),
+        present=Count('pk', filter=Q(Status=True))
+    ).order_by():
+        student_deltas[(row['TSA_ID'], row['Student_ID'])] = [-row['rows'], -row['present']]
+        tsa_deltas[row['TSA_ID']][1] -= row['rows']
+        tsa_deltas[row['TSA_ID']][2] -= row['present']
+    if not tsa_deltas:
+        return
+
+    with transaction.atomic():
+        # A lecture stops counting when all of its rows go
+        emptied = Attendance.objects.filter(TSA_ID__in=list(tsa_deltas)).values(
+            'TSA_ID', 'Date', 'Session_ID'
+        ).annotate(
+            rows=Count('pk'),
+            doomed=Count('pk', filter=Q(pk__in=rows.values('pk')))
+        ).filter(rows=F('doomed')).order_by()
+        for row in emptied:
+            tsa_deltas[row['TSA_ID']][0] -= 1
+
+        _apply_deltas(student_deltas, tsa_deltas)
+
+
+def _apply_deltas(student_deltas, tsa_deltas):
+    """
+    Add [rows, present] deltas per (tsa, student) and [sessions, rows,
+    present] deltas per TSA to the summary tables. Runs in the caller's
+    transaction.
+    """
+    # Deletions only touch existing rows, so cascading deletes of a
+    # student or TSA never recreate the summaries they are removing.
+    Attendance_Summary.objects.bulk_create(
+        [
+            Attendance_Summary(TSA_ID_id=tsa_id, Student_ID_id=student_id)
+            for (tsa_id, student_id), (rows, _) in student_deltas.items() if rows >= 0
+        ],
+        ignore_conflicts=True
+    )
+    # One UPDATE per distinct delta; a roster only produces a few
+    by_delta = defaultdict(lambda: defaultdict(list))
+    for (tsa_id, student_id), (rows, present) in student_deltas.items():
+        if rows or present:
+            by_delta[(rows, present)][tsa_id].append(student_id)
+    for (rows, present), students in by_delta.items():
+        condition = Q()
+        for tsa_id, student_ids in students.items():
+            condition |= Q(TSA_ID=tsa_id, Student_ID__in=student_ids)
+        Attendance_Summary.objects.filter(condition).update(
+            Total_Sessions=F('Total_Sessions') + rows,
+            Present_Count=F('Present_Count') + present
+        )
+
+    TSA_Attendance_Summary.objects.bulk_create(
+        [TSA_Attendance_Summary(TSA_ID_id=tsa_id) for tsa_id, (_, rows, _) in tsa_deltas.items() if rows >= 0],
+        ignore_conflicts=True
+    )
+    for tsa_id, (sessions, rows, present) in tsa_deltas.items():
+        TSA_Attendance_Summary.objects.filter(TSA_ID=tsa_id).update(
+            Total_Sessions=F('Total_Sessions') + sessions,
+            Total_Records=F('Total_Records') + rows,
+            Present_Count=F('Present_Count') + present
+        )
+
+
+def rebuild_attendance_summaries():
+    """Recompute both summary tables from Attendance. Returns (pairs, TSAs) written."""
+    with transaction.atomic():
+        Attendance_Summary.objects.all().delete()
+        TSA_Attendance_Summary.objects.all().delete()
+
+        pairs = Attendance.objects.values('TSA_ID', 'Student_ID').annotate(
+            rows=Count('pk'),
+            present=Count('pk', filter=Q(Status=True))
+        ).order_by()
+        Attendance_Summary.objects.bulk_create((
+            Attendance_Summary(
+                TSA_ID_id=row['TSA_ID'],
+                Student_ID_id=row['Student_ID'],
+                Total_Sessions=row['rows'],
+                Present_Count=row['present']
+            )
+            for row in pairs.iterator()
+        ), batch_size=1000)
+
+        sessions = defaultdict(int)
+        for tsa_id, _, _ in Attendance.objects.values_list('TSA_ID', 'Date', 'Session_ID').distinct().iterator():
+            sessions[tsa_id] += 1
+
+        totals = Attendance.objects.values('TSA_ID').annotate(
+            rows=Count('pk'),
+            present=Count('pk', filter=Q(Status=True))
+        ).order_by()
+        tsa_rows = TSA_Attendance_Summary.objects.bulk_create([
+            TSA_Attendance_Summary(
+                TSA_ID_id=row['TSA_ID'],
+                Total_Sessions=sessions[row['TSA_ID']],
+                Total_Records=row['rows'],
+                Present_Count=row['present']
+            )
+            for row in totals
+        ], batch_size=1000)
+
+        return Attendance_Summary.objects.count(), len(tsa_rows)
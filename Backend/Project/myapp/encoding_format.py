@@ -0,0 +1,138 @@
+"""
+Binary storage format for face encodings.
+
+Encodings are stored with a small versioned header followed by the vector:
+
+    offset  size  field
+    0       2     magic b'FE'
+    2       1     format version (1)
+    3       1     dtype code (1 = float32, 2 = float16, 3 = float64)
+    4       1     flags (bit 0: vector is L2-normalized)
+    5       1     model tag (1 = dlib ResNet, face_recognition_models 0.3)
+    6       2     vector length, little-endian
+
+Rows written before this format are raw float64.tobytes() of a
+128-dimensional vector (1,024 bytes, no header); readers accept both.
+"""
+import struct
+
+import numpy as np
+from django.conf import settings
+
+
+MAGIC = b'FE'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<2sBBBBH')
+
+DTYPE_CODES = {
+    'float32': 1,
+    'float16': 2,
+    'float64': 3,
+}
+CODE_DTYPES = {code: np.dtype(name) for name, code in DTYPE_CODES.items()}
+
+FLAG_NORMALIZED = 0x01
+
+MODEL_DLIB_RESNET_V1 = 1
+MODELS = {
+    MODEL_DLIB_RESNET_V1: 'dlib_resnet_v1',
+}
+
+LEGACY_SIZE = 128
+LEGACY_BYTES = LEGACY_SIZE * 8
+
+FACE_ENCODING_DTYPE = getattr(settings, 'FACE_ENCODING_DTYPE', 'float32')
+FACE_ENCODING_NORMALIZE = getattr(settings, 'FACE_ENCODING_NORMALIZE', False)
+FACE_ENCODING_MODEL = getattr(settings, 'FACE_ENCODING_MODEL', MODEL_DLIB_RESNET_V1)
+
+
+def _l2_normalize(vector):
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+def pack_encoding(encoding, dtype=None, normalize=None, model=None):
+    """Serialize an encoding vector with a versioned header."""
+    dtype = dtype or FACE_ENCODING_DTYPE
+    normalize = FACE_ENCODING_NORMALIZE if normalize is None else normalize
+    model = model or FACE_ENCODING_MODEL
+    if dtype not in DTYPE_CODES:
+        raise ValueError(f'Unsupported encoding dtype: {dtype}')
+
+    vector = np.asarray(encoding, dtype=np.float64).ravel()
+    flags = 0
+    if normalize:
+        vector = _l2_normalize(vector)
+        flags |= FLAG_NORMALIZED
+
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, DTYPE_CODES[dtype], flags, model, vector.shape[0])
+    return header + vector.astype(CODE_DTYPES[DTYPE_CODES[dtype]]).tobytes()
+
+
+def encoding_info(data):
+    """
+    Describe stored encoding bytes.
+
+    Returns a dict with version, dtype, normalized, model and size, or None
+    if the bytes are neither the versioned nor the legacy format.
+    """
+    if data is None:
+        return None
+    data = bytes(data)
+    if len(data) >= HEADER.size and data[:2] == MAGIC:
+        magic, version, dtype_code, flags, model, size = HEADER.unpack_from(data)
+        dtype = CODE_DTYPES.get(dtype_code)
+        if version != FORMAT_VERSION or dtype is None:
+            return None
+        if len(data) != HEADER.size + size * dtype.itemsize:
+            return None
+        return {
+            'version': version,
+            'dtype': dtype.name,
+            'normalized': bool(flags & FLAG_NORMALIZED),
+            'model': MODELS.get(model, f'unknown ({model})'),
+            'size': size,
+        }
+    if len(data) == LEGACY_BYTES:
+        return {
+            'version': 0,
+            'dtype': 'float64',
+            'normalized': False,
+            'model': MODELS[MODEL_DLIB_RESNET_V1],
+            'size': LEGACY_SIZE,
+        }
+    return None
+
+
+def unpack_encoding(data, normalize=None):
+    """
+    Read stored encoding bytes in either format into a float64 vector.
+
+    When normalize is true (default: FACE_ENCODING_NORMALIZE) vectors stored
+    unnormalized are L2-normalized on read, so mixed rows compare correctly.
+    Returns None for unreadable data.
+    """
+    info = encoding_info(data)
+    if info is None:
+        return None
+    normalize = FACE_ENCODING_NORMALIZE if normalize is None else normalize
+
+    data = bytes(data)
+    if info['version'] == 0:
+        vector = np.frombuffer(data, dtype=np.float64)
+    else:
+        vector = np.frombuffer(data, dtype=info['dtype'], offset=HEADER.size).astype(np.float64)
+    if normalize and not info['normalized']:
+        vector = _l2_normalize(vector)
+    return vector
+
+
+def prepare_query(encoding):
+    """Bring a freshly computed encoding into the space stored vectors are compared in."""
+    vector = np.asarray(encoding, dtype=np.float64)
+    if FACE_ENCODING_NORMALIZE:
+        if vector.ndim == 1:
+            return _l2_normalize(vector)
+        norms = np.linalg.norm(vector, axis=-1, keepdims=True)
+        return vector / np.where(norms > 0, norms, 1)
+    return vector
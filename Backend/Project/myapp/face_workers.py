@@ -0,0 +1,499 @@
+"""
+Process pool for CPU-bound face detection and encoding.
+
+dlib work is moved off the request thread into a persistent pool of worker
+processes. Each worker loads the face_recognition models once when it starts,
+and images are handed over through shared memory instead of being pickled.
+Very large photos are cut into overlapping tiles searched in parallel, and
+the per-tile boxes are merged with non-maximum suppression.
+
+This module must not import Django models: worker processes only need
+face_recognition and NumPy.
+"""
+import atexit
+import io
+import math
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import numpy as np
+import PIL.Image
+from django.conf import settings
+
+
+class WorkerPoolBusy(Exception):
+    """Raised when the face worker queue is full."""
+
+
+# How the working resolution for face detection is chosen, see
+# FACE_DETECTION_POLICY in settings
+DEFAULT_DETECTION_POLICY = {
+    # Width of the smallest (back-row) face, as a fraction of the longer image side
+    'MIN_FACE_FRACTION': 0.02,
+    # Face width the HOG detector finds reliably without upsampling
+    'TARGET_FACE_PX': 80,
+    # Largest image HOG scans in one pass: upsampling never goes beyond it, and
+    # the worker pool may tile working images above it (see FACE_TILING_POLICY)
+    'MAX_PIXELS': 12_000_000,
+    # Upsampling passed to face_locations when faces already reach TARGET_FACE_PX
+    'UPSAMPLE': 0,
+    # Upsampling allowed when they do not, even at the working scale
+    'MAX_UPSAMPLE': 1,
+}
+
+
+def choose_detection_scale(shape, policy=None):
+    """
+    Pick the scale factor and upsample count used to detect faces in an
+    image of the given shape.
+
+    The image is shrunk until the smallest expected face is about
+    TARGET_FACE_PX wide, never further, so back-row faces stay detectable
+    even when the working image exceeds MAX_PIXELS. When faces are smaller
+    than that at full resolution, HOG upsampling makes up the difference
+    (up to MAX_UPSAMPLE, and without enlarging past MAX_PIXELS).
+    """
+    policy = {**DEFAULT_DETECTION_POLICY, **(policy or {})}
+    height, width = shape[:2]
+    smallest_face = policy['MIN_FACE_FRACTION'] * max(height, width)
+    if smallest_face <= 0:
+        return 1.0, policy['UPSAMPLE']
+
+    face_scale = policy['TARGET_FACE_PX'] / smallest_face
+    pixel_scale = math.sqrt(policy['MAX_PIXELS'] / max(height * width, 1))
+    scale = min(1.0, face_scale)
+
+    upsample = policy['UPSAMPLE']
+    if face_scale > 1.0 and pixel_scale > 1.0:
+        # Each upsample doubles the image, so add as many as the faces need
+        upsample = max(upsample, round(math.log2(min(face_scale, pixel_scale))))
+        upsample = min(upsample, policy['MAX_UPSAMPLE'])
+    return scale, upsample
+
+
+def resize_image(image, scale):
+    """Resize an RGB image array by a scale factor."""
+    if scale >= 1.0:
+        return image
+    height, width = image.shape[:2]
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    resized = PIL.Image.fromarray(image).resize(size, PIL.Image.BILINEAR, reducing_gap=2.0)
+    return np.asarray(resized)
+
+
+def scale_locations(face_locations, scale, shape):
+    """Map (top, right, bottom, left) boxes found at `scale` back to full resolution."""
+    if scale == 1.0:
+        return list(face_locations)
+    height, width = shape[:2]
+    mapped = []
+    for top, right, bottom, left in face_locations:
+        mapped.append((
+            max(0, int(round(top / scale))),
+            min(width, int(round(right / scale))),
+            min(height, int(round(bottom / scale))),
+            max(0, int(round(left / scale))),
+        ))
+    return mapped
+
+
+def detect_faces_in_image(image, policy=None):
+    """
+    Locate and encode every face in an RGB image array.
+
+    Faces are located on a downscaled copy chosen by choose_detection_scale,
+    and encoded on the full-resolution image. Returns
+    (face_locations, face_encodings, timings).
+    """
+    import face_recognition
+
+    started = time.perf_counter()
+    scale, upsample = choose_detection_scale(image.shape, policy)
+    working_image = resize_image(image, scale)
+    face_locations = face_recognition.face_locations(
+        working_image, number_of_times_to_upsample=upsample
+    )
+    detected = time.perf_counter()
+    face_locations = scale_locations(face_locations, scale, image.shape)
+    face_encodings = []
+    if face_locations:
+        face_encodings = face_recognition.face_encodings(image, face_locations)
+    finished = time.perf_counter()
+
+    timings = {
+        'scale': round(scale, 4),
+        'detection_seconds': round(detected - started, 4),
+        'encoding_seconds': round(finished - detected, 4),
+        'total_seconds': round(finished - started, 4),
+    }
+    return face_locations, face_encodings, timings
+
+
+def encode_portrait(data):
+    """
+    Encode the single face in an enrollment photo given as encoded image bytes.
+
+    Returns (status, encoding) where status is 'ok', 'no_face', 'multi_face'
+    or 'error'; encoding is the float64 vector on success (see
+    encoding_format.pack_encoding for storage), otherwise None or an error
+    message.
+    """
+    import face_recognition
+
+    try:
+        with PIL.Image.open(io.BytesIO(data)) as photo:
+            image = np.asarray(photo.convert('RGB'))
+        face_locations = face_recognition.face_locations(image)
+        if len(face_locations) == 0:
+            return 'no_face', None
+        if len(face_locations) > 1:
+            return 'multi_face', None
+        face_encodings = face_recognition.face_encodings(image, face_locations)
+        return 'ok', face_encodings[0]
+    except Exception as e:
+        return 'error', str(e)
+
+
+def tile_boxes(shape, tile_size, overlap):
+    """
+    Split an image into overlapping (top, left, bottom, right) tiles that
+    cover it completely.
+
+    Each side gets the fewest tiles of at most `tile_size` that overlap by
+    `overlap`; the tiles are then shrunk to equal size and spread evenly, so
+    neighbours overlap by exactly `overlap` instead of the last tile nearly
+    repeating the one before it.
+    """
+    height, width = shape[:2]
+
+    def spans(length):
+        if length <= tile_size:
+            return [(0, length)]
+        count = math.ceil((length - overlap) / max(1, tile_size - overlap))
+        size = math.ceil((length + (count - 1) * overlap) / count)
+        step = (length - size) / (count - 1)
+        return [(round(k * step), round(k * step) + size) for k in range(count)]
+
+    return [
+        (top, left, bottom, right)
+        for top, bottom in spans(height)
+        for left, right in spans(width)
+    ]
+
+
+def suppress_duplicate_faces(face_locations, threshold=0.5):
+    """
+    Non-maximum suppression over (top, right, bottom, left) boxes.
+
+    HOG detections carry no score, and a face cut by a tile edge yields a
+    smaller partial box, so larger boxes are kept first. A box is dropped
+    when its intersection with a kept box covers more than `threshold` of the
+    smaller of the two.
+    """
+    if not face_locations:
+        return []
+    boxes = np.asarray(face_locations, dtype=np.float64)
+    top, right, bottom, left = boxes.T
+    areas = np.maximum(bottom - top, 0) * np.maximum(right - left, 0)
+    order = np.argsort(-areas, kind='stable')
+
+    keep = []
+    while order.size:
+        i = order[0]
+        keep.append(int(i))
+        rest = order[1:]
+        inter_h = np.maximum(0, np.minimum(bottom[i], bottom[rest]) - np.maximum(top[i], top[rest]))
+        inter_w = np.maximum(0, np.minimum(right[i], right[rest]) - np.maximum(left[i], left[rest]))
+        smaller = np.maximum(np.minimum(areas[i], areas[rest]), 1)
+        order = rest[(inter_h * inter_w) / smaller <= threshold]
+    return [tuple(int(v) for v in face_locations[i]) for i in sorted(keep)]
+
+
+def _init_worker():
+    # Importing face_recognition loads the dlib detector, landmark predictor
+    # and ResNet encoder, so do it once per worker instead of once per job
+    import face_recognition  # noqa: F401
+
+
+class _SharedImage:
+    """Copy of an image array in a shared memory segment owned by the caller."""
+
+    def __init__(self, image):
+        image = np.ascontiguousarray(image)
+        self.shape = image.shape
+        self.dtype = image.dtype.str
+        self.shm = shared_memory.SharedMemory(create=True, size=max(image.nbytes, 1))
+        np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)[...] = image
+
+    @property
+    def ref(self):
+        return self.shm.name, self.shape, self.dtype
+
+    def release(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+def _with_shared_image(ref, func, *args):
+    shm_name, shape, dtype = ref
+    shm = shared_memory.SharedMemory(name=shm_name)
+    image = None
+    try:
+        image = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        return func(image, *args)
+    finally:
+        # Drop the view on the buffer so the segment can be closed
+        image = None
+        shm.close()
+
+
+def _detect_faces_shared(ref, policy):
+    def run(image):
+        face_locations, face_encodings, timings = detect_faces_in_image(image, policy)
+        return list(face_locations), [np.array(e) for e in face_encodings], timings
+    return _with_shared_image(ref, run)
+
+
+def _locate_faces_in_tile(ref, tile, upsample):
+    import face_recognition
+
+    def run(image):
+        started = time.perf_counter()
+        top, left, bottom, right = tile
+        crop = np.ascontiguousarray(image[top:bottom, left:right])
+        found = face_recognition.face_locations(crop, number_of_times_to_upsample=upsample)
+        # Shift boxes from tile to image coordinates
+        boxes = [(t + top, r + left, b + top, l + left) for t, r, b, l in found]
+        return boxes, time.perf_counter() - started
+    return _with_shared_image(ref, run)
+
+
+def _encode_faces_shared(ref, face_locations):
+    import face_recognition
+
+    def run(image):
+        return [np.array(e) for e in face_recognition.face_encodings(image, face_locations)]
+    return _with_shared_image(ref, run)
+
+
+def encode_portraits(photos, processes=None, start_method='spawn'):
+    """
+    Encode many enrollment photos in parallel worker processes.
+
+    `photos` is a list of encoded image bytes; results of encode_portrait are
+    returned in the same order. Runs on a dedicated pool so bulk enrollment
+    does not compete with the request-serving pool's admission limits.
+    """
+    processes = processes or os.cpu_count() or 1
+    if processes <= 1 or len(photos) <= 1:
+        return [encode_portrait(data) for data in photos]
+    with ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context(start_method),
+        initializer=_init_worker,
+    ) as executor:
+        chunksize = max(1, len(photos) // (processes * 4))
+        return list(executor.map(encode_portrait, photos, chunksize=chunksize))
+
+
+DEFAULT_TILING_POLICY = {
+    # Working images up to this many pixels are detected in one pass
+    'MIN_PIXELS': 12_000_000,
+    # Overlapping tiles cost more CPU than one pass, which only pays off in
+    # wall-clock time when this many workers can search them at once
+    'MIN_PROCESSES': 3,
+    'TILE_SIZE': 1600,
+    # Must exceed the largest face so every face fits whole in some tile
+    'OVERLAP': 256,
+    'NMS_THRESHOLD': 0.5,
+}
+
+
+class FaceWorkerPool:
+    """
+    Bounded front end to a ProcessPoolExecutor running face detection.
+
+    At most `concurrency` images are handed to the workers at once. Up to
+    `queue_size` further requests wait for a slot; anything beyond that is
+    rejected with WorkerPoolBusy so a burst cannot pile up unbounded work.
+    Large images are split into overlapping tiles that are searched on
+    several workers in parallel when there are enough of them (see
+    DEFAULT_TILING_POLICY). With processes=0 detection runs inline in
+    the calling thread.
+    """
+
+    def __init__(self, processes, concurrency, queue_size, timeout=None, start_method='spawn',
+                 detection_policy=None, tiling_policy=None):
+        self.processes = processes
+        self.concurrency = max(1, concurrency)
+        self.queue_size = max(0, queue_size)
+        self.timeout = timeout
+        self.start_method = start_method
+        self.detection_policy = detection_policy
+        self.tiling_policy = {**DEFAULT_TILING_POLICY, **(tiling_policy or {})}
+        self._slots = threading.BoundedSemaphore(self.concurrency)
+        self._admission = threading.BoundedSemaphore(self.concurrency + self.queue_size)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context(self.start_method),
+                    initializer=_init_worker,
+                )
+            return self._executor
+
+    def _reset_executor(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+    @contextmanager
+    def _admitted(self):
+        if not self._admission.acquire(blocking=False):
+            raise WorkerPoolBusy('Face recognition workers are busy, please retry shortly')
+        try:
+            if not self._slots.acquire(timeout=self.timeout):
+                raise WorkerPoolBusy('Timed out waiting for a face recognition worker')
+            try:
+                yield
+            except BrokenProcessPool:
+                self._reset_executor()
+                raise
+            finally:
+                self._slots.release()
+        finally:
+            self._admission.release()
+
+    def detect(self, image):
+        """
+        Locate and encode the faces of an RGB image on the worker pool.
+
+        Blocks until the result is ready and returns
+        (face_locations, face_encodings, timings).
+        """
+        with self._admitted():
+            if not self.processes:
+                return detect_faces_in_image(image, self.detection_policy)
+            return self._detect(image)
+
+    def encode(self, data):
+        """Run encode_portrait on the worker pool for one enrollment photo."""
+        with self._admitted():
+            if not self.processes:
+                return encode_portrait(data)
+            return self._get_executor().submit(encode_portrait, data).result(timeout=self.timeout)
+
+    def plan_detection(self, shape):
+        """Return (scale, upsample, tiled) for detecting faces in an image of this shape."""
+        scale, upsample = choose_detection_scale(shape, self.detection_policy)
+        height, width = shape[:2]
+        working_pixels = (height * scale) * (width * scale) * (4 ** upsample)
+        tiled = (
+            self.processes >= self.tiling_policy['MIN_PROCESSES']
+            and working_pixels > self.tiling_policy['MIN_PIXELS']
+        )
+        return scale, upsample, tiled
+
+    def _detect(self, image):
+        scale, upsample, tiled = self.plan_detection(image.shape)
+        if not tiled:
+            shared = _SharedImage(image)
+            try:
+                future = self._get_executor().submit(
+                    _detect_faces_shared, shared.ref, self.detection_policy
+                )
+                return future.result(timeout=self.timeout)
+            finally:
+                shared.release()
+        return self._detect_tiled(image, scale, upsample)
+
+    def _detect_tiled(self, image, scale, upsample):
+        started = time.perf_counter()
+        executor = self._get_executor()
+        working_image = resize_image(image, scale)
+        shared_full = _SharedImage(image)
+        shared_working = shared_full if working_image is image else _SharedImage(working_image)
+        try:
+            tiles = tile_boxes(
+                working_image.shape,
+                self.tiling_policy['TILE_SIZE'],
+                self.tiling_policy['OVERLAP'],
+            )
+            futures = [
+                executor.submit(_locate_faces_in_tile, shared_working.ref, tile, upsample)
+                for tile in tiles
+            ]
+            tile_timings = []
+            found = []
+            for tile, future in zip(tiles, futures):
+                boxes, seconds = future.result(timeout=self.timeout)
+                found.extend(boxes)
+                tile_timings.append({
+                    'tile': list(tile),
+                    'faces_found': len(boxes),
+                    'seconds': round(seconds, 4),
+                })
+            detected = time.perf_counter()
+
+            face_locations = suppress_duplicate_faces(found, self.tiling_policy['NMS_THRESHOLD'])
+            face_locations = scale_locations(face_locations, scale, image.shape)
+            merged = time.perf_counter()
+
+            face_encodings = []
+            if face_locations:
+                face_encodings = executor.submit(
+                    _encode_faces_shared, shared_full.ref, face_locations
+                ).result(timeout=self.timeout)
+            finished = time.perf_counter()
+        finally:
+            shared_full.release()
+            if shared_working is not shared_full:
+                shared_working.release()
+
+        timings = {
+            'scale': round(scale, 4),
+            'tiles': tile_timings,
+            'detection_seconds': round(detected - started, 4),
+            'merge_seconds': round(merged - detected, 4),
+            'encoding_seconds': round(finished - merged, 4),
+            'total_seconds': round(finished - started, 4),
+        }
+        return face_locations, face_encodings, timings
+
+
+# Per web server process; see FACE_WORKER_PROCESSES in settings.py
+FACE_WORKER_PROCESSES = getattr(settings, 'FACE_WORKER_PROCESSES', 2)
+FACE_WORKER_CONCURRENCY = getattr(settings, 'FACE_WORKER_CONCURRENCY', FACE_WORKER_PROCESSES or 1)
+FACE_WORKER_QUEUE_SIZE = getattr(settings, 'FACE_WORKER_QUEUE_SIZE', 32)
+FACE_WORKER_TIMEOUT = getattr(settings, 'FACE_WORKER_TIMEOUT', 120)
+FACE_WORKER_START_METHOD = getattr(settings, 'FACE_WORKER_START_METHOD', 'spawn')
+FACE_DETECTION_POLICY = getattr(settings, 'FACE_DETECTION_POLICY', {})
+FACE_TILING_POLICY = getattr(settings, 'FACE_TILING_POLICY', {})
+
+face_worker_pool = FaceWorkerPool(
+    processes=FACE_WORKER_PROCESSES,
+    concurrency=FACE_WORKER_CONCURRENCY,
+    queue_size=FACE_WORKER_QUEUE_SIZE,
+    timeout=FACE_WORKER_TIMEOUT,
+    start_method=FACE_WORKER_START_METHOD,
+    detection_policy=FACE_DETECTION_POLICY,
+    tiling_policy=FACE_TILING_POLICY,
+)
+atexit.register(face_worker_pool.shutdown)
@@ -0,0 +1,145 @@
+"""
+Self-improving reference gallery built from confirmed attendance.
+
+When FACE_GALLERY_ENABLED is set, every face matched in a group photo with a
+distance of at most FACE_GALLERY_MAX_DISTANCE is kept as a
+Face_Gallery_Candidate. If the teacher then marks that student present for
+the same TSA through mark_attendance, or corrects them to present through
+correct_attendance, within FACE_GALLERY_CONFIRM_WINDOW, the closest
+candidate is promoted to a GALLERY Student_Face_Encoding and takes part in
+matching like any other reference. Each student keeps at most
+FACE_GALLERY_SIZE gallery encodings, newest first. Candidates are aged out
+as new ones are recorded: those older than the confirm window are dropped and
+each student keeps only the FACE_GALLERY_MAX_CANDIDATES closest per TSA.
+
+`python manage.py refresh_face_gallery` drops unconfirmed candidates and
+rebuilds the cached matrices and the face index.
+"""
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .ann_index import FACE_INDEX_DIR, build_index, refresh_students
+from .encoding_format import pack_encoding
+from .models import Face_Gallery_Candidate, Student_Face_Encoding
+from .recognition import encoding_cache
+
+
+FACE_GALLERY_ENABLED = getattr(settings, 'FACE_GALLERY_ENABLED', False)
+FACE_GALLERY_MAX_DISTANCE = getattr(settings, 'FACE_GALLERY_MAX_DISTANCE', 0.4)
+FACE_GALLERY_SIZE = getattr(settings, 'FACE_GALLERY_SIZE', 5)
+FACE_GALLERY_MAX_CANDIDATES = getattr(settings, 'FACE_GALLERY_MAX_CANDIDATES', 3)
+FACE_GALLERY_CONFIRM_WINDOW = getattr(settings, 'FACE_GALLERY_CONFIRM_WINDOW', 6 * 60 * 60)  # seconds
+
+
+def record_candidates(tsa_id, matches, face_encodings, enrolled):
+    """Keep the high-confidence matches of one photo. Returns the number stored."""
+    if not FACE_GALLERY_ENABLED:
+        return 0
+
+    candidates = [
+        Face_Gallery_Candidate(
+            TSA_ID_id=tsa_id,
+            Student_ID_id=enrolled.students[student_index]['id'],
+            Encoding=pack_encoding(face_encodings[face_index]),
+            Distance=distance,
+        )
+        for face_index, student_index, distance, _ in matches
+        if distance <= FACE_GALLERY_MAX_DISTANCE
+    ]
+    Face_Gallery_Candidate.objects.bulk_create(candidates)
+    if candidates:
+        evict_candidates(tsa_id, {candidate.Student_ID_id for candidate in candidates})
+    return len(candidates)
+
+
+def promote_confirmed(tsa_id, student_ids):
+    """
+    Promote the candidates of students just marked present for a TSA.
+
+    Only the closest recent candidate of each student is kept, so several
+    photos of the same lecture add a single gallery entry. Returns the number
+    of gallery encodings added.
+    """
+    if not FACE_GALLERY_ENABLED or not student_ids:
+        return 0
+
+    candidates = Face_Gallery_Candidate.objects.filter(TSA_ID=tsa_id, Student_ID__in=student_ids)
+    cutoff = timezone.now() - timedelta(seconds=FACE_GALLERY_CONFIRM_WINDOW)
+
+    best = {}
+    for student_id, data in candidates.filter(Created_At__gte=cutoff).order_by('Distance').values_list('Student_ID', 'Encoding'):
+        best.setdefault(student_id, data)
+
+    Student_Face_Encoding.objects.bulk_create([
+        Student_Face_Encoding(Student_ID_id=student_id, Encoding=data, Source='GALLERY', Status='OK')
+        for student_id, data in best.items()
+    ])
+    # Expired candidates of other students go too, they can no longer be confirmed
+    Face_Gallery_Candidate.objects.filter(
+        Q(TSA_ID=tsa_id, Student_ID__in=student_ids) | Q(Created_At__lt=cutoff)
+    ).delete()
+
+    if best:
+        evict_gallery(best.keys())
+        refresh_students(best.keys())
+        for student_id in best:
+            encoding_cache.invalidate_student(student_id)
+    return len(best)
+
+
+def evict_candidates(tsa_id=None, student_ids=None):
+    """
+    Delete expired candidates and all but the FACE_GALLERY_MAX_CANDIDATES
+    closest of each student per TSA. Returns the number deleted.
+    """
+    cutoff = timezone.now() - timedelta(seconds=FACE_GALLERY_CONFIRM_WINDOW)
+    candidates = Face_Gallery_Candidate.objects.filter(Created_At__gte=cutoff)
+    if tsa_id is not None:
+        candidates = candidates.filter(TSA_ID=tsa_id)
+    if student_ids is not None:
+        candidates = candidates.filter(Student_ID__in=list(student_ids))
+
+    kept = {}
+    stale = []
+    for candidate_tsa, student_id, pk in candidates.order_by('TSA_ID', 'Student_ID', 'Distance', '-pk').values_list(
+        'TSA_ID', 'Student_ID', 'pk'
+    ):
+        key = (candidate_tsa, student_id)
+        kept[key] = kept.get(key, 0) + 1
+        if kept[key] > FACE_GALLERY_MAX_CANDIDATES:
+            stale.append(pk)
+
+    deleted, _ = Face_Gallery_Candidate.objects.filter(Q(pk__in=stale) | Q(Created_At__lt=cutoff)).delete()
+    return deleted
+
+
+def evict_gallery(student_ids=None):
+    """Delete the oldest gallery encodings beyond FACE_GALLERY_SIZE per student."""
+    gallery = Student_Face_Encoding.objects.filter(Source='GALLERY')
+    if student_ids is not None:
+        gallery = gallery.filter(Student_ID__in=list(student_ids))
+
+    kept = {}
+    stale = []
+    for student_id, pk in gallery.order_by('Student_ID', '-Created_At', '-pk').values_list('Student_ID', 'pk'):
+        kept[student_id] = kept.get(student_id, 0) + 1
+        if kept[student_id] > FACE_GALLERY_SIZE:
+            stale.append(pk)
+
+    if stale:
+        Student_Face_Encoding.objects.filter(pk__in=stale).delete()
+    return len(stale)
+
+
+def refresh_gallery():
+    """Drop expired and surplus candidates, enforce gallery bounds and rebuild cached matrices."""
+    expired = evict_candidates()
+    evicted = evict_gallery()
+    if os.path.isdir(FACE_INDEX_DIR):
+        build_index()
+    encoding_cache.clear()
+    return expired, evicted
@@ -0,0 +1,188 @@
+"""
+Background work queues backed by the database.
+
+Recognition jobs are stored in the Recognition_Job table together with their
+uploaded photo, and student face encodings are queued by setting
+Students.face_encoding_status to PENDING. Neither queue needs an external
+broker and both survive restarts. New work is run by a small in-process
+thread pool as soon as its row is committed; `python manage.py
+process_recognition_jobs` and `process_face_encodings` drain anything left
+behind.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import face_recognition
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .face_workers import face_worker_pool
+from .gallery import record_candidates
+from .models import Recognition_Job, Students, Student_Face_Encoding
+from .recognition import get_tsa_encodings, match_faces, build_recognition_result
+
+
+FACE_JOB_THREADS = getattr(settings, 'FACE_JOB_THREADS', 2)
+# RUNNING jobs not updated for this long are assumed to belong to a dead process
+FACE_JOB_STALE_AFTER = getattr(settings, 'FACE_JOB_STALE_AFTER', 600)  # seconds
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=FACE_JOB_THREADS,
+                thread_name_prefix='recognition-job',
+            )
+        return _executor
+
+
+def submit_background(func, *args):
+    """Run func(*args) on the background thread pool; errors are logged, not raised."""
+    return _get_executor().submit(_run_in_thread, func, *args)
+
+
+def enqueue_recognition_job(tsa_id, uploaded_file):
+    """Store the photo as a pending job and schedule it to run after commit."""
+    job = Recognition_Job(TSA_ID_id=tsa_id)
+    job.Image.save(f'{job.Job_ID}_{uploaded_file.name}', uploaded_file, save=False)
+    job.save()
+
+    job_id = job.Job_ID
+    transaction.on_commit(lambda: submit_background(run_recognition_job, job_id))
+    return job
+
+
+def _run_in_thread(func, *args):
+    close_old_connections()
+    try:
+        func(*args)
+    except Exception as e:
+        print(f"ERROR in background task {func.__name__}{args}: {str(e)}")
+    finally:
+        close_old_connections()
+
+
+def _set_progress(job_id, progress):
+    Recognition_Job.objects.filter(Job_ID=job_id).update(Progress=progress, Updated_At=timezone.now())
+
+
+def run_recognition_job(job_id):
+    """
+    Claim and run one pending job. Returns False if another worker already
+    claimed it.
+    """
+    claimed = Recognition_Job.objects.filter(Job_ID=job_id, Status='PENDING').update(
+        Status='RUNNING', Progress=0, Updated_At=timezone.now()
+    )
+    if not claimed:
+        return False
+
+    job = Recognition_Job.objects.get(Job_ID=job_id)
+    try:
+        group_image = face_recognition.load_image_file(job.Image.path)
+        _set_progress(job_id, 10)
+
+        face_locations, face_encodings, timings = face_worker_pool.detect(group_image)
+        _set_progress(job_id, 80)
+
+        if not face_locations:
+            raise ValueError('No faces found in the image')
+
+        enrolled = get_tsa_encodings(job.TSA_ID_id)
+        matches = match_faces(face_encodings, enrolled)
+        record_candidates(job.TSA_ID_id, matches, face_encodings, enrolled)
+
+        job.Result = build_recognition_result(face_locations, matches, enrolled, timings)
+        job.Status = 'DONE'
+        job.Progress = 100
+    except Exception as e:
+        job.Status = 'FAILED'
+        job.Error = f'Error processing image: {str(e)}'
+
+    # The photo is no longer needed once the job has finished
+    if job.Image:
+        try:
+            job.Image.delete(save=False)
+        except Exception:
+            pass
+    job.save(update_fields=['Result', 'Status', 'Progress', 'Error', 'Image', 'Updated_At'])
+    return True
+
+
+def requeue_stale_jobs():
+    """Return RUNNING jobs abandoned by a dead process to the queue."""
+    cutoff = timezone.now() - timedelta(seconds=FACE_JOB_STALE_AFTER)
+    return Recognition_Job.objects.filter(Status='RUNNING', Updated_At__lt=cutoff).update(
+        Status='PENDING', Progress=0, Updated_At=timezone.now()
+    )
+
+
+def run_pending_jobs(limit=None):
+    """Run pending jobs oldest first. Returns the number of jobs processed."""
+    processed = 0
+    pending = Recognition_Job.objects.filter(Status='PENDING').order_by('Created_At')
+    for job_id in pending.values_list('Job_ID', flat=True)[:limit]:
+        if run_recognition_job(job_id):
+            processed += 1
+    return processed
+
+
+def enqueue_face_encoding(student_id):
+    """Schedule the encoding of a student's photo to run after commit."""
+    transaction.on_commit(lambda: submit_background(run_face_encoding, student_id))
+
+
+def run_face_encoding(student_id):
+    """Encode one student whose encoding is PENDING. Returns the new status."""
+    student = Students.objects.filter(Student_ID=student_id, face_encoding_status='PENDING').first()
+    if student is None or not student.ImagePath:
+        return None
+    return student._process_face_encoding()
+
+
+def enqueue_reference_encoding(reference_id):
+    """Schedule the encoding of a Student_Face_Encoding photo to run after commit."""
+    transaction.on_commit(lambda: submit_background(run_reference_encoding, reference_id))
+
+
+def run_reference_encoding(reference_id):
+    """Encode one pending reference photo. Returns the new status."""
+    reference = Student_Face_Encoding.objects.filter(pk=reference_id, Status='PENDING').first()
+    if reference is None or not reference.Image:
+        return None
+    return reference._process_encoding()
+
+
+def retry_face_encodings(statuses=('ERROR',)):
+    """Queue students and reference photos whose encoding ended in one of `statuses` again."""
+    requeued = Students.objects.filter(face_encoding_status__in=statuses).exclude(
+        ImagePath__isnull=True
+    ).exclude(ImagePath='').update(face_encoding_status='PENDING', face_encoding_error=None)
+    requeued += Student_Face_Encoding.objects.filter(Status__in=statuses).exclude(
+        Image__isnull=True
+    ).exclude(Image='').update(Status='PENDING', Error=None)
+    return requeued
+
+
+def run_pending_face_encodings(limit=None):
+    """Encode pending students, then pending reference photos. Returns {status: count}."""
+    counts = {}
+    pending = Students.objects.filter(face_encoding_status='PENDING').order_by('Student_ID')
+    for student_id in pending.values_list('Student_ID', flat=True)[:limit]:
+        status = run_face_encoding(student_id)
+        if status:
+            counts[status] = counts.get(status, 0) + 1
+
+    pending = Student_Face_Encoding.objects.filter(Status='PENDING').order_by('pk')
+    for reference_id in pending.values_list('pk', flat=True)[:limit]:
+        status = run_reference_encoding(reference_id)
+        if status:
+            counts[status] = counts.get(status, 0) + 1
+    return counts
@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from myapp.ann_index import FACE_INDEX_DIR, build_index
+
+
+class Command(BaseCommand):
+    help = (
+        'Build the shared memory-mapped face store and open-roster index over every '
+        'student encoding. Once built it is kept up to date as encodings change.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--nlist', type=int, default=None, help='Number of clusters (default: sqrt of the row count)')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        rows = build_index(nlist=options['nlist'])
+        if rows is None:
+            raise CommandError(f'Another process is rebuilding the index in {FACE_INDEX_DIR}')
+        self.stdout.write(self.style.SUCCESS(
+            f'Indexed {rows} encoding(s) in {time.perf_counter() - started:.1f}s ({FACE_INDEX_DIR})'
+        ))
@@ -0,0 +1,121 @@
+import csv
+import os
+import zipfile
+
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from myapp.ann_index import FACE_INDEX_DIR, build_index
+from myapp.encoding_format import pack_encoding
+from myapp.face_workers import encode_portraits
+from myapp.models import Students
+from myapp.recognition import encoding_cache
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _iter_photos(source):
+    """Yield (file name, Student_ID, loader) for every photo in a directory or zip archive."""
+    if zipfile.is_zipfile(source):
+        archive = zipfile.ZipFile(source)
+        for member in archive.infolist():
+            name = os.path.basename(member.filename)
+            if member.is_dir() or not name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            yield name, os.path.splitext(name)[0], lambda m=member: archive.read(m)
+    elif os.path.isdir(source):
+        for root, _, files in os.walk(source):
+            for name in sorted(files):
+                if not name.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                path = os.path.join(root, name)
+                yield name, os.path.splitext(name)[0], lambda p=path: _read_file(p)
+    else:
+        raise CommandError(f'{source} is neither a directory nor a zip archive')
+
+
+class Command(BaseCommand):
+    help = (
+        'Encode student photos in bulk. Photos are named <Student_ID>.<ext> and '
+        'read from a directory or zip archive; encodings are written with one bulk_update.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', help='Directory or zip archive of student photos')
+        parser.add_argument('--workers', type=int, default=None, help='Encoding processes (default: CPU count)')
+        parser.add_argument('--batch-size', type=int, default=200, help='Photos held in memory at once')
+        parser.add_argument('--report', default=None, help='Path of the CSV report (default: bulk_enroll_report_<timestamp>.csv)')
+        parser.add_argument('--no-images', action='store_true', help='Only store encodings, do not replace Students.ImagePath')
+
+    def handle(self, *args, **options):
+        photos = list(_iter_photos(options['source']))
+        if not photos:
+            raise CommandError('No photos found')
+
+        students = Students.objects.select_related('Branch_ID').in_bulk([student_id for _, student_id, _ in photos])
+        report = []
+        updated = {}
+
+        known = []
+        for name, student_id, load in photos:
+            if student_id in students:
+                known.append((name, student_id, load))
+            else:
+                report.append((student_id, name, 'unknown_student', 'No student with this ID'))
+
+        batch_size = max(1, options['batch_size'])
+        for start in range(0, len(known), batch_size):
+            batch = known[start:start + batch_size]
+            data = [load() for _, _, load in batch]
+            results = encode_portraits(data, processes=options['workers'])
+
+            for (name, student_id, _), photo, (result, value) in zip(batch, data, results):
+                student = students[student_id]
+                if result != 'ok':
+                    # Record the failure on students that have no encoding yet
+                    if student.face_encoding is None:
+                        student.face_encoding_status = result.upper()
+                        student.face_encoding_error = value
+                        updated[student_id] = student
+                    report.append((student_id, name, result, value or ''))
+                    continue
+
+                student.face_encoding = pack_encoding(value)
+                student.face_encoding_status = 'OK'
+                student.face_encoding_error = None
+                if not options['no_images']:
+                    if student.ImagePath:
+                        student.ImagePath.delete(save=False)
+                    student.ImagePath.save(name, ContentFile(photo), save=False)
+                updated[student_id] = student
+                report.append((student_id, name, 'ok', ''))
+
+            self.stdout.write(f'Encoded {min(start + batch_size, len(known))}/{len(known)} photos')
+
+        fields = ['face_encoding', 'face_encoding_status', 'face_encoding_error']
+        if not options['no_images']:
+            fields.append('ImagePath')
+        Students.objects.bulk_update(list(updated.values()), fields, batch_size=500)
+        if os.path.isdir(FACE_INDEX_DIR):
+            build_index()
+        encoding_cache.clear()
+
+        report_path = options['report'] or f'bulk_enroll_report_{timezone.now():%Y%m%d_%H%M%S}.csv'
+        with open(report_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['Student_ID', 'File', 'Status', 'Message'])
+            writer.writerows(report)
+
+        counts = {}
+        for _, _, result, _ in report:
+            counts[result] = counts.get(result, 0) + 1
+        summary = ', '.join(f'{result}: {count}' for result, count in sorted(counts.items()))
+        self.stdout.write(self.style.SUCCESS(f"Stored {counts.get('ok', 0)} encodings ({summary})"))
+        self.stdout.write(f'Report written to {report_path}')
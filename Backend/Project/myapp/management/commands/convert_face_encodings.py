@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand
+
+from myapp.encoding_format import FACE_ENCODING_DTYPE, FACE_ENCODING_NORMALIZE, encoding_info, pack_encoding, unpack_encoding
+from myapp.models import Students
+from myapp.recognition import encoding_cache
+
+
+class Command(BaseCommand):
+    help = (
+        'Rewrite stored face encodings in the current storage format '
+        '(FACE_ENCODING_DTYPE / FACE_ENCODING_NORMALIZE). Legacy raw float64 rows '
+        'are converted; unreadable rows are reported and left untouched.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dtype', choices=['float32', 'float16', 'float64'], default=FACE_ENCODING_DTYPE,
+                            help='Storage dtype (default: FACE_ENCODING_DTYPE)')
+        parser.add_argument('--batch-size', type=int, default=500, help='Rows written per bulk_update')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the rows that would change')
+
+    def handle(self, *args, **options):
+        dtype = options['dtype']
+        batch_size = max(1, options['batch_size'])
+        rows = Students.objects.exclude(face_encoding__isnull=True).only('Student_ID', 'face_encoding')
+
+        pending = []
+        counts = {'converted': 0, 'current': 0, 'invalid': 0}
+        for student in rows.iterator(chunk_size=batch_size):
+            info = encoding_info(student.face_encoding)
+            if info is None:
+                counts['invalid'] += 1
+                self.stdout.write(self.style.WARNING(f'Unreadable encoding for student {student.Student_ID}'))
+                continue
+            if info['version'] != 0 and info['dtype'] == dtype and info['normalized'] == bool(FACE_ENCODING_NORMALIZE):
+                counts['current'] += 1
+                continue
+
+            student.face_encoding = pack_encoding(unpack_encoding(student.face_encoding, normalize=False), dtype=dtype)
+            pending.append(student)
+            counts['converted'] += 1
+            if len(pending) >= batch_size and not options['dry_run']:
+                Students.objects.bulk_update(pending, ['face_encoding'])
+                pending = []
+
+        if pending and not options['dry_run']:
+            Students.objects.bulk_update(pending, ['face_encoding'])
+        if counts['converted'] and not options['dry_run']:
+            encoding_cache.clear()
+
+        verb = 'Would convert' if options['dry_run'] else 'Converted'
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {counts['converted']} encoding(s) to {dtype}; "
+            f"{counts['current']} already current, {counts['invalid']} unreadable"
+        ))
@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from myapp.jobs import retry_face_encodings, run_pending_face_encodings
+
+
+class Command(BaseCommand):
+    help = 'Compute pending student face encodings, optionally retrying failed ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retry', nargs='*', metavar='STATUS', default=None,
+                            help='Re-queue students with these statuses first (default: ERROR)')
+        parser.add_argument('--once', action='store_true', help='Drain the queue once and exit')
+        parser.add_argument('--interval', type=float, default=2.0, help='Seconds to sleep when the queue is empty')
+
+    def handle(self, *args, **options):
+        if options['retry'] is not None:
+            statuses = [status.upper() for status in options['retry']] or ['ERROR']
+            requeued = retry_face_encodings(statuses)
+            self.stdout.write(f'Re-queued {requeued} student(s)')
+
+        while True:
+            counts = run_pending_face_encodings()
+            if counts:
+                summary = ', '.join(f'{status}: {count}' for status, count in sorted(counts.items()))
+                self.stdout.write(self.style.SUCCESS(f'Encoded {sum(counts.values())} student(s) ({summary})'))
+
+            if options['once']:
+                break
+            if not counts:
+                time.sleep(options['interval'])
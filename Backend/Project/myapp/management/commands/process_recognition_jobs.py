@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from myapp.jobs import requeue_stale_jobs, run_pending_jobs
+
+
+class Command(BaseCommand):
+    help = 'Run pending asynchronous group photo recognition jobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Drain the queue once and exit')
+        parser.add_argument('--interval', type=float, default=2.0, help='Seconds to sleep when the queue is empty')
+
+    def handle(self, *args, **options):
+        while True:
+            requeued = requeue_stale_jobs()
+            if requeued:
+                self.stdout.write(f'Requeued {requeued} stale job(s)')
+
+            processed = run_pending_jobs()
+            if processed:
+                self.stdout.write(self.style.SUCCESS(f'Processed {processed} job(s)'))
+
+            if options['once']:
+                break
+            if not processed:
+                time.sleep(options['interval'])
@@ -0,0 +1,20 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from myapp.attendance_summary import rebuild_attendance_summaries
+
+
+class Command(BaseCommand):
+    help = (
+        'Recompute the per-student and per-TSA attendance summary tables from '
+        'Attendance. Run once after upgrading, and after deleting Attendance rows '
+        'through a queryset outside the admin; other writes keep them up to date.'
+    )
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        pairs, tsas = rebuild_attendance_summaries()
+        self.stdout.write(self.style.SUCCESS(
+            f'Summarized {pairs} student/TSA pair(s) and {tsas} TSA(s) in {time.perf_counter() - started:.1f}s'
+        ))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from myapp.gallery import refresh_gallery
+
+
+class Command(BaseCommand):
+    help = (
+        'Drop gallery candidates that were never confirmed, trim every student '
+        'gallery to FACE_GALLERY_SIZE and rebuild the cached encoding matrices'
+    )
+
+    def handle(self, *args, **options):
+        expired, evicted = refresh_gallery()
+        self.stdout.write(self.style.SUCCESS(
+            f'Removed {expired} expired or surplus candidate(s) and {evicted} old gallery encoding(s)'
+        ))
@@ -1,12 +1,14 @@
 from django.db import models
 from django.core.validators import MinValueValidator, MaxValueValidator
 import os
-import numpy as np
+import uuid
 from django.core.files.storage import default_storage
 from django.core.files.base import ContentFile
 from django.conf import settings
 import face_recognition
 
+from .encoding_format import encoding_info, pack_encoding
+
 # Create your models here.
 
 class TimeSlots(models.Model):
@@ -166,123 +168,124 @@ class Students(models.Model):
     ImagePath = models.ImageField(upload_to=student_image_path, blank=True, null=True)
     face_encoding = models.BinaryField(blank=True, null=True)
 
+    FACE_ENCODING_STATUS_CHOICES = [
+        ('PENDING', 'Pending'),
+        ('OK', 'OK'),
+        ('NO_FACE', 'No face'),
+        ('MULTI_FACE', 'Multiple faces'),
+        ('ERROR', 'Error'),
+    ]
+    face_encoding_status = models.CharField(max_length=10, choices=FACE_ENCODING_STATUS_CHOICES, blank=True, null=True, db_index=True)
+    face_encoding_error = models.TextField(blank=True, null=True)
+
     def save(self, *args, **kwargs):
         """
         Override the save method to handle image uploads and face encodings.
         
         For first-time uploads:
         1. Save the image in media folder
-        2. Create and save face encodings
+        2. Queue the face encoding
         
         For subsequent uploads:
         1. Delete the previous image
         2. Save the new image
-        3. Create and update face encodings
+        3. Queue the face encoding again
+        
+        Encoding runs on the background queue (see myapp.jobs), so saving a
+        student never waits for dlib. face_encoding_status stays PENDING until
+        the worker has stored the result.
         """
-        # Check if this is a new student or an existing one
-        is_new_student = self.pk is None
+        # Get the old student instance from the database, if any
+        old_student = Students.objects.filter(pk=self.pk).first() if self.pk else None
         
         # For existing students, check if the image has changed
-        if not is_new_student:
-            try:
-                # Get the old student instance from the database
-                old_student = Students.objects.get(pk=self.pk)
+        if old_student is not None:
+            if self.ImagePath and old_student.ImagePath and self.ImagePath != old_student.ImagePath:
+                # Image has changed, we need to delete the old image
+                old_image_path = old_student.ImagePath.path
+                print(f"DEBUG: Image changed for student {self.Student_ID}")
+                print(f"DEBUG: Old image path: {old_image_path}")
                 
-                # Check if the image has changed
-                if self.ImagePath and old_student.ImagePath and self.ImagePath != old_student.ImagePath:
-                    # Image has changed, we need to delete the old image
-                    old_image_path = old_student.ImagePath.path
-                    print(f"DEBUG: Image changed for student {self.Student_ID}")
-                    print(f"DEBUG: Old image path: {old_image_path}")
-                    
-                    # Delete the old image file
-                    if os.path.exists(old_image_path):
-                        try:
-                            print(f"DEBUG: Deleting old image file: {old_image_path}")
-                            os.remove(old_image_path)
-                            print(f"DEBUG: Old image file deleted successfully")
-                        except Exception as e:
-                            print(f"ERROR deleting old image file: {str(e)}")
-            except Students.DoesNotExist:
-                # This shouldn't happen, but just in case
-                pass
+                # Delete the old image file
+                if os.path.exists(old_image_path):
+                    try:
+                        print(f"DEBUG: Deleting old image file: {old_image_path}")
+                        os.remove(old_image_path)
+                        print(f"DEBUG: Old image file deleted successfully")
+                    except Exception as e:
+                        print(f"ERROR deleting old image file: {str(e)}")
+        
+        # Queue encoding for a new image, or retry one that failed for
+        # reasons other than the photo itself
+        update_fields = kwargs.get('update_fields')
+        image_changed = old_student is None or self.ImagePath != old_student.ImagePath
+        needs_encoding = bool(self.ImagePath) and (update_fields is None or 'ImagePath' in update_fields) and (
+            image_changed
+            or (self.face_encoding is None and self.face_encoding_status not in ('PENDING', 'NO_FACE', 'MULTI_FACE'))
+        )
+        if needs_encoding:
+            if image_changed:
+                self.face_encoding = None
+            self.face_encoding_status = 'PENDING'
+            self.face_encoding_error = None
+            if update_fields is not None:
+                kwargs['update_fields'] = set(update_fields) | {'face_encoding', 'face_encoding_status', 'face_encoding_error'}
         
         # First save to let Django handle the file upload
         super().save(*args, **kwargs)
         
-        # Process face encoding if an image is uploaded
-        if self.ImagePath:
-            print(f"DEBUG: Processing face encoding for student {self.Student_ID}")
-            self._process_face_encoding()
+        if needs_encoding:
+            print(f"DEBUG: Queued face encoding for student {self.Student_ID}")
+            from .jobs import enqueue_face_encoding
+            enqueue_face_encoding(self.Student_ID)
     
     def _process_face_encoding(self):
         """
-        Process face encoding for the student's image.
-        This method is called after the image is saved to the media folder.
+        Compute the face encoding of the student's image and store it together
+        with its status. Called by the background encoding queue after the
+        image has been saved to the media folder. Returns the new status.
         """
+        from .ann_index import refresh_students
+        from .face_workers import face_worker_pool
+        from .recognition import encoding_cache
+        
+        face_encoding_bytes = None
+        error = None
         try:
-            # Load the image and detect faces
             image_path = self.ImagePath.path
-            print(f"DEBUG: Processing image at path: {image_path}")
-            
             if not os.path.exists(image_path):
-                print(f"ERROR: Image file not found at {image_path}")
-                return
-            
-            print(f"DEBUG: Loading image with face_recognition")
-            image = face_recognition.load_image_file(image_path)
-            
-            # Find all face locations in the image
-            print(f"DEBUG: Finding face locations")
-            face_locations = face_recognition.face_locations(image)
-            print(f"DEBUG: Found {len(face_locations)} faces in the image")
-            
-            if len(face_locations) == 0:
-                print(f"ERROR: No face detected in the image for student {self.Student_ID}")
-                return
-            
-            if len(face_locations) > 1:
-                print(f"ERROR: Multiple faces detected in the image for student {self.Student_ID}")
-                return
-            
-            # Get face encodings for the face in the image
-            print(f"DEBUG: Generating face encodings")
-            face_encodings = face_recognition.face_encodings(image, face_locations)
-            print(f"DEBUG: Generated {len(face_encodings)} face encodings")
-            
-            # Store the face encoding
-            print(f"DEBUG: Converting face encoding to bytes")
-            face_encoding_bytes = face_encodings[0].tobytes()
-            print(f"DEBUG: Face encoding bytes length: {len(face_encoding_bytes)}")
-            
-            # Update the model instance with the face encoding
-            self.face_encoding = face_encoding_bytes
-            
-            # Save the model to store the face encoding
-            print(f"DEBUG: Saving face encoding to database")
-            super().save(update_fields=['face_encoding'])
-            
-            # Verify the face encoding was saved
-            saved_student = Students.objects.get(pk=self.pk)
-            if saved_student.face_encoding:
-                print(f"SUCCESS: Face encoding stored for student {self.Student_ID}")
-                print(f"DEBUG: Stored face encoding length: {len(saved_student.face_encoding)}")
+                status, error = 'ERROR', f"Image file not found at {image_path}"
             else:
-                print(f"ERROR: Face encoding not stored for student {self.Student_ID}")
-                # Try one more time with a direct database update
-                print(f"DEBUG: Attempting direct database update")
-                Students.objects.filter(pk=self.pk).update(face_encoding=face_encoding_bytes)
-                # Verify again
-                saved_student = Students.objects.get(pk=self.pk)
-                if saved_student.face_encoding:
-                    print(f"SUCCESS: Face encoding stored on second attempt for student {self.Student_ID}")
-                else:
-                    print(f"ERROR: Face encoding still not stored after second attempt for student {self.Student_ID}")
-            
+                with open(image_path, 'rb') as f:
+                    result, value = face_worker_pool.encode(f.read())
+                status = result.upper()
+                if result == 'ok':
+                    face_encoding_bytes = pack_encoding(value)
+                elif result == 'error':
+                    error = value
         except Exception as e:
-            print(f"ERROR processing image for student {self.Student_ID}: {str(e)}")
-            import traceback
-            print(traceback.format_exc())
+            status, error = 'ERROR', str(e)
+        
+        if status == 'OK':
+            print(f"SUCCESS: Face encoding stored for student {self.Student_ID}")
+        else:
+            print(f"ERROR: Face encoding failed for student {self.Student_ID}: {status} {error or ''}")
+        
+        # Skip the write if the image was replaced while we were encoding
+        Students.objects.filter(pk=self.pk, ImagePath=self.ImagePath.name).update(
+            face_encoding=face_encoding_bytes,
+            face_encoding_status=status,
+            face_encoding_error=error,
+        )
+        self.face_encoding = face_encoding_bytes
+        self.face_encoding_status = status
+        self.face_encoding_error = error
+        
+        # Update the shared face store first so a reload sees the new rows,
+        # then drop cached encoding matrices of the TSAs this student is in
+        refresh_students([self.Student_ID])
+        encoding_cache.invalidate_student(self.Student_ID)
+        return status
 
     def delete(self, *args, **kwargs):
         # Delete the image file when the student record is deleted
@@ -297,14 +300,20 @@ class Students(models.Model):
 
     def get_face_encoding_status(self):
         """Get a human-readable status of the face encoding."""
+        if self.face_encoding_status == 'PENDING':
+            return "Encoding pending"
         if self.face_encoding is None:
+            if self.face_encoding_status in ('NO_FACE', 'MULTI_FACE', 'ERROR'):
+                return self.get_face_encoding_status_display()
             return "No face encoding"
         try:
-            # Convert binary data back to numpy array to verify it's valid
-            encoding_array = np.frombuffer(self.face_encoding, dtype=np.float64)
-            if len(encoding_array) == 128:  # face_recognition uses 128-dimensional encodings
-                return "Valid face encoding"
-            return "Invalid encoding format"
+            # Parse the header (or recognise the legacy raw float64 layout)
+            info = encoding_info(self.face_encoding)
+            if info is None or info['size'] != 128:  # face_recognition uses 128-dimensional encodings
+                return "Invalid encoding format"
+            if info['version'] == 0:
+                return "Valid face encoding (legacy float64)"
+            return f"Valid face encoding (v{info['version']}, {info['dtype']}, {info['model']})"
         except Exception as e:
             return f"Error checking encoding: {str(e)}"
 
@@ -338,7 +347,7 @@ class Students(models.Model):
             print(f"TEST: Generated {len(face_encodings)} face encodings")
             
             print(f"TEST: Converting face encoding to bytes")
-            face_encoding_bytes = face_encodings[0].tobytes()
+            face_encoding_bytes = pack_encoding(face_encodings[0])
             print(f"TEST: Face encoding bytes length: {len(face_encoding_bytes)}")
             
             return True, "Face encoding generated successfully", face_encoding_bytes
@@ -358,6 +367,99 @@ class Students(models.Model):
         return f"{self.Student_ID} - {self.Student_Name}"
 
 
+class Student_Face_Encoding(models.Model):
+    """
+    Additional reference encodings of a student, e.g. photos taken under
+    different lighting or angles. They are matched together with
+    Students.face_encoding: a student's distance to a face is the smaller of
+    the distance to the centroid of all references and to the closest one.
+    """
+    SOURCE_CHOICES = [
+        ('PHOTO', 'Reference photo'),
+        ('GALLERY', 'Confirmed attendance'),
+    ]
+
+    def reference_image_path(instance, filename):
+        ext = filename.split('.')[-1]
+        return f'student_references/{instance.Student_ID_id}/{uuid.uuid4().hex}.{ext}'
+
+    Student_ID = models.ForeignKey(Students, on_delete=models.CASCADE, db_column='Student_ID', related_name='face_references')
+    Image = models.ImageField(upload_to=reference_image_path, blank=True, null=True)
+    Encoding = models.BinaryField(blank=True, null=True)
+    Source = models.CharField(max_length=10, choices=SOURCE_CHOICES, default='PHOTO')
+    Status = models.CharField(max_length=10, choices=Students.FACE_ENCODING_STATUS_CHOICES, blank=True, null=True, db_index=True)
+    Error = models.TextField(blank=True, null=True)
+    Created_At = models.DateTimeField(auto_now_add=True)
+
+    def save(self, *args, **kwargs):
+        """Queue the encoding of a new or replaced reference photo, like Students.save."""
+        old = Student_Face_Encoding.objects.filter(pk=self.pk).first() if self.pk else None
+        needs_encoding = bool(self.Image) and (old is None or self.Image != old.Image)
+        if needs_encoding:
+            self.Encoding = None
+            self.Status = 'PENDING'
+            self.Error = None
+
+        super().save(*args, **kwargs)
+
+        if needs_encoding:
+            from .jobs import enqueue_reference_encoding
+            enqueue_reference_encoding(self.pk)
+
+    def _process_encoding(self):
+        """Encode the reference photo and store the result. Returns the new status."""
+        from .ann_index import refresh_students
+        from .face_workers import face_worker_pool
+        from .recognition import encoding_cache
+
+        encoding_bytes = None
+        error = None
+        try:
+            with self.Image.open('rb') as f:
+                result, value = face_worker_pool.encode(f.read())
+            status = result.upper()
+            if result == 'ok':
+                encoding_bytes = pack_encoding(value)
+            elif result == 'error':
+                error = value
+        except Exception as e:
+            status, error = 'ERROR', str(e)
+
+        if status != 'OK':
+            print(f"ERROR: Reference encoding {self.pk} failed for student {self.Student_ID_id}: {status} {error or ''}")
+
+        Student_Face_Encoding.objects.filter(pk=self.pk, Image=self.Image.name).update(
+            Encoding=encoding_bytes,
+            Status=status,
+            Error=error,
+        )
+        self.Encoding = encoding_bytes
+        self.Status = status
+        self.Error = error
+
+        refresh_students([self.Student_ID_id])
+        encoding_cache.invalidate_student(self.Student_ID_id)
+        return status
+
+    def delete(self, *args, **kwargs):
+        from .ann_index import refresh_students
+        from .recognition import encoding_cache
+
+        if self.Image:
+            self.Image.delete(save=False)
+        super().delete(*args, **kwargs)
+        refresh_students([self.Student_ID_id])
+        encoding_cache.invalidate_student(self.Student_ID_id)
+
+    class Meta:
+        db_table = 'Student_Face_Encoding'
+        verbose_name = 'Student Face Reference'
+        verbose_name_plural = 'Student Face References'
+
+    def __str__(self):
+        return f"{self.Student_ID_id} - {self.get_Source_display()} ({self.Status})"
+
+
 class Students_Current_Class(models.Model):
     Student_ID = models.OneToOneField(Students, on_delete=models.CASCADE, db_column='Student_ID', primary_key=True)
     Branch_ID = models.ForeignKey(Branch, on_delete=models.CASCADE, db_column='Branch_ID')
@@ -455,7 +557,8 @@ class Attendance(models.Model):
     Student_ID = models.ForeignKey(Students, on_delete=models.CASCADE, db_column='Student_ID')
     Session_ID = models.ForeignKey(Session, on_delete=models.CASCADE, db_column='Session_ID')
     Class_ID = models.ForeignKey(Classes, on_delete=models.CASCADE, db_column='Class_ID')
-    TSA_ID = models.ForeignKey(Teacher_Subject_Assignment, on_delete=models.CASCADE, db_column='TSA_ID')
+    # Indexed through the composite indexes below, which all start with TSA_ID
+    TSA_ID = models.ForeignKey(Teacher_Subject_Assignment, on_delete=models.CASCADE, db_column='TSA_ID', db_index=False)
     Status = models.BooleanField()
 
     class Meta:
@@ -463,10 +566,66 @@ class Attendance(models.Model):
         verbose_name = 'Attendance'
         verbose_name_plural = 'Attendance Records'
         unique_together = ('Date', 'Session_ID', 'Student_ID')
+        # Covering indexes for the read paths (see Util_BenchmarkAttendanceIndexes.py):
+        # lectures of a TSA (schedule, register dates, summary upkeep) and
+        # the rows of one student in a TSA (register, summary rebuild)
+        indexes = [
+            models.Index(fields=['TSA_ID', 'Session_ID', 'Date', 'Status']),
+            models.Index(fields=['TSA_ID', 'Student_ID', 'Date', 'Status']),
+        ]
 
     def __str__(self):
         return f"{self.Date} - {self.Student_ID.Student_ID} - {self.Session_ID.Session_ID}"
 
+    def delete(self, *args, **kwargs):
+        from django.db import transaction
+        from .attendance_summary import discount_attendance
+
+        # Cascades never call this, they are discounted by the parents'
+        # pre_delete receivers (see myapp.signals)
+        with transaction.atomic():
+            discount_attendance(Attendance.objects.filter(pk=self.pk))
+            return super().delete(*args, **kwargs)
+
+
+class Attendance_Summary(models.Model):
+    """
+    Attendance totals of one student in one TSA, kept in step with the
+    Attendance table (see myapp.attendance_summary).
+    """
+    TSA_ID = models.ForeignKey(Teacher_Subject_Assignment, on_delete=models.CASCADE, db_column='TSA_ID')
+    Student_ID = models.ForeignKey(Students, on_delete=models.CASCADE, db_column='Student_ID')
+    Total_Sessions = models.IntegerField(default=0)
+    Present_Count = models.IntegerField(default=0)
+
+    class Meta:
+        db_table = 'Attendance_Summary'
+        verbose_name = 'Attendance Summary'
+        verbose_name_plural = 'Attendance Summaries'
+        unique_together = ('TSA_ID', 'Student_ID')
+
+    def __str__(self):
+        return f"{self.TSA_ID_id} - {self.Student_ID_id}: {self.Present_Count}/{self.Total_Sessions}"
+
+
+class TSA_Attendance_Summary(models.Model):
+    """
+    Attendance totals of one TSA: distinct (Date, Session_ID) lectures held,
+    attendance rows and present rows.
+    """
+    TSA_ID = models.OneToOneField(Teacher_Subject_Assignment, on_delete=models.CASCADE, db_column='TSA_ID', primary_key=True)
+    Total_Sessions = models.IntegerField(default=0)
+    Total_Records = models.IntegerField(default=0)
+    Present_Count = models.IntegerField(default=0)
+
+    class Meta:
+        db_table = 'TSA_Attendance_Summary'
+        verbose_name = 'TSA Attendance Summary'
+        verbose_name_plural = 'TSA Attendance Summaries'
+
+    def __str__(self):
+        return f"{self.TSA_ID_id}: {self.Present_Count}/{self.Total_Records} over {self.Total_Sessions} sessions"
+
 
 class Users(models.Model):
     ROLE_CHOICES = [
@@ -486,3 +645,59 @@ class Users(models.Model):
 
     def __str__(self):
         return f"{self.User_ID} - {self.Role}"
+
+
+class Face_Gallery_Candidate(models.Model):
+    """
+    A high-confidence face matched in a group photo, kept until the teacher
+    confirms the student as present through mark_attendance or
+    correct_attendance (see myapp.gallery). Confirmed candidates become
+    GALLERY references.
+    """
+    TSA_ID = models.ForeignKey(Teacher_Subject_Assignment, on_delete=models.CASCADE, db_column='TSA_ID')
+    Student_ID = models.ForeignKey(Students, on_delete=models.CASCADE, db_column='Student_ID')
+    Encoding = models.BinaryField()
+    Distance = models.FloatField()
+    Created_At = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        db_table = 'Face_Gallery_Candidate'
+        verbose_name = 'Face Gallery Candidate'
+        verbose_name_plural = 'Face Gallery Candidates'
+        indexes = [
+            models.Index(fields=['TSA_ID', 'Student_ID', 'Created_At']),
+        ]
+
+    def __str__(self):
+        return f"{self.Student_ID_id} - {self.TSA_ID_id} ({self.Distance:.3f})"
+
+
+class Recognition_Job(models.Model):
+    STATUS_CHOICES = [
+        ('PENDING', 'Pending'),
+        ('RUNNING', 'Running'),
+        ('DONE', 'Done'),
+        ('FAILED', 'Failed'),
+    ]
+
+    Job_ID = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    TSA_ID = models.ForeignKey(Teacher_Subject_Assignment, on_delete=models.CASCADE, db_column='TSA_ID')
+    # Uploaded photo, kept until the job has run so pending jobs survive restarts
+    Image = models.FileField(upload_to='recognition_jobs/', blank=True, null=True)
+    Status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='PENDING')
+    Progress = models.IntegerField(default=0, validators=[MinValueValidator(0), MaxValueValidator(100)])
+    Result = models.JSONField(blank=True, null=True)
+    Error = models.TextField(blank=True, null=True)
+    Created_At = models.DateTimeField(auto_now_add=True)
+    Updated_At = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'Recognition_Job'
+        verbose_name = 'Recognition Job'
+        verbose_name_plural = 'Recognition Jobs'
+        indexes = [
+            models.Index(fields=['Status', 'Created_At']),
+        ]
+
+    def __str__(self):
+        return f"{self.Job_ID} - {self.Status}"
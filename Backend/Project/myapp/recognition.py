@@ -0,0 +1,405 @@
+"""
+Face matching helpers used by the group photo recognition endpoints.
+
+Enrolled encodings of a TSA are packed into a single matrix so that every
+detected face can be compared against every student with one NumPy
+operation, instead of calling face_recognition.compare_faces per pair.
+Students with several reference encodings contribute a block of rows (their
+centroid followed by each reference) that is reduced to one column per
+student with a minimum.
+The packed matrices are kept in a small in-process LRU cache so that the
+3-4 uploads of one class do not hit the database again.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from django.conf import settings
+
+from .encoding_format import prepare_query, unpack_encoding
+from .models import Students, Student_TSA_Enrollment, Student_Face_Encoding
+
+
+# face_recognition produces 128-dimensional encodings
+ENCODING_SIZE = 128
+
+FACE_MATCH_TOLERANCE = getattr(settings, 'FACE_MATCH_TOLERANCE', 0.6)
+FACE_ENCODING_CACHE_MAX_BYTES = getattr(settings, 'FACE_ENCODING_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+FACE_ENCODING_CACHE_TTL = getattr(settings, 'FACE_ENCODING_CACHE_TTL', 300)
+
+# Rough per-student overhead of the parallel list of student dicts
+_STUDENT_ENTRY_BYTES = 256
+
+
+class EnrolledEncodings:
+    """
+    Packed face encodings of the students enrolled in one TSA.
+
+    The rows of students[i] start at matrix[row_starts[i]] and run up to the
+    next student's block; with row_starts None there is exactly one row per
+    student. Students without a usable encoding are left out of the matrix
+    but still counted in total_enrolled.
+    """
+
+    def __init__(self, tsa_id, matrix, students, total_enrolled, enrolled_ids=(), row_starts=None):
+        self.tsa_id = tsa_id
+        self.matrix = matrix
+        self.students = students
+        self.total_enrolled = total_enrolled
+        # Every enrolled student, with or without an encoding, so that a newly
+        # stored encoding invalidates the TSAs the student belongs to
+        self.enrolled_ids = frozenset(enrolled_ids)
+        self.row_starts = row_starts
+
+    def __len__(self):
+        return len(self.students)
+
+    def student_distances(self, row_distances):
+        """Reduce (faces, rows) distances to (faces, students) by taking each block's minimum."""
+        if self.row_starts is None or row_distances.shape[0] == 0 or row_distances.shape[1] == 0:
+            return row_distances
+        return np.minimum.reduceat(row_distances, self.row_starts, axis=1)
+
+    def contains_student(self, student_id):
+        return student_id in self.enrolled_ids
+
+    @property
+    def student_ids(self):
+        return [student['id'] for student in self.students]
+
+    @property
+    def nbytes(self):
+        return self.matrix.nbytes + _STUDENT_ENTRY_BYTES * max(self.total_enrolled, 1)
+
+
+class EncodingCache:
+    """
+    Thread-safe LRU cache of EnrolledEncodings keyed by TSA ID.
+
+    Entries are evicted least recently used first once max_bytes is exceeded,
+    and are treated as stale after ttl seconds so that workers which missed an
+    invalidation (other processes, bulk imports) eventually reload.
+    """
+
+    def __init__(self, max_bytes=FACE_ENCODING_CACHE_MAX_BYTES, ttl=FACE_ENCODING_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(tsa_id):
+        try:
+            return int(tsa_id)
+        except (TypeError, ValueError):
+            return str(tsa_id)
+
+    def get(self, tsa_id):
+        key = self._key(tsa_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            enrolled, loaded_at = entry
+            if self.ttl and time.monotonic() - loaded_at > self.ttl:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return enrolled
+
+    def put(self, enrolled):
+        key = self._key(enrolled.tsa_id)
+        size = enrolled.nbytes
+        with self._lock:
+            self._remove(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (enrolled, time.monotonic())
+            self._size += size
+            while self._size > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+
+    def invalidate_tsa(self, tsa_id):
+        with self._lock:
+            self._remove(self._key(tsa_id))
+
+    def invalidate_student(self, student_id):
+        """Drop every cached TSA the student is enrolled in."""
+        with self._lock:
+            stale = [
+                key for key, (enrolled, _) in self._entries.items()
+                if enrolled.contains_student(student_id)
+            ]
+            for key in stale:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[0].nbytes
+
+
+encoding_cache = EncodingCache()
+
+
+def student_encoding_rows(stored):
+    """
+    Matrix rows of one student from their stored encodings (primary first).
+
+    Unreadable encodings are skipped. With more than one reference the
+    centroid comes first, so a face between two references still matches.
+    """
+    encodings = []
+    for data in stored:
+        encoding = unpack_encoding(data) if data else None
+        if encoding is not None and encoding.shape[0] == ENCODING_SIZE:
+            encodings.append(encoding)
+    if len(encodings) > 1:
+        encodings.insert(0, prepare_query(np.mean(encodings, axis=0)))
+    return encodings
+
+
+def read_stored_encodings(student_ids=None):
+    """
+    Read and decode the encodings of the given students (default: all) from
+    the database. Returns {student_id: (branch_id, rows)} with rows as built
+    by student_encoding_rows.
+    """
+    students = Students.objects.all()
+    references = Student_Face_Encoding.objects.filter(Status='OK', Encoding__isnull=False)
+    if student_ids is not None:
+        students = students.filter(Student_ID__in=student_ids)
+        references = references.filter(Student_ID__in=student_ids)
+
+    stored = {}
+    branches = {}
+    for student_id, branch_id, face_encoding in students.values_list('Student_ID', 'Branch_ID', 'face_encoding'):
+        stored[student_id] = [face_encoding]
+        branches[student_id] = branch_id
+    for student_id, data in references.values_list('Student_ID', 'Encoding'):
+        if student_id in stored:
+            stored[student_id].append(data)
+
+    return {
+        student_id: (branches[student_id], student_encoding_rows(encodings))
+        for student_id, encodings in stored.items()
+    }
+
+
+def load_tsa_encodings(tsa_id):
+    """
+    Pack the face encodings of every student enrolled in a TSA.
+
+    Encodings come from the shared memory-mapped face store when it has been
+    built (see ann_index), so only the roster is read from the database.
+    """
+    from .ann_index import face_index
+
+    rows = list(Student_TSA_Enrollment.objects.filter(TSA_ID=tsa_id).values_list(
+        'Student_ID',
+        'Student_ID__Student_Name',
+        'Student_ID__Branch_ID',
+        'Student_ID__Graduation_Batch',
+    ))
+    enrolled_ids = [row[0] for row in rows]
+
+    if face_index.available():
+        stored = face_index.student_rows(enrolled_ids)
+    else:
+        stored = {student_id: encodings for student_id, (_, encodings) in read_stored_encodings(enrolled_ids).items()}
+
+    students = []
+    blocks = []
+    row_starts = []
+    row_count = 0
+    for student_id, name, branch_id, batch in rows:
+        encodings = stored.get(student_id)
+        if encodings is None or not len(encodings):
+            continue
+
+        students.append({
+            'id': student_id,
+            'name': name,
+            'branch': branch_id,
+            'batch': batch,
+        })
+        blocks.extend(encodings)
+        row_starts.append(row_count)
+        row_count += len(encodings)
+
+    # Stored vectors are at most float32 precision, so the packed matrix is
+    # kept in float32 to halve its cache footprint
+    if blocks:
+        matrix = np.ascontiguousarray(np.vstack(blocks), dtype=np.float32)
+    else:
+        matrix = np.empty((0, ENCODING_SIZE), dtype=np.float32)
+    # One row per student needs no reduction
+    row_starts = np.asarray(row_starts, dtype=np.intp) if row_count > len(students) else None
+
+    return EnrolledEncodings(tsa_id, matrix, students, len(enrolled_ids), enrolled_ids, row_starts)
+
+
+def get_tsa_encodings(tsa_id):
+    """Return the packed encodings of a TSA, loading them on a cache miss."""
+    enrolled = encoding_cache.get(tsa_id)
+    if enrolled is None:
+        enrolled = load_tsa_encodings(tsa_id)
+        encoding_cache.put(enrolled)
+    return enrolled
+
+
+def face_distance_matrix(face_encodings, known_matrix):
+    """
+    Euclidean distance between every detected face and every known encoding.
+
+    Returns an array of shape (len(face_encodings), len(known_matrix)), the
+    same values face_recognition.face_distance would give pair by pair.
+    Computed in the precision of known_matrix, so float32 caches are not
+    copied to float64 on every request.
+    """
+    known_matrix = np.asarray(known_matrix)
+    dtype = np.float32 if known_matrix.dtype == np.float32 else np.float64
+    faces = np.asarray(face_encodings, dtype=dtype).reshape(-1, ENCODING_SIZE)
+    known = np.asarray(known_matrix, dtype=dtype).reshape(-1, ENCODING_SIZE)
+    if faces.shape[0] == 0 or known.shape[0] == 0:
+        return np.empty((faces.shape[0], known.shape[0]), dtype=dtype)
+
+    # |a - b|^2 = |a|^2 + |b|^2 - 2 a.b, computed for all pairs at once
+    squared = (
+        np.einsum('ij,ij->i', faces, faces)[:, np.newaxis]
+        + np.einsum('ij,ij->i', known, known)[np.newaxis, :]
+        - 2.0 * faces @ known.T
+    )
+    np.maximum(squared, 0.0, out=squared)
+    return np.sqrt(squared)
+
+
+def assign_faces(distances, tolerance=FACE_MATCH_TOLERANCE):
+    """
+    Globally assign faces to students from a distance matrix.
+
+    Candidate pairs within tolerance are taken closest first, so each face is
+    matched to at most one student and each student to at most one face.
+    Returns a list of (face_index, student_index, distance, margin) tuples,
+    where margin is how much closer the face is to its student than to the
+    runner-up student (None with no runner-up). A face that lost its nearest
+    student to a closer face is assigned with margin 0.
+    """
+    face_idx, student_idx = np.nonzero(distances <= tolerance)
+    if face_idx.size == 0:
+        return []
+
+    candidate_distances = distances[face_idx, student_idx]
+    order = np.argsort(candidate_distances, kind='stable')
+
+    # Two closest students of every face, for the runner-up margin
+    if distances.shape[1] > 1:
+        nearest = np.argmin(distances, axis=1)
+        closest_two = np.partition(distances, 1, axis=1)[:, :2]
+    else:
+        nearest = np.zeros(distances.shape[0], dtype=np.intp)
+        closest_two = np.concatenate([distances, np.full_like(distances, np.inf)], axis=1)
+
+    used_faces = set()
+    used_students = set()
+    matches = []
+    for k in order:
+        face = int(face_idx[k])
+        student = int(student_idx[k])
+        if face in used_faces or student in used_students:
+            continue
+        used_faces.add(face)
+        used_students.add(student)
+        distance = float(candidate_distances[k])
+        runner_up = closest_two[face, 1] if nearest[face] == student else closest_two[face, 0]
+        margin = float(max(runner_up - distance, 0.0)) if np.isfinite(runner_up) else None
+        matches.append((face, student, distance, margin))
+    return matches
+
+
+def match_faces(face_encodings, enrolled, tolerance=FACE_MATCH_TOLERANCE):
+    """Match detected face encodings against the packed encodings of a TSA."""
+    faces = prepare_query(np.asarray(face_encodings).reshape(-1, ENCODING_SIZE))
+    distances = enrolled.student_distances(face_distance_matrix(faces, enrolled.matrix))
+    return assign_faces(distances, tolerance)
+
+
+def merge_photo_matches(photo_matches):
+    """
+    Merge the per-photo matches of one class into a single roster.
+
+    photo_matches[p] is the match list of photo p as returned by match_faces.
+    Returns {student_index: {'best_distance': float, 'best_margin': float or
+    None, 'photos': [p, ...], 'faces': [face index in each photo, ...]}}.
+    """
+    roster = {}
+    for photo_index, matches in enumerate(photo_matches):
+        for face_index, student_index, distance, margin in matches:
+            entry = roster.get(student_index)
+            if entry is None:
+                roster[student_index] = {
+                    'best_distance': distance,
+                    'best_margin': margin,
+                    'photos': [photo_index],
+                    'faces': [face_index],
+                }
+            else:
+                if distance < entry['best_distance']:
+                    entry['best_distance'] = distance
+                    entry['best_margin'] = margin
+                entry['photos'].append(photo_index)
+                entry['faces'].append(face_index)
+    return roster
+
+
+def face_box(location):
+    """A (top, right, bottom, left) face location as a response dict."""
+    top, right, bottom, left = (int(value) for value in location)
+    return {'top': top, 'right': right, 'bottom': bottom, 'left': left}
+
+
+def unmatched_faces(face_locations, matches):
+    """Faces of one photo that were not matched to any student."""
+    matched = {match[0] for match in matches}
+    return [
+        {'face_index': face_index, 'box': face_box(location)}
+        for face_index, location in enumerate(face_locations)
+        if face_index not in matched
+    ]
+
+
+def build_recognition_result(face_locations, matches, enrolled, timings=None):
+    """Response payload for one group photo, shared by the sync and async paths."""
+    identified_students = []
+    for face_index, student_index, distance, margin in matches:
+        student = enrolled.students[student_index]
+        identified_students.append({
+            'name': student['name'],
+            'id': student['id'],
+            'branch': student['branch'],
+            'batch': student['batch'],
+            'attendance_status': True,
+            'detection_count': 1,  # Each student is matched to at most one face per photo
+            'distance': round(distance, 4),
+            'margin': round(margin, 4) if margin is not None else None,
+            'face_index': face_index,
+            'box': face_box(face_locations[face_index])
+        })
+
+    return {
+        'success': True,
+        'total_faces_found': len(face_locations),
+        'students_identified': len(identified_students),
+        'total_enrolled_students': enrolled.total_enrolled,
+        'identified_students': identified_students,
+        'unmatched_faces': unmatched_faces(face_locations, matches),
+        'timings': timings or {}
+    }
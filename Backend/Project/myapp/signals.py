@@ -0,0 +1,97 @@
+from collections import defaultdict
+
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete
+from django.dispatch import Signal, receiver
+
+from .models import Attendance, Classes, Session, Students, Student_TSA_Enrollment, Student_Face_Encoding
+from .recognition import encoding_cache
+from .ann_index import refresh_students
+from .attendance_summary import apply_attendance_changes, discount_attendance
+
+
+# Sent after Attendance rows are created or corrected in bulk, which bypasses
+# post_save. `changes` is a list of (tsa_id, student_id, date, session_id,
+# old_status, new_status) tuples, with old_status None for created rows and
+# new_status None for deleted ones, so receivers can adjust cached
+# aggregates incrementally.
+attendance_written = Signal()
+
+
+@receiver(attendance_written)
+def summarize_written_attendance(sender, changes, **kwargs):
+    apply_attendance_changes(changes)
+
+
+@receiver(pre_save, sender=Attendance)
+def remember_saved_attendance(sender, instance, **kwargs):
+    instance._summary_previous = None
+    if instance.pk:
+        instance._summary_previous = Attendance.objects.filter(pk=instance.pk).values_list(
+            'TSA_ID', 'Student_ID', 'Date', 'Session_ID', 'Status'
+        ).first()
+
+
+@receiver(post_save, sender=Attendance)
+def summarize_saved_attendance(sender, instance, **kwargs):
+    current = (instance.TSA_ID_id, instance.Student_ID_id, instance.Date, instance.Session_ID_id)
+    previous = getattr(instance, '_summary_previous', None)
+    if previous is None:
+        changes = [current + (None, instance.Status)]
+    elif (previous[0], previous[1], str(previous[2]), previous[3]) == (int(current[0]), current[1], str(current[2]), current[3]):
+        changes = [current + (previous[4], instance.Status)]
+    else:
+        # The row moved to another TSA, student or lecture
+        changes = [previous[:4] + (previous[4], None), current + (None, instance.Status)]
+    apply_attendance_changes(changes)
+
+
+# Attendance has no delete receivers, so deleting a student, session or
+# class removes its rows with a single cascading DELETE. Their totals are
+# subtracted beforehand with grouped queries; deleting a TSA needs nothing
+# since its summaries cascade with it. Attendance.delete() and the admin
+# discount the rows they delete; after deleting rows directly through a
+# queryset (shell, scripts) run rebuild_attendance_summary.
+CASCADED_ATTENDANCE_FIELDS = {Students: 'Student_ID', Session: 'Session_ID', Classes: 'Class_ID'}
+
+
+@receiver(pre_delete, sender=Students)
+@receiver(pre_delete, sender=Session)
+@receiver(pre_delete, sender=Classes)
+def discount_cascaded_attendance(sender, instance, origin=None, **kwargs):
+    field = CASCADED_ATTENDANCE_FIELDS[sender]
+    rows = Attendance.objects.filter(**{field: instance.pk})
+    # One delete can reach a row through several parents (a branch takes its
+    # classes and its students), so skip rows already discounted by it
+    discounted = getattr(origin, '_discounted_attendance', None)
+    if discounted is None:
+        discounted = defaultdict(set)
+        if origin is not None:
+            origin._discounted_attendance = discounted
+    for other_field, pks in discounted.items():
+        rows = rows.exclude(**{f'{other_field}__in': pks})
+    discounted[field].add(instance.pk)
+    discount_attendance(rows)
+
+
+# Keep the packed per-TSA encoding matrices in sync with enrollment changes.
+# Bulk operations (bulk_create, queryset.update) do not send these signals;
+# those rely on the cache TTL instead.
+
+@receiver(post_save, sender=Student_TSA_Enrollment)
+@receiver(post_delete, sender=Student_TSA_Enrollment)
+def invalidate_enrollment_encodings(sender, instance, **kwargs):
+    encoding_cache.invalidate_tsa(instance.TSA_ID_id)
+    # The row may have moved the student away from a previously cached TSA
+    encoding_cache.invalidate_student(instance.Student_ID_id)
+
+
+@receiver(post_delete, sender=Students)
+def invalidate_student_encodings(sender, instance, **kwargs):
+    refresh_students([instance.Student_ID])
+    encoding_cache.invalidate_student(instance.Student_ID)
+
+
+@receiver(post_save, sender=Student_Face_Encoding)
+@receiver(post_delete, sender=Student_Face_Encoding)
+def invalidate_reference_encodings(sender, instance, **kwargs):
+    encoding_cache.invalidate_student(instance.Student_ID_id)
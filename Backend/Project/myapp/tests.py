@@ -1,3 +1,805 @@
-from django.test import TestCase
+"""
+Query-count and wall-time budgets for every API endpoint, plus unit tests
+for the face matching helpers.
 
-# Create your tests here.
+Each URL in myapp/urls.py is called against a seeded college (three
+branches, 300 students, four weeks of attendance) and must stay within the
+maximum number of SQL queries and seconds recorded for its URL name in
+myapp/query_budgets.json. When an endpoint legitimately changes, update its
+budget in the same commit. Face detection is stubbed with synthetic
+encodings of enrolled students, so the face endpoints are budgeted on their
+matched path without running dlib.
+"""
+import datetime
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from unittest import mock
+
+from django.contrib import admin
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.core.files.uploadedfile import SimpleUploadedFile
+import numpy as np
+from PIL import Image
+from rest_framework.test import APIClient
+
+from .admin import AttendanceAdmin
+from .ann_index import FaceIndex, build_index, match_open_roster, refresh_students, update_students
+from .attendance_summary import rebuild_attendance_summaries
+from .encoding_format import encoding_info, pack_encoding, unpack_encoding
+from .face_workers import DEFAULT_DETECTION_POLICY, FaceWorkerPool, choose_detection_scale, face_worker_pool, tile_boxes
+from .gallery import promote_confirmed
+from .jobs import requeue_stale_jobs, run_recognition_job
+from .recognition import assign_faces, encoding_cache, get_tsa_encodings
+from .urls import urlpatterns
+from .models import (
+    Attendance, Attendance_Summary, Branch, Classes, Face_Gallery_Candidate, Recognition_Job, RoomNum, Session, Students,
+    Students_Current_Class, Student_Face_Encoding, Student_TSA_Enrollment, Subjects, Teacher_Subject_Assignment,
+    Teachers, TimeSlots, TimeTables, TSA_Attendance_Summary, Users,
+)
+
+
+BUDGETS_FILE = Path(__file__).resolve().parent / 'query_budgets.json'
+BUDGETS = json.loads(BUDGETS_FILE.read_text())['endpoints']
+
+BRANCHES = ['CS', 'EC', 'ME']
+SECTIONS = ['A', 'B']
+STUDENTS_PER_CLASS = 50
+TSAS_PER_CLASS = 4
+WEEKS = 4
+LECTURE_DAYS = ['MONDAY', 'WEDNESDAY', 'FRIDAY']
+DAY_OFFSETS = {'MONDAY': 0, 'TUESDAY': 1, 'WEDNESDAY': 2, 'THURSDAY': 3, 'FRIDAY': 4, 'SATURDAY': 5}
+FIRST_MONDAY = datetime.date(2026, 9, 7)
+
+MEDIA_ROOT = tempfile.mkdtemp(prefix='myapp-tests-')
+
+
+# Reference encodings of the CS3A students, far apart from each other
+STUDENT_ENCODINGS = np.random.default_rng(0).normal(scale=0.1, size=(STUDENTS_PER_CLASS, 128))
+
+
+def blank_photo(name='photo.jpg'):
+    """A small JPEG; the stubbed detector decides which faces it shows."""
+    data = io.BytesIO()
+    Image.new('RGB', (320, 240), (120, 120, 120)).save(data, 'JPEG')
+    return SimpleUploadedFile(name, data.getvalue(), content_type='image/jpeg')
+
+
+def detected_faces(student_indexes, strangers=1):
+    """
+    What face_worker_pool.detect returns for a photo showing the given CS3A
+    students, slightly off their references, plus unenrolled strangers.
+    """
+    noise = np.random.default_rng(len(student_indexes))
+    encodings = [STUDENT_ENCODINGS[s] + noise.normal(scale=0.005, size=128) for s in student_indexes]
+    encodings += list(noise.normal(scale=0.1, size=(strangers, 128)))
+    locations = [(10, 40 * k + 30, 40, 40 * k) for k in range(len(encodings))]
+    return locations, encodings, {'detect': 0.0, 'encode': 0.0}
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class SeededCollegeTestCase(TestCase):
+    """Three branches of two classes each, with four weeks of attendance."""
+
+    @classmethod
+    def setUpTestData(cls):
+        TimeSlots.objects.bulk_create([
+            TimeSlots(TimeSlot_ID=f'T{slot}', Start_Time=datetime.time(9 + slot), End_Time=datetime.time(10 + slot))
+            for slot in range(TSAS_PER_CLASS)
+        ])
+        Session.objects.bulk_create([
+            Session(Session_ID=f'{day[:3]}{slot}', Day=day, TimeSlot_ID_id=f'T{slot}', ExtraClass=False)
+            for day in DAY_OFFSETS for slot in range(TSAS_PER_CLASS)
+        ])
+        RoomNum.objects.create(RoomNo='R101', Is_A='CLASSROOM')
+
+        attendance = []
+        timetable = []
+        for branch_id in BRANCHES:
+            branch = Branch.objects.create(Branch_ID=branch_id, Branch_Name=f'Branch {branch_id}')
+            teachers = Teachers.objects.bulk_create([
+                Teachers(
+                    Teacher_ID=f'{branch_id}T{t}', Teacher_Name=f'Teacher {branch_id}{t}', Initials=f'{branch_id}{t}',
+                    Branch_ID=branch, Teacher_Email=f'{branch_id.lower()}{t}@college.test'
+                )
+                for t in range(3)
+            ])
+            Subjects.objects.bulk_create([
+                Subjects(Scheme=2022, Semester=3, Subject_Code=f'{branch_id}30{k}', Subject_Name=f'{branch_id} subject {k}', Credits=4)
+                for k in range(TSAS_PER_CLASS)
+            ])
+
+            for section in SECTIONS:
+                class_id = f'{branch_id}3{section}'
+                Classes.objects.create(Class_ID=class_id, Branch_ID=branch, Semester=3, Section=section)
+                students = Students.objects.bulk_create([
+                    Students(
+                        Student_ID=f'{class_id}{s:03d}', Student_Name=f'Student {class_id}{s:03d}', Branch_ID=branch,
+                        Graduation_Batch=2028, Student_Email=f'{class_id.lower()}{s:03d}@college.test'
+                    )
+                    for s in range(STUDENTS_PER_CLASS)
+                ])
+                Students_Current_Class.objects.bulk_create([
+                    Students_Current_Class(Student_ID=student, Branch_ID=branch, Semester=3, Section=section, Class_ID=class_id)
+                    for student in students
+                ])
+
+                for k in range(TSAS_PER_CLASS):
+                    tsa = Teacher_Subject_Assignment.objects.create(
+                        Teacher_ID=teachers[k % len(teachers)], Subject_Code_id=f'{branch_id}30{k}', Semester=3,
+                        IsElective='NO', IsLab='NO', Class_ID_id=class_id, Teaching_Graduation_Batch=2028
+                    )
+                    Student_TSA_Enrollment.objects.bulk_create([
+                        Student_TSA_Enrollment(Student_ID=student, TSA_ID=tsa) for student in students
+                    ])
+                    for day in LECTURE_DAYS:
+                        session_id = f'{day[:3]}{k}'
+                        timetable.append(TimeTables(Session_ID_id=session_id, Class_ID_id=class_id, TSA_ID=tsa, RoomNo_id='R101'))
+                        for week in range(WEEKS):
+                            lecture_date = FIRST_MONDAY + datetime.timedelta(days=7 * week + DAY_OFFSETS[day])
+                            attendance.extend(
+                                Attendance(
+                                    Date=lecture_date, Day=day, Student_ID=student, Session_ID_id=session_id,
+                                    Class_ID_id=class_id, TSA_ID=tsa, Status=(s + week + k) % 5 != 0
+                                )
+                                for s, student in enumerate(students)
+                            )
+
+        TimeTables.objects.bulk_create(timetable)
+        Attendance.objects.bulk_create(attendance, batch_size=2000)
+        rebuild_attendance_summaries()
+
+        students = list(Students.objects.filter(Student_ID__startswith='CS3A').order_by('Student_ID'))
+        for student, encoding in zip(students, STUDENT_ENCODINGS):
+            student.face_encoding = pack_encoding(encoding)
+            student.face_encoding_status = 'OK'
+        Students.objects.bulk_update(students, ['face_encoding', 'face_encoding_status'])
+
+        Users.objects.bulk_create([
+            Users(User_ID='CS3A000', Password='student-pass', Role='STUDENT'),
+            Users(User_ID='CST1', Password='teacher-pass', Role='TEACHER'),
+            Users(User_ID='CST0', Password='hod-pass', Role='HOD'),
+        ])
+
+        cls.tsa = Teacher_Subject_Assignment.objects.filter(Class_ID='CS3A').order_by('TSA_ID').first()
+        cls.job = Recognition_Job.objects.create(TSA_ID=cls.tsa, Status='DONE', Progress=100, Result={'students': []})
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+
+
+    def summaries(self):
+        # A rebuild skips emptied rows that incremental upkeep leaves at zero
+        return (
+            sorted(Attendance_Summary.objects.exclude(Total_Sessions=0, Present_Count=0).values_list(
+                'TSA_ID', 'Student_ID', 'Total_Sessions', 'Present_Count'
+            )),
+            sorted(TSA_Attendance_Summary.objects.exclude(Total_Sessions=0, Total_Records=0, Present_Count=0).values_list(
+                'TSA_ID', 'Total_Sessions', 'Total_Records', 'Present_Count'
+            )),
+        )
+
+    def assertSummariesRebuilt(self):
+        """The incrementally kept summaries equal a rebuild from Attendance."""
+        kept = self.summaries()
+        rebuild_attendance_summaries()
+        self.assertEqual(kept, self.summaries())
+
+
+class EndpointBudgetTests(SeededCollegeTestCase):
+
+    # 30 of the 50 CS3A students are in the photos, as well as one stranger
+    PRESENT = range(30)
+
+    def setUp(self):
+        self.client = APIClient()
+        # Every endpoint pays for its own encoding lookups
+        encoding_cache.clear()
+        # Matched faces are kept as gallery candidates, so budget that too
+        for patcher in (
+            mock.patch.object(face_worker_pool, 'detect', return_value=detected_faces(self.PRESENT)),
+            mock.patch('myapp.gallery.FACE_GALLERY_ENABLED', True),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def assertWithinBudget(self, name, method, path, expected_status, **kwargs):
+        """Call an endpoint and check its status, query count and wall time against its budget."""
+        budget = BUDGETS[name]
+        started = time.perf_counter()
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(path, **kwargs)
+        elapsed = time.perf_counter() - started
+
+        self.assertEqual(response.status_code, expected_status, f'{name}: {getattr(response, "data", response.content)}')
+        self.assertLessEqual(
+            len(queries), budget['queries'],
+            f"{name} ran {len(queries)} queries, budget is {budget['queries']}:\n"
+            + '\n'.join(query['sql'] for query in queries.captured_queries)
+        )
+        self.assertLessEqual(
+            elapsed, budget['seconds'],
+            f"{name} took {elapsed:.3f}s, budget is {budget['seconds']}s"
+        )
+        return response
+
+    def test_every_url_has_a_budget(self):
+        names = {pattern.name for pattern in urlpatterns}
+        self.assertEqual(sorted(names - set(BUDGETS)), [], 'URLs without a budget in query_budgets.json')
+        self.assertEqual(sorted(set(BUDGETS) - names), [], 'Budgets for URLs that no longer exist')
+        for name in BUDGETS:
+            self.assertTrue(hasattr(self, f'test_{name}'), f'No budget test calls {name}')
+
+    # Face recognition
+
+    def test_group_photo_api(self):
+        response = self.assertWithinBudget(
+            'group_photo_api', 'post', reverse('group_photo_api'), 200,
+            data={'tsa_id': self.tsa.TSA_ID, 'image': blank_photo()}, format='multipart'
+        )
+        self.assertEqual(response.data['students_identified'], len(self.PRESENT))
+        self.assertEqual(len(response.data['unmatched_faces']), 1)
+        self.assertEqual(Face_Gallery_Candidate.objects.count(), len(self.PRESENT))
+
+    def test_group_photo_api_cache_hit(self):
+        get_tsa_encodings(self.tsa.TSA_ID)
+        # Only the gallery candidates are written and trimmed; the roster comes from the cache
+        with self.assertNumQueries(3):
+            response = self.client.post(
+                reverse('group_photo_api'), data={'tsa_id': self.tsa.TSA_ID, 'image': blank_photo()}, format='multipart'
+            )
+        self.assertEqual(response.data['students_identified'], len(self.PRESENT))
+
+    def test_group_photo_batch_api(self):
+        response = self.assertWithinBudget(
+            'group_photo_batch_api', 'post', reverse('group_photo_batch_api'), 200,
+            data={'tsa_id': self.tsa.TSA_ID, 'images': [blank_photo('a.jpg'), blank_photo('b.jpg')]}, format='multipart'
+        )
+        self.assertEqual(response.data['students_identified'], len(self.PRESENT))
+        self.assertEqual(response.data['identified_students'][0]['photos'], [0, 1])
+
+    def test_group_photo_attendance_api(self):
+        response = self.assertWithinBudget(
+            'group_photo_attendance_api', 'post', reverse('group_photo_attendance_api'), 201,
+            data={'TSA_ID': self.tsa.TSA_ID, 'Date': '2026-10-05', 'Session_ID': 'MON0', 'images': [blank_photo()]},
+            format='multipart'
+        )
+        self.assertEqual(response.data['total_students'], STUDENTS_PER_CLASS)
+        self.assertEqual(response.data['present_count'], len(self.PRESENT))
+        # Recognized faces wait for a teacher to confirm them
+        self.assertEqual(Face_Gallery_Candidate.objects.count(), len(self.PRESENT))
+        self.assertFalse(Student_Face_Encoding.objects.filter(Source='GALLERY').exists())
+
+    def test_recognition_job_status(self):
+        self.assertWithinBudget(
+            'recognition_job_status', 'get', reverse('recognition_job_status', kwargs={'job_id': self.job.Job_ID}), 200
+        )
+
+    # Logins
+
+    def test_student_login(self):
+        self.assertWithinBudget(
+            'student_login', 'post', reverse('student_login'), 200,
+            data={'email': 'CS3A000', 'password': 'student-pass'}, format='json'
+        )
+
+    def test_teacher_login(self):
+        self.assertWithinBudget(
+            'teacher_login', 'post', reverse('teacher_login'), 200,
+            data={'email': 'CST1', 'password': 'teacher-pass'}, format='json'
+        )
+
+    def test_hod_login(self):
+        self.assertWithinBudget(
+            'hod_login', 'post', reverse('hod_login'), 200,
+            data={'email': 'CST0', 'password': 'hod-pass'}, format='json'
+        )
+
+    # Dashboards
+
+    def test_get_student_info(self):
+        response = self.assertWithinBudget(
+            'get_student_info', 'get', reverse('get_student_info', kwargs={'student_id': 'CS3A001'}), 200
+        )
+        self.assertEqual(len(response.data['Enrolled_Subjects']), TSAS_PER_CLASS)
+
+    def test_get_teacher_info(self):
+        self.assertWithinBudget('get_teacher_info', 'get', reverse('get_teacher_info', kwargs={'teacher_id': 'CST1'}), 200)
+
+    def test_get_teacher_schedule(self):
+        self.assertWithinBudget(
+            'get_teacher_schedule', 'get', reverse('get_teacher_schedule', kwargs={'teacher_id': 'CST0'}), 200
+        )
+
+    def test_get_teacher_analytics(self):
+        self.assertWithinBudget(
+            'get_teacher_analytics', 'get', reverse('get_teacher_analytics', kwargs={'teacher_id': 'CST0'}), 200
+        )
+
+    def test_get_teacher_attendance_register(self):
+        self.assertWithinBudget(
+            'get_teacher_attendance_register', 'get',
+            reverse('get_teacher_attendance_register', kwargs={'teacher_id': self.tsa.Teacher_ID_id, 'tsa_id': self.tsa.TSA_ID}),
+            200
+        )
+
+    def test_get_tsa_students(self):
+        self.assertWithinBudget('get_tsa_students', 'get', reverse('get_tsa_students', kwargs={'tsa_id': self.tsa.TSA_ID}), 200)
+
+    def test_get_hod_info(self):
+        self.assertWithinBudget('get_hod_info', 'get', reverse('get_hod_info', kwargs={'teacher_id': 'CST0'}), 200)
+
+    def test_get_department_analytics(self):
+        self.assertWithinBudget(
+            'get_department_analytics', 'get', reverse('get_department_analytics', kwargs={'teacher_id': 'CST0'}), 200
+        )
+
+    def test_get_department_tsa_analytics(self):
+        self.assertWithinBudget(
+            'get_department_tsa_analytics', 'get', reverse('get_department_tsa_analytics', kwargs={'teacher_id': 'CST0'}), 200
+        )
+
+    # Attendance writes
+
+    def test_mark_attendance(self):
+        students = Student_TSA_Enrollment.objects.filter(TSA_ID=self.tsa).values_list('Student_ID', flat=True)
+        self.assertWithinBudget(
+            'mark_attendance', 'post', reverse('mark_attendance'), 201,
+            data={
+                'Date': '2026-10-05', 'Day': 'MONDAY', 'Session_ID': 'MON0', 'Class_ID': 'CS3A', 'TSA_ID': self.tsa.TSA_ID,
+                'attendance_data': [{'student_id': student_id, 'status': True} for student_id in students],
+            },
+            format='json'
+        )
+
+    def test_correct_attendance(self):
+        students = Student_TSA_Enrollment.objects.filter(TSA_ID=self.tsa).values_list('Student_ID', flat=True)[:10]
+        self.assertWithinBudget(
+            'correct_attendance', 'patch',
+            reverse('correct_attendance', kwargs={'date': FIRST_MONDAY.isoformat(), 'session_id': 'MON0'}), 200,
+            data={'changes': [{'student_id': student_id, 'status': False} for student_id in students]},
+            format='json'
+        )
+
+    def test_correct_attendance_confirms_gallery_candidates(self):
+        absent = Attendance.objects.filter(
+            TSA_ID=self.tsa, Date=FIRST_MONDAY, Session_ID='MON0', Status=False
+        ).values_list('Student_ID', flat=True).first()
+        Face_Gallery_Candidate.objects.create(
+            TSA_ID=self.tsa, Student_ID_id=absent, Encoding=pack_encoding(np.zeros(128)), Distance=0.3
+        )
+        with mock.patch('myapp.gallery.refresh_students'):
+            self.client.patch(
+                reverse('correct_attendance', kwargs={'date': FIRST_MONDAY.isoformat(), 'session_id': 'MON0'}),
+                data={'changes': [{'student_id': absent, 'status': True}]}, format='json'
+            )
+        self.assertTrue(Student_Face_Encoding.objects.filter(Student_ID=absent, Source='GALLERY').exists())
+        self.assertFalse(Face_Gallery_Candidate.objects.filter(Student_ID=absent).exists())
+
+
+class MarkAttendanceTests(SeededCollegeTestCase):
+
+    def setUp(self):
+        self.client = APIClient()
+        # Idempotency keys live in the cache, which outlives each test's transaction
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.students = list(Student_TSA_Enrollment.objects.filter(TSA_ID=self.tsa).values_list('Student_ID', flat=True))
+
+    def post(self, date, tsa, status, upsert=False, **extra):
+        return self.client.post(reverse('mark_attendance'), {
+            'Date': date.isoformat(), 'Day': 'MONDAY', 'Session_ID': 'MON0', 'Class_ID': 'CS3A', 'TSA_ID': tsa.TSA_ID,
+            'attendance_data': [{'student_id': student_id, 'status': status} for student_id in self.students],
+            'upsert': upsert,
+        }, format='json', **extra)
+
+    def lecture(self, date):
+        return Attendance.objects.filter(Date=date, Session_ID='MON0', Student_ID__in=self.students)
+
+    def test_resending_a_lecture_needs_upsert(self):
+        response = self.post(FIRST_MONDAY, self.tsa, False)
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue(self.lecture(FIRST_MONDAY).filter(Status=True).exists())
+
+    def test_upsert_overwrites_existing_rows(self):
+        response = self.post(FIRST_MONDAY, self.tsa, False, upsert=True)
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(self.lecture(FIRST_MONDAY).count(), len(self.students))
+        self.assertFalse(self.lecture(FIRST_MONDAY).filter(Status=True).exists())
+        self.assertSummariesRebuilt()
+
+    def test_upsert_moving_rows_to_another_tsa(self):
+        other = Teacher_Subject_Assignment.objects.filter(Class_ID='CS3A').exclude(TSA_ID=self.tsa.TSA_ID).first()
+        response = self.post(FIRST_MONDAY, other, True, upsert=True)
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(set(self.lecture(FIRST_MONDAY).values_list('TSA_ID', flat=True)), {other.TSA_ID})
+        self.assertSummariesRebuilt()
+
+    def test_replaying_an_idempotency_key(self):
+        next_monday = FIRST_MONDAY + datetime.timedelta(weeks=WEEKS)
+        first = self.post(next_monday, self.tsa, True, HTTP_IDEMPOTENCY_KEY='roster-1')
+        self.assertEqual(first.status_code, 201, first.data)
+
+        with CaptureQueriesContext(connection) as queries:
+            replay = self.post(next_monday, self.tsa, True, HTTP_IDEMPOTENCY_KEY='roster-1')
+        self.assertEqual(replay.status_code, 201)
+        self.assertEqual(replay.data, first.data)
+        self.assertEqual(replay['Idempotent-Replay'], 'true')
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(self.lecture(next_monday).count(), len(self.students))
+
+    def test_idempotency_key_reused_for_another_payload(self):
+        next_monday = FIRST_MONDAY + datetime.timedelta(weeks=WEEKS)
+        self.assertEqual(self.post(next_monday, self.tsa, True, HTTP_IDEMPOTENCY_KEY='roster-1').status_code, 201)
+
+        response = self.post(next_monday, self.tsa, False, upsert=True, HTTP_IDEMPOTENCY_KEY='roster-1')
+        self.assertEqual(response.status_code, 422)
+        self.assertFalse(self.lecture(next_monday).filter(Status=False).exists())
+
+
+class RecognitionJobTests(SeededCollegeTestCase):
+
+    PRESENT = range(20)
+
+    def setUp(self):
+        self.client = APIClient()
+        encoding_cache.clear()
+        patcher = mock.patch.object(face_worker_pool, 'detect', return_value=detected_faces(self.PRESENT))
+        self.detect = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def enqueue(self):
+        """Upload a photo in async mode without letting the thread pool pick it up."""
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            response = self.client.post(
+                reverse('group_photo_api'),
+                data={'tsa_id': self.tsa.TSA_ID, 'image': blank_photo(), 'async': 'true'}, format='multipart'
+            )
+        self.assertEqual(response.status_code, 202, response.data)
+        self.assertEqual(len(callbacks), 1)
+        return Recognition_Job.objects.get(Job_ID=response.data['job_id'])
+
+    def poll(self, job):
+        response = self.client.get(reverse('recognition_job_status', args=[job.Job_ID]))
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_async_upload_is_processed_by_the_command(self):
+        job = self.enqueue()
+        self.assertEqual(job.Status, 'PENDING')
+        self.assertTrue(os.path.exists(job.Image.path))
+        self.assertEqual(self.poll(job)['status'], 'PENDING')
+
+        out = io.StringIO()
+        call_command('process_recognition_jobs', '--once', stdout=out)
+        self.assertIn('Processed 1 job(s)', out.getvalue())
+
+        image_path = job.Image.path
+        job.refresh_from_db()
+        self.assertEqual((job.Status, job.Progress, job.Error), ('DONE', 100, None))
+        self.assertEqual(job.Result['students_identified'], len(self.PRESENT))
+        self.assertEqual(len(job.Result['unmatched_faces']), 1)
+        # The photo is dropped once the job has run
+        self.assertFalse(job.Image)
+        self.assertFalse(os.path.exists(image_path))
+
+        polled = self.poll(job)
+        self.assertEqual(polled['status'], 'DONE')
+        self.assertEqual(polled['result'], job.Result)
+
+    def test_photo_without_faces_fails_the_job(self):
+        self.detect.return_value = ([], [], {})
+        job = self.enqueue()
+
+        self.assertTrue(run_recognition_job(job.Job_ID))
+        job.refresh_from_db()
+        self.assertEqual(job.Status, 'FAILED')
+        self.assertIn('No faces found', job.Error)
+        self.assertIsNone(job.Result)
+        self.assertEqual(self.poll(job)['error'], job.Error)
+
+    def test_a_job_runs_once(self):
+        job = self.enqueue()
+        self.assertTrue(run_recognition_job(job.Job_ID))
+        self.assertFalse(run_recognition_job(job.Job_ID))
+        self.assertEqual(self.detect.call_count, 1)
+
+    def test_abandoned_running_job_is_requeued(self):
+        job = self.enqueue()
+        Recognition_Job.objects.filter(Job_ID=job.Job_ID).update(
+            Status='RUNNING', Updated_At=job.Updated_At - datetime.timedelta(hours=1)
+        )
+        self.assertEqual(requeue_stale_jobs(), 1)
+
+        call_command('process_recognition_jobs', '--once', stdout=io.StringIO())
+        job.refresh_from_db()
+        self.assertEqual(job.Status, 'DONE')
+
+
+class GalleryCandidateTests(SeededCollegeTestCase):
+
+    PRESENT = range(10)
+
+    def setUp(self):
+        self.client = APIClient()
+        for patcher in (
+            mock.patch.object(face_worker_pool, 'detect', return_value=detected_faces(self.PRESENT)),
+            mock.patch('myapp.gallery.FACE_GALLERY_ENABLED', True),
+            mock.patch('myapp.gallery.FACE_GALLERY_MAX_CANDIDATES', 2),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def upload(self):
+        response = self.client.post(
+            reverse('group_photo_api'), data={'tsa_id': self.tsa.TSA_ID, 'image': blank_photo()}, format='multipart'
+        )
+        self.assertEqual(response.status_code, 200, response.data)
+
+    def expired_candidate(self, student_id):
+        candidate = Face_Gallery_Candidate.objects.create(
+            TSA_ID=self.tsa, Student_ID_id=student_id, Encoding=pack_encoding(np.zeros(128)), Distance=0.1
+        )
+        Face_Gallery_Candidate.objects.filter(pk=candidate.pk).update(
+            Created_At=candidate.Created_At - datetime.timedelta(days=1)
+        )
+        return candidate
+
+    def test_each_student_keeps_a_few_candidates(self):
+        for _ in range(4):
+            self.upload()
+        per_student = Face_Gallery_Candidate.objects.values_list('Student_ID', flat=True)
+        self.assertEqual(len(per_student), 2 * len(self.PRESENT))
+        self.assertEqual(len(set(per_student)), len(self.PRESENT))
+
+    def test_recording_drops_expired_candidates(self):
+        expired = self.expired_candidate('CS3A049')
+        self.upload()
+        self.assertFalse(Face_Gallery_Candidate.objects.filter(pk=expired.pk).exists())
+        self.assertEqual(Face_Gallery_Candidate.objects.count(), len(self.PRESENT))
+
+    def test_promoting_drops_expired_candidates(self):
+        expired = self.expired_candidate('CS3A049')
+        self.assertEqual(promote_confirmed(self.tsa.TSA_ID, ['CS3A000']), 0)
+        self.assertFalse(Face_Gallery_Candidate.objects.filter(pk=expired.pk).exists())
+
+
+class AttendanceSummaryDeleteTests(SeededCollegeTestCase):
+
+    def test_deleting_a_student_is_set_based(self):
+        with CaptureQueriesContext(connection) as queries:
+            Students.objects.get(Student_ID='CS3A001').delete()
+        # Independent of the student's number of attendance rows
+        self.assertLessEqual(len(queries), 40)
+        self.assertSummariesRebuilt()
+
+    def test_deleting_the_only_rows_of_a_lecture(self):
+        Attendance.objects.filter(TSA_ID=self.tsa, Date=FIRST_MONDAY, Session_ID='MON0').exclude(
+            Student_ID='CS3A002'
+        ).delete()
+        rebuild_attendance_summaries()
+        Students.objects.filter(Student_ID='CS3A002').delete()
+        self.assertSummariesRebuilt()
+
+    def test_deleting_a_session(self):
+        Session.objects.filter(Session_ID='WED1').delete()
+        self.assertSummariesRebuilt()
+
+    def test_rows_reached_through_several_parents_count_once(self):
+        # Keep the branch's TSAs alive so their summaries must be discounted
+        Teacher_Subject_Assignment.objects.filter(Class_ID__Branch_ID='ME').update(Teacher_ID='CST1')
+        Branch.objects.filter(Branch_ID='ME').delete()
+        self.assertSummariesRebuilt()
+
+    def test_deleting_an_attendance_row(self):
+        Attendance.objects.filter(TSA_ID=self.tsa, Student_ID='CS3A004').first().delete()
+        self.assertSummariesRebuilt()
+
+    def test_deleting_the_last_row_of_a_lecture(self):
+        rows = Attendance.objects.filter(TSA_ID=self.tsa, Date=FIRST_MONDAY, Session_ID='MON0')
+        AttendanceAdmin(Attendance, admin.site).delete_queryset(None, rows.exclude(Student_ID='CS3A005'))
+        rows.get().delete()
+        self.assertSummariesRebuilt()
+
+    def test_admin_bulk_delete(self):
+        rows = Attendance.objects.filter(TSA_ID=self.tsa, Date=FIRST_MONDAY)
+        AttendanceAdmin(Attendance, admin.site).delete_queryset(None, rows)
+        self.assertSummariesRebuilt()
+
+
+class AssignFacesTests(SimpleTestCase):
+
+    def test_faces_competing_for_one_student(self):
+        # Both faces are nearest to student 0; face 1 is closer and wins it,
+        # so face 0 falls back to student 1, which is not its nearest match.
+        distances = np.array([
+            [0.30, 0.45],
+            [0.20, 0.50],
+        ])
+        matches = assign_faces(distances, tolerance=0.6)
+
+        self.assertEqual([(face, student) for face, student, _, _ in matches], [(1, 0), (0, 1)])
+        face, student, distance, margin = matches[1]
+        self.assertAlmostEqual(distance, 0.45)
+        self.assertEqual(margin, 0.0)
+        self.assertAlmostEqual(matches[0][3], 0.30)
+
+    def test_margin_against_runner_up(self):
+        matches = assign_faces(np.array([[0.25, 0.40, 0.55]]), tolerance=0.6)
+        self.assertEqual(len(matches), 1)
+        self.assertAlmostEqual(matches[0][3], 0.15)
+
+    def test_single_student_has_no_margin(self):
+        self.assertEqual(assign_faces(np.array([[0.3]]), tolerance=0.6), [(0, 0, 0.3, None)])
+
+
+class ChooseDetectionScaleTests(SimpleTestCase):
+
+    def smallest_face_px(self, shape):
+        scale, upsample = choose_detection_scale(shape)
+        return DEFAULT_DETECTION_POLICY['MIN_FACE_FRACTION'] * max(shape[:2]) * scale * 2 ** upsample
+
+    def test_large_photo_is_downscaled_without_upsampling(self):
+        scale, upsample = choose_detection_scale((4000, 6000, 3))
+        self.assertLess(scale, 1.0)
+        self.assertEqual(upsample, 0)
+        self.assertAlmostEqual(self.smallest_face_px((4000, 6000, 3)), DEFAULT_DETECTION_POLICY['TARGET_FACE_PX'])
+
+    def test_faces_are_not_shrunk_below_target_for_the_pixel_cap(self):
+        # Honouring MAX_PIXELS would leave this square photo's back-row faces
+        # at ~69px; it is shrunk only to TARGET_FACE_PX, without upsampling
+        scale, upsample = choose_detection_scale((5000, 5000, 3))
+        self.assertAlmostEqual(scale, 0.8)
+        self.assertEqual(upsample, 0)
+        self.assertAlmostEqual(self.smallest_face_px((5000, 5000, 3)), DEFAULT_DETECTION_POLICY['TARGET_FACE_PX'])
+
+    def test_small_photo_is_upsampled_within_the_pixel_cap(self):
+        scale, upsample = choose_detection_scale((600, 800, 3))
+        self.assertEqual((scale, upsample), (1.0, 1))
+
+
+class FaceTilingTests(SimpleTestCase):
+
+    def test_tiles_of_a_12_mp_photo(self):
+        tiles = tile_boxes((3000, 4000), tile_size=1600, overlap=256)
+        self.assertEqual(len(tiles), 9)
+
+        covered = np.zeros((3000, 4000), dtype=np.int8)
+        for top, left, bottom, right in tiles:
+            self.assertLessEqual(bottom - top, 1600)
+            self.assertLessEqual(right - left, 1600)
+            covered[top:bottom, left:right] += 1
+        self.assertTrue(covered.all())
+        # Neighbours overlap by the configured amount, not most of a tile
+        lefts = sorted({left for _, left, _, _ in tiles})
+        rights = sorted({right for _, _, _, right in tiles})
+        self.assertEqual([rights[k] - lefts[k + 1] for k in range(len(lefts) - 1)], [256, 256])
+
+    def test_small_pools_detect_in_one_pass(self):
+        shape = (4000, 5000, 3)
+        self.assertFalse(FaceWorkerPool(2, 2, 0).plan_detection(shape)[2])
+        self.assertTrue(FaceWorkerPool(4, 4, 0).plan_detection(shape)[2])
+        # A 12 MP phone photo is searched in one pass even on a large pool
+        self.assertFalse(FaceWorkerPool(4, 4, 0).plan_detection((3000, 4000, 3))[2])
+
+
+class FaceIndexTests(TestCase):
+
+    ENCODINGS = np.random.default_rng(1).normal(scale=0.1, size=(8, 128))
+
+    @classmethod
+    def setUpTestData(cls):
+        for branch_id in ('CS', 'EC'):
+            Branch.objects.create(Branch_ID=branch_id, Branch_Name=f'Branch {branch_id}')
+        Students.objects.bulk_create([
+            Students(
+                Student_ID=f'S{k}', Student_Name=f'Student {k}', Branch_ID_id='CS' if k < 4 else 'EC',
+                Graduation_Batch=2028, Student_Email=f's{k}@college.test',
+                face_encoding=pack_encoding(encoding), face_encoding_status='OK'
+            )
+            for k, encoding in enumerate(cls.ENCODINGS)
+        ])
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='myapp-face-index-')
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        for patcher in (
+            mock.patch('myapp.ann_index.FACE_INDEX_DIR', self.directory),
+            mock.patch('myapp.ann_index.face_index', FaceIndex(self.directory)),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        build_index(self.directory, nlist=2)
+
+    def identify(self, encoding, branch=None):
+        matches, enrolled = match_open_roster([encoding + 0.005], branch=branch)
+        return [enrolled.students[student]['id'] for _, student, _, _ in matches]
+
+    def test_open_roster_finds_the_student(self):
+        self.assertEqual(self.identify(self.ENCODINGS[5]), ['S5'])
+        self.assertEqual(self.identify(self.ENCODINGS[5], branch='EC'), ['S5'])
+        self.assertEqual(self.identify(self.ENCODINGS[5], branch='CS'), [])
+
+    def test_delta_replaces_the_rows_of_a_student(self):
+        new_encoding = np.random.default_rng(2).normal(scale=0.1, size=128)
+        Students.objects.filter(Student_ID='S2').update(face_encoding=pack_encoding(new_encoding))
+        update_students(['S2'], self.directory)
+
+        self.assertEqual(self.identify(new_encoding), ['S2'])
+        self.assertEqual(self.identify(self.ENCODINGS[2]), [])
+        self.assertEqual(self.identify(self.ENCODINGS[3]), ['S3'])
+
+    def test_failed_update_is_retried(self):
+        new_encoding = np.random.default_rng(3).normal(scale=0.1, size=128)
+        Students.objects.filter(Student_ID='S1').update(face_encoding=pack_encoding(new_encoding))
+        with mock.patch('myapp.ann_index.update_students', side_effect=OSError('disk full')), \
+                mock.patch('builtins.print'):
+            refresh_students(['S1'])
+        self.assertEqual(self.identify(new_encoding), [])
+
+        # The next update of any student also writes the stale one
+        refresh_students(['S6'])
+        self.assertEqual(self.identify(new_encoding), ['S1'])
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'stale_students.txt')))
+
+
+class EncodingFormatTests(SimpleTestCase):
+
+    VECTOR = np.random.default_rng(4).normal(scale=0.1, size=128)
+
+    def test_round_trip(self):
+        for dtype, tolerance in (('float64', 0), ('float32', 1e-7), ('float16', 1e-3)):
+            data = pack_encoding(self.VECTOR, dtype=dtype, normalize=False)
+            self.assertEqual(data[:3], b'FE\x01')
+            self.assertEqual(encoding_info(data)['dtype'], dtype)
+            np.testing.assert_allclose(unpack_encoding(data, normalize=False), self.VECTOR, atol=tolerance)
+
+    def test_normalized_flag(self):
+        data = pack_encoding(self.VECTOR, dtype='float64', normalize=True)
+        self.assertTrue(encoding_info(data)['normalized'])
+        self.assertAlmostEqual(np.linalg.norm(unpack_encoding(data, normalize=False)), 1.0)
+
+    def test_legacy_blob(self):
+        data = self.VECTOR.tobytes()
+        self.assertEqual(encoding_info(data)['version'], 0)
+        np.testing.assert_array_equal(unpack_encoding(data, normalize=False), self.VECTOR)
+
+    def test_unreadable_data(self):
+        data = pack_encoding(self.VECTOR)
+        self.assertIsNone(encoding_info(b'XX' + data[2:]))
+        self.assertIsNone(unpack_encoding(b'XX' + data[2:]))
+        self.assertIsNone(encoding_info(data[:-1]))
+        self.assertIsNone(encoding_info(self.VECTOR.tobytes()[:-8]))
+
+
+class ConvertFaceEncodingsTests(TestCase):
+
+    def test_legacy_rows_are_converted(self):
+        branch = Branch.objects.create(Branch_ID='CS', Branch_Name='Computer Science')
+        vector = np.random.default_rng(5).normal(scale=0.1, size=128)
+        Students.objects.bulk_create([
+            Students(
+                Student_ID=student_id, Student_Name=student_id, Branch_ID=branch, Graduation_Batch=2028,
+                Student_Email=f'{student_id.lower()}@college.test', face_encoding=data
+            )
+            for student_id, data in (('LEGACY', vector.tobytes()), ('CURRENT', pack_encoding(vector)), ('BROKEN', b'FE\x09'))
+        ])
+
+        call_command('convert_face_encodings', dtype='float32', stdout=io.StringIO())
+
+        stored = dict(Students.objects.values_list('Student_ID', 'face_encoding'))
+        self.assertEqual(encoding_info(stored['LEGACY'])['dtype'], 'float32')
+        np.testing.assert_allclose(unpack_encoding(stored['LEGACY'], normalize=False), vector, atol=1e-7)
+        self.assertEqual(bytes(stored['CURRENT']), pack_encoding(vector))
+        self.assertEqual(bytes(stored['BROKEN']), b'FE\x09')
@@ -0,0 +1,65 @@
+"""
+Decoding of uploaded group photos.
+
+Uploads are decoded straight from Django's in-memory or spooled upload
+buffer into a NumPy array, without writing them to MEDIA_ROOT first.
+Decoded frames can optionally be archived for audit on a background thread.
+"""
+import io
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import PIL.Image
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.utils import timezone
+
+
+GROUP_PHOTO_ARCHIVE = getattr(settings, 'GROUP_PHOTO_ARCHIVE', False)
+GROUP_PHOTO_ARCHIVE_DIR = getattr(settings, 'GROUP_PHOTO_ARCHIVE_DIR', 'group_photo_archive')
+
+_archive_executor = None
+_archive_lock = threading.Lock()
+
+
+def decode_upload(uploaded_file):
+    """Decode an uploaded image file into an RGB NumPy array."""
+    uploaded_file.seek(0)
+    with PIL.Image.open(uploaded_file) as image:
+        return np.asarray(image.convert('RGB'))
+
+
+def _get_archive_executor():
+    global _archive_executor
+    with _archive_lock:
+        if _archive_executor is None:
+            _archive_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='photo-archive')
+        return _archive_executor
+
+
+def _write_archive(image, name):
+    buffer = io.BytesIO()
+    PIL.Image.fromarray(image).save(buffer, format='JPEG', quality=90)
+    default_storage.save(name, ContentFile(buffer.getvalue()))
+
+
+def archive_frame(image, tsa_id):
+    """
+    Queue a decoded frame to be written under GROUP_PHOTO_ARCHIVE_DIR when
+    archiving is enabled. Never blocks the request on disk I/O.
+    """
+    if not GROUP_PHOTO_ARCHIVE:
+        return None
+    name = f'{GROUP_PHOTO_ARCHIVE_DIR}/{timezone.localdate():%Y-%m-%d}/{tsa_id}_{uuid.uuid4().hex}.jpg'
+    future = _get_archive_executor().submit(_write_archive, image, name)
+    future.add_done_callback(_report_archive_error)
+    return name
+
+
+def _report_archive_error(future):
+    error = future.exception()
+    if error is not None:
+        print(f"ERROR archiving group photo: {str(error)}")
@@ -4,6 +4,9 @@ from . import views
 urlpatterns = [
    
     path('api/group-photo/', views.GroupPhotoRecognitionAPI.as_view(), name='group_photo_api'),
+    path('api/group-photo/batch/', views.GroupPhotoBatchRecognitionAPI.as_view(), name='group_photo_batch_api'),
+    path('api/group-photo/attendance/', views.GroupPhotoAttendanceAPI.as_view(), name='group_photo_attendance_api'),
+    path('api/group-photo/jobs/<uuid:job_id>/', views.get_recognition_job, name='recognition_job_status'),
     
     # Login endpoints
     path('api/student/login/', views.student_login, name='student_login'),
@@ -18,6 +21,7 @@ urlpatterns = [
     path('api/teacher-attendance/<str:teacher_id>/<int:tsa_id>/', views.get_teacher_attendance_register, name='get_teacher_attendance_register'),
     path('api/tsa-students/<int:tsa_id>/', views.get_tsa_students, name='get_tsa_students'),
     path('api/mark-attendance/', views.mark_attendance, name='mark_attendance'),
+    path('api/attendance/<str:date>/<str:session_id>/', views.correct_attendance, name='correct_attendance'),
     
     
     # HOD information endpoints
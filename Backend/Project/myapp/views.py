@@ -1,22 +1,133 @@
 from django.shortcuts import render
 
 # Create your views here.
-from django.core.files.storage import default_storage
-from django.core.files.base import ContentFile
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-import face_recognition
-import numpy as np
-import os
+import datetime
+import hashlib
+import json
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from django.conf import settings
+from django.core.cache import cache
+from django.urls import reverse
 
 from rest_framework.decorators import api_view
-from django.db.models import Count, Q
-from .models import Students,Classes, Students_Current_Class, Student_TSA_Enrollment, Teacher_Subject_Assignment, Subjects, Teachers, Attendance, Users, TimeTables, Session
+from django.db import IntegrityError, transaction
+from django.db.models import BooleanField, Case, Count, Exists, F, OuterRef, Q, Sum, Value, When, Window
+from django.db.models.functions import DenseRank
+from .models import Students, Students_Current_Class, Student_TSA_Enrollment, Teacher_Subject_Assignment, Subjects, Teachers, Attendance, Users, TimeTables, Recognition_Job, Attendance_Summary, TSA_Attendance_Summary
+from .recognition import (
+    get_tsa_encodings, match_faces, merge_photo_matches, build_recognition_result, face_box, unmatched_faces,
+)
+from .jobs import enqueue_recognition_job
+from .gallery import record_candidates, promote_confirmed
+from .ann_index import match_open_roster
+from .signals import attendance_written
+from .uploads import decode_upload, archive_frame
+from .face_workers import face_worker_pool, WorkerPoolBusy
 
 
-#Here we are getting Avereage Attendance of each Subject at run time , later we will store that in separate table and fetch from there.
+FACE_BATCH_MAX_IMAGES = getattr(settings, 'FACE_BATCH_MAX_IMAGES', 10)
+FACE_BATCH_MAX_WORKERS = getattr(settings, 'FACE_BATCH_MAX_WORKERS', 4)
+ATTENDANCE_IDEMPOTENCY_TTL = getattr(settings, 'ATTENDANCE_IDEMPOTENCY_TTL', 24 * 60 * 60)
+
+def _detect_faces_in_upload(uploaded_file, tsa_id):
+    """Decode an uploaded photo and return its face locations, encodings and timings."""
+    image = decode_upload(uploaded_file)
+    archive_frame(image, tsa_id)
+    # Detection and encoding run on the worker pool, not in this thread
+    return face_worker_pool.detect(image)
+
+
+def _recognize_photos(uploaded_files, tsa_id):
+    """
+    Detect faces in several photos concurrently and match each against the
+    TSA's enrolled students. Returns (enrolled, photos, photo_matches,
+    photo_locations) where photos holds the per-photo summary of the response.
+    """
+    workers = max(1, min(FACE_BATCH_MAX_WORKERS, len(uploaded_files)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_detect_faces_in_upload, f, tsa_id) for f in uploaded_files]
+
+        # Fetch the enrolled encodings while the photos are processed
+        enrolled = get_tsa_encodings(tsa_id)
+
+        photos = []
+        photo_matches = []
+        photo_locations = []
+        for index, (uploaded_file, future) in enumerate(zip(uploaded_files, futures)):
+            photo = {'index': index, 'name': uploaded_file.name}
+            try:
+                face_locations, face_encodings, timings = future.result()
+            except WorkerPoolBusy:
+                raise
+            except Exception as e:
+                photo['error'] = f'Error processing image: {str(e)}'
+                photo_matches.append([])
+                photo_locations.append([])
+                photos.append(photo)
+                continue
+
+            matches = match_faces(face_encodings, enrolled)
+            record_candidates(tsa_id, matches, face_encodings, enrolled)
+            photo['faces_found'] = len(face_locations)
+            photo['students_identified'] = len(matches)
+            photo['unmatched_faces'] = unmatched_faces(face_locations, matches)
+            photo['timings'] = timings
+            photo_matches.append(matches)
+            photo_locations.append(face_locations)
+            photos.append(photo)
+
+    return enrolled, photos, photo_matches, photo_locations
+
+
+def _write_attendance(attendance_list, upsert=False):
+    """
+    Insert attendance rows in one transaction, or with upsert overwrite the
+    rows that already exist for (Date, Session_ID, Student_ID), and report
+    what changed through attendance_written so the summaries follow.
+    """
+    with transaction.atomic():
+        previous = {}
+        if upsert:
+            lectures = {}
+            for row in attendance_list:
+                lectures.setdefault((str(row.Date), row.Session_ID_id), []).append(row.Student_ID_id)
+            condition = Q()
+            for (date, session_id), student_ids in lectures.items():
+                condition |= Q(Date=date, Session_ID=session_id, Student_ID__in=student_ids)
+            previous = {
+                (str(date), session_id, student_id): (tsa_id, old_status)
+                for date, session_id, student_id, tsa_id, old_status in Attendance.objects.select_for_update().filter(
+                    condition
+                ).values_list('Date', 'Session_ID', 'Student_ID', 'TSA_ID', 'Status')
+            }
+            # INSERT ... ON CONFLICT (Date, Session_ID, Student_ID) DO UPDATE
+            Attendance.objects.bulk_create(
+                attendance_list,
+                update_conflicts=True,
+                unique_fields=['Date', 'Session_ID', 'Student_ID'],
+                update_fields=['Day', 'Class_ID', 'TSA_ID', 'Status'],
+            )
+        else:
+            Attendance.objects.bulk_create(attendance_list)
+
+        changes = []
+        for row in attendance_list:
+            key = (row.Student_ID_id, row.Date, row.Session_ID_id)
+            old = previous.get((str(row.Date), row.Session_ID_id, row.Student_ID_id))
+            if old is None:
+                changes.append((row.TSA_ID_id,) + key + (None, row.Status))
+            elif old[0] == int(row.TSA_ID_id):
+                changes.append((row.TSA_ID_id,) + key + (old[1], row.Status))
+            else:
+                # The upsert moved the row to another TSA
+                changes.append((old[0],) + key + (old[1], None))
+                changes.append((row.TSA_ID_id,) + key + (None, row.Status))
+        attendance_written.send(sender=Attendance, changes=changes)
+
 
 class GroupPhotoRecognitionAPI(APIView):
     def post(self, request):
@@ -28,6 +139,17 @@ class GroupPhotoRecognitionAPI(APIView):
                     status=status.HTTP_400_BAD_REQUEST
                 )
             
+            # Open roster: identify against a whole branch or the college
+            # through the face index instead of one TSA's enrollment
+            roster = request.data.get('roster', 'tsa')
+            if roster in ('branch', 'college'):
+                return self._recognize_open_roster(request, roster)
+            if roster != 'tsa':
+                return Response(
+                    {'error': "roster must be 'tsa', 'branch' or 'college'"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
             if 'tsa_id' not in request.data:
                 return Response(
                     {'error': 'No TSA ID provided'}, 
@@ -40,91 +162,320 @@ class GroupPhotoRecognitionAPI(APIView):
             # Get the uploaded file
             uploaded_file = request.FILES['image']
             
-            # Save the file temporarily with a unique name
-            temp_filename = f'temp/group_photo_{uploaded_file.name}'
-            file_path = default_storage.save(temp_filename, ContentFile(uploaded_file.read()))
-            full_path = os.path.join(settings.MEDIA_ROOT, file_path)
-            
-            try:
-                # Load the image
-                group_image = face_recognition.load_image_file(full_path)
-                
-                # Find all face locations in the image
-                face_locations = face_recognition.face_locations(group_image)
-                
-                if not face_locations:
-                    return Response(
-                        {'error': 'No faces found in the image'}, 
-                        status=status.HTTP_400_BAD_REQUEST
-                    )
-                
-                # Get face encodings for all faces in the image
-                face_encodings = face_recognition.face_encodings(group_image, face_locations)
-                
-                # Get students enrolled in the specific TSA
-                from .models import Student_TSA_Enrollment
-                enrolled_students = Student_TSA_Enrollment.objects.filter(
-                    TSA_ID=tsa_id
-                ).select_related('Student_ID')
-                
-                # Dictionary to store identified students (using student ID as key to ensure uniqueness)
-                identified_students_dict = {}
-                
-                # Compare each face in the group photo with enrolled students' encodings
-                for face_encoding in face_encodings:
-                    for enrollment in enrolled_students:
-                        student = enrollment.Student_ID
-                        if student.face_encoding:  # Check if student has face encoding
-                            # Convert binary face encoding back to numpy array
-                            student_encoding = np.frombuffer(student.face_encoding, dtype=np.float64)
-                            
-                            # Compare faces
-                            matches = face_recognition.compare_faces([student_encoding], face_encoding, tolerance=0.6)
-                            
-                            if matches[0]:
-                                # Use student ID as key to ensure uniqueness
-                                student_id = student.Student_ID
-                                if student_id not in identified_students_dict:
-                                    identified_students_dict[student_id] = {
-                                        'name': student.Student_Name,
-                                        'id': student_id,
-                                        'branch': student.Branch_ID.Branch_ID,
-                                        'batch': student.Graduation_Batch,
-                                        'attendance_status': True,  # You can modify this based on your requirements
-                                        'detection_count': 1  # Count how many times this student was detected
-                                    }
-                                else:
-                                    # Increment detection count if student was already identified
-                                    identified_students_dict[student_id]['detection_count'] += 1
-                                break  # Found a match for this face, move to next face
-                
-                # Convert dictionary to list for response
-                identified_students = list(identified_students_dict.values())
-                
-              
-                
+            # In async mode, queue the photo and let the client poll the job
+            if str(request.data.get('async', '')).lower() in ('1', 'true', 'yes'):
+                job = enqueue_recognition_job(tsa_id, uploaded_file)
                 return Response({
                     'success': True,
-         
-                    'total_faces_found': len(face_locations),
-                    'students_identified': len(identified_students),
-                    'total_enrolled_students': enrolled_students.count(),
-                    'identified_students': identified_students
-                }, status=status.HTTP_200_OK)
-                
-            finally:
-                # Clean up the temporary file
-                try:
-                    default_storage.delete(file_path)
-                except:
-                    pass
+                    'job_id': str(job.Job_ID),
+                    'status': job.Status,
+                    'status_url': request.build_absolute_uri(
+                        reverse('recognition_job_status', args=[job.Job_ID])
+                    )
+                }, status=status.HTTP_202_ACCEPTED)
+            
+            # Find and encode all faces in the image
+            face_locations, face_encodings, timings = _detect_faces_in_upload(uploaded_file, tsa_id)
+            
+            if not face_locations:
+                return Response(
+                    {'error': 'No faces found in the image'}, 
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            
+            # Pack the encodings of students enrolled in the specific TSA
+            enrolled = get_tsa_encodings(tsa_id)
+            
+            # Compare all faces with all enrolled students in one pass,
+            # assigning each face to at most one student and vice versa
+            matches = match_faces(face_encodings, enrolled)
+            record_candidates(tsa_id, matches, face_encodings, enrolled)
+            
+            return Response(
+                build_recognition_result(face_locations, matches, enrolled, timings),
+                status=status.HTTP_200_OK
+            )
                     
+        except WorkerPoolBusy as e:
+            return Response(
+                {'error': str(e)},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE
+            )
         except Exception as e:
             return Response(
                 {'error': f'Error processing image: {str(e)}'}, 
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+    def _recognize_open_roster(self, request, roster):
+        """Match a group photo against every student of a branch (branch_id) or the college."""
+        branch_id = None
+        if roster == 'branch':
+            branch_id = request.data.get('branch_id')
+            if not branch_id:
+                return Response(
+                    {'error': 'No branch ID provided'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+        face_locations, face_encodings, timings = _detect_faces_in_upload(
+            request.FILES['image'], f'branch-{branch_id}' if branch_id else 'college'
+        )
+        if not face_locations:
+            return Response(
+                {'error': 'No faces found in the image'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            matches, candidates = match_open_roster(face_encodings, branch=branch_id)
+        except FileNotFoundError as e:
+            return Response({'error': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        result = build_recognition_result(face_locations, matches, candidates, timings)
+        result['roster'] = roster
+        return Response(result, status=status.HTTP_200_OK)
+
+
+class GroupPhotoBatchRecognitionAPI(APIView):
+    """
+    Recognize students across several photos of one class in a single request.
+
+    Expected multipart data:
+        tsa_id: TSA ID
+        images: one or more image files
+
+    Photos are decoded and searched for faces concurrently, matched against
+    the enrolled students of the TSA, and merged into one roster with the best
+    distance and runner-up margin of each student and the photos and face
+    boxes they were seen in. Faces no student matched are listed per photo.
+    """
+    def post(self, request):
+        try:
+            uploaded_files = request.FILES.getlist('images')
+            if not uploaded_files:
+                return Response(
+                    {'error': 'No image files provided'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            if len(uploaded_files) > FACE_BATCH_MAX_IMAGES:
+                return Response(
+                    {'error': f'At most {FACE_BATCH_MAX_IMAGES} images can be processed per request'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            if 'tsa_id' not in request.data:
+                return Response(
+                    {'error': 'No TSA ID provided'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            tsa_id = request.data['tsa_id']
+
+            enrolled, photos, photo_matches, photo_locations = _recognize_photos(uploaded_files, tsa_id)
+            roster = merge_photo_matches(photo_matches)
+
+            identified_students = []
+            for student_index, entry in roster.items():
+                student = enrolled.students[student_index]
+                identified_students.append({
+                    'name': student['name'],
+                    'id': student['id'],
+                    'branch': student['branch'],
+                    'batch': student['batch'],
+                    'attendance_status': True,
+                    'detection_count': len(entry['photos']),
+                    'best_distance': round(entry['best_distance'], 4),
+                    'best_margin': round(entry['best_margin'], 4) if entry['best_margin'] is not None else None,
+                    'photos': entry['photos'],
+                    'detections': [
+                        {'photo': photo_index, 'face_index': face_index, 'box': face_box(photo_locations[photo_index][face_index])}
+                        for photo_index, face_index in zip(entry['photos'], entry['faces'])
+                    ]
+                })
+            identified_students.sort(key=lambda x: x['best_distance'])
+
+            return Response({
+                'success': True,
+                'total_images': len(uploaded_files),
+                'total_faces_found': sum(photo.get('faces_found', 0) for photo in photos),
+                'students_identified': len(identified_students),
+                'total_enrolled_students': enrolled.total_enrolled,
+                'photos': photos,
+                'identified_students': identified_students
+            }, status=status.HTTP_200_OK)
+
+        except WorkerPoolBusy as e:
+            return Response(
+                {'error': str(e)},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE
+            )
+        except Exception as e:
+            return Response(
+                {'error': f'Error processing images: {str(e)}'},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+class GroupPhotoAttendanceAPI(APIView):
+    """
+    Recognize students in the photos of one lecture and commit the register.
+
+    Expected multipart data:
+        images: one or more image files (or a single 'image')
+        Date: YYYY-MM-DD
+        Session_ID: session the lecture was held in
+        TSA_ID: TSA ID
+        Day: optional, derived from Date when missing
+        Class_ID: optional, defaults to the TSA's class
+        upsert: optional, overwrite an existing register of the session
+
+    Every enrolled student gets an Attendance row, present if recognized in
+    any photo, all written in one transaction. Returns the committed register.
+    """
+    def post(self, request):
+        try:
+            uploaded_files = request.FILES.getlist('images') or request.FILES.getlist('image')
+            if not uploaded_files:
+                return Response(
+                    {'error': 'No image files provided'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            if len(uploaded_files) > FACE_BATCH_MAX_IMAGES:
+                return Response(
+                    {'error': f'At most {FACE_BATCH_MAX_IMAGES} images can be processed per request'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            missing = [field for field in ('Date', 'Session_ID', 'TSA_ID') if not request.data.get(field)]
+            if missing:
+                return Response(
+                    {'error': f"Missing fields: {', '.join(missing)}"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            tsa_id = request.data['TSA_ID']
+            session_id = request.data['Session_ID']
+            attendance_date = datetime.date.fromisoformat(request.data['Date'])
+            day = request.data.get('Day') or attendance_date.strftime('%A').upper()
+
+            tsa = Teacher_Subject_Assignment.objects.filter(TSA_ID=tsa_id).values('Class_ID').first()
+            if tsa is None:
+                return Response({'error': 'TSA not found'}, status=status.HTTP_404_NOT_FOUND)
+            class_id = request.data.get('Class_ID') or tsa['Class_ID']
+
+            enrolled, photos, photo_matches, photo_locations = _recognize_photos(uploaded_files, tsa_id)
+            roster = merge_photo_matches(photo_matches)
+            present = {enrolled.students[student_index]['id']: entry for student_index, entry in roster.items()}
+
+            register = list(Student_TSA_Enrollment.objects.filter(TSA_ID=tsa_id).values_list(
+                'Student_ID', 'Student_ID__Student_Name', 'Student_ID__students_current_class__Class_ID'
+            ).order_by('Student_ID'))
+
+            attendance_list = []
+            for student_id, student_name, current_class_id in register:
+                # Electives have no TSA class; fall back to the student's own class
+                row_class_id = class_id or current_class_id
+                if not row_class_id:
+                    return Response(
+                        {'error': f'No Class_ID for student {student_id}'},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+                attendance_list.append(Attendance(
+                    Date=attendance_date,
+                    Day=day,
+                    Student_ID_id=student_id,
+                    Session_ID_id=session_id,
+                    Class_ID_id=row_class_id,
+                    TSA_ID_id=tsa_id,
+                    Status=student_id in present
+                ))
+
+            upsert = str(request.data.get('upsert', '')).lower() in ('1', 'true', 'yes')
+            try:
+                _write_attendance(attendance_list, upsert)
+            except IntegrityError:
+                return Response(
+                    {'error': 'Attendance for this session has already been marked; resend with upsert to overwrite it'},
+                    status=status.HTTP_409_CONFLICT
+                )
+
+            # Matches are only candidates here; they join the gallery once a
+            # teacher confirms the student through mark_attendance or
+            # correct_attendance
+            attendance = []
+            for student_id, student_name, _ in register:
+                entry = present.get(student_id)
+                attendance.append({
+                    'student_id': student_id,
+                    'student_name': student_name,
+                    'status': entry is not None,
+                    'distance': round(entry['best_distance'], 4) if entry else None,
+                    'margin': round(entry['best_margin'], 4) if entry and entry['best_margin'] is not None else None,
+                    'photos': entry['photos'] if entry else []
+                })
+
+            return Response({
+                'success': True,
+                'date': str(attendance_date),
+                'day': day,
+                'session_id': session_id,
+                'tsa_id': int(tsa_id),
+                'class_id': class_id,
+                'total_students': len(attendance),
+                'present_count': len([row for row in attendance if row['status']]),
+                'absent_count': len([row for row in attendance if not row['status']]),
+                'photos': photos,
+                'attendance': attendance
+            }, status=status.HTTP_201_CREATED)
+
+        except WorkerPoolBusy as e:
+            return Response(
+                {'error': str(e)},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE
+            )
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            return Response(
+                {'error': f'Error processing images: {str(e)}'},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+
+@api_view(['GET'])
+def get_recognition_job(request, job_id):
+    """
+    Poll an asynchronous group photo recognition job.
+
+    Once the job is DONE, 'result' holds the same payload the synchronous
+    /api/group-photo/ endpoint returns.
+    """
+    try:
+        job = Recognition_Job.objects.get(Job_ID=job_id)
+
+        response_data = {
+            'job_id': str(job.Job_ID),
+            'tsa_id': job.TSA_ID_id,
+            'status': job.Status,
+            'progress': job.Progress,
+            'created_at': job.Created_At,
+            'updated_at': job.Updated_At,
+        }
+        if job.Status == 'DONE':
+            response_data['result'] = job.Result
+        elif job.Status == 'FAILED':
+            response_data['error'] = job.Error
+
+        return Response(response_data, status=200)
+
+    except Recognition_Job.DoesNotExist:
+        return Response({"error": "Recognition job not found"}, status=404)
+    except Exception as e:
+        return Response({"error": str(e)}, status=500)
+
+
 @api_view(['POST'])
 def student_login(request):
     try:
@@ -246,7 +597,7 @@ def hod_login(request):
 def get_student_info(request, student_id):
     try:
         # Fetch student basic details
-        student = Students.objects.get(Student_ID=student_id)
+        student = Students.objects.select_related('Branch_ID').get(Student_ID=student_id)
         student_class = Students_Current_Class.objects.get(Student_ID=student)
 
         # Fix the image URL to use the media URL path
@@ -274,45 +625,45 @@ def get_student_info(request, student_id):
             }
         }
 
-        # Fetch subjects the student has enrolled in
-        tsa_enrollments = Student_TSA_Enrollment.objects.filter(Student_ID=student)
-        enrolled_subjects = []
+        # Fetch subjects the student has enrolled in, with their subject and teacher
+        tsa_enrollments = Student_TSA_Enrollment.objects.filter(Student_ID=student).select_related(
+            'TSA_ID__Subject_Code', 'TSA_ID__Teacher_ID'
+        )
+        tsa_list = [enrollment.TSA_ID for enrollment in tsa_enrollments]
+
+        # Student and class attendance for every subject in one grouped query
+        # over the precomputed summaries. Class figures only count students
+        # enrolled in that TSA.
+        enrolled_in_tsa = Student_TSA_Enrollment.objects.filter(
+            TSA_ID=OuterRef('TSA_ID'),
+            Student_ID=OuterRef('Student_ID')
+        )
+        attendance_counts = {
+            row['TSA_ID']: row
+            for row in Attendance_Summary.objects.filter(
+                TSA_ID__in=[tsa.TSA_ID for tsa in tsa_list]
+            ).filter(Exists(enrolled_in_tsa)).values('TSA_ID').annotate(
+                total_classes=Sum('Total_Sessions', filter=Q(Student_ID=student.Student_ID)),
+                classes_attended=Sum('Present_Count', filter=Q(Student_ID=student.Student_ID)),
+                total_attendance_records=Sum('Total_Sessions'),
+                total_present_records=Sum('Present_Count')
+            )
+        }
 
-        for enrollment in tsa_enrollments:
-            tsa = enrollment.TSA_ID
+        enrolled_subjects = []
+        for tsa in tsa_list:
             subject = tsa.Subject_Code
             teacher = tsa.Teacher_ID
+            counts = attendance_counts.get(tsa.TSA_ID, {})
 
             # Student's attendance in this subject
-            total_classes = Attendance.objects.filter(
-                TSA_ID=tsa,
-                Student_ID=student,
-            ).count()
-
-            classes_attended = Attendance.objects.filter(
-                TSA_ID=tsa,
-                Student_ID=student,
-                Status=True
-            ).count()
-
+            total_classes = counts.get('total_classes') or 0
+            classes_attended = counts.get('classes_attended') or 0
             attendance_percentage = (classes_attended / total_classes * 100) if total_classes > 0 else 0
 
             # Class average attendance for this subject
-            students_in_tsa = Student_TSA_Enrollment.objects.filter(
-                TSA_ID=tsa
-            ).values_list('Student_ID', flat=True)
-
-            total_attendance_records = Attendance.objects.filter(
-                TSA_ID=tsa,
-                Student_ID__in=students_in_tsa
-            ).count()
-
-            total_present_records = Attendance.objects.filter(
-                TSA_ID=tsa,
-                Student_ID__in=students_in_tsa,
-                Status=True
-            ).count()
-
+            total_attendance_records = counts.get('total_attendance_records') or 0
+            total_present_records = counts.get('total_present_records') or 0
             average_class_attendance = (total_present_records / total_attendance_records * 100) if total_attendance_records > 0 else 0
 
             enrolled_subjects.append({
@@ -368,52 +719,60 @@ def get_teacher_info(request, teacher_id):
 @api_view(['GET'])
 def get_teacher_schedule(request, teacher_id):
     try:
-        # First get all TSA IDs for this teacher
-        teacher_tsas = Teacher_Subject_Assignment.objects.filter(Teacher_ID=teacher_id)
-        tsa_ids = [tsa.TSA_ID for tsa in teacher_tsas]
-        
-        # Get timetable entries for these TSAs
-        timetable_entries = TimeTables.objects.filter(TSA_ID__in=tsa_ids).select_related(
+        # Get timetable entries for this teacher's TSAs
+        timetable_entries = list(TimeTables.objects.filter(TSA_ID__Teacher_ID=teacher_id).select_related(
             'Session_ID',
             'Session_ID__TimeSlot_ID',
             'Class_ID',
             'TSA_ID',
             'TSA_ID__Subject_Code',
             'RoomNo'
-        )
-        
+        ))
+        tsa_ids = {entry.TSA_ID_id for entry in timetable_entries}
+
+        # Enrollment counts per TSA, shared by all of a TSA's slots
+        student_counts = dict(Student_TSA_Enrollment.objects.filter(TSA_ID__in=tsa_ids).values('TSA_ID').annotate(
+            students=Count('pk')
+        ).values_list('TSA_ID', 'students'))
+
+        # Unique classes and present count per (TSA, Session) in one grouped query
+        teacher_attendance = Attendance.objects.filter(TSA_ID__in=tsa_ids)
+        session_stats = {
+            (row['TSA_ID'], row['Session_ID']): row
+            for row in teacher_attendance.values('TSA_ID', 'Session_ID').annotate(
+                total_classes=Count('Date', distinct=True),
+                present_count=Count('id', filter=Q(Status=True))
+            )
+        }
+
+        # Recent attendance trend (last 5 classes of every session) in one
+        # query: rank each session's dates with a window, keep the 5 newest
+        recent_rows = teacher_attendance.annotate(
+            recency=Window(DenseRank(), partition_by=[F('TSA_ID'), F('Session_ID')], order_by=F('Date').desc())
+        ).filter(recency__lte=5).values('id')
+        recent_trends = {}
+        for record in Attendance.objects.filter(id__in=recent_rows).values('TSA_ID', 'Session_ID', 'Date').annotate(
+            present_count=Count('id', filter=Q(Status=True)),
+            total_count=Count('id')
+        ).order_by('TSA_ID', 'Session_ID', '-Date'):
+            recent_trends.setdefault((record['TSA_ID'], record['Session_ID']), []).append({
+                'date': str(record['Date']),
+                'attendance_percentage': round((record['present_count'] / record['total_count'] * 100), 2) if record['total_count'] > 0 else 0
+            })
+
         schedule = []
         for entry in timetable_entries:
-            # Get all students enrolled in this TSA
-            enrolled_students = Student_TSA_Enrollment.objects.filter(TSA_ID=entry.TSA_ID)
-            total_students = enrolled_students.count()
-            
-            # Get attendance records for this specific session
-            session_attendance = Attendance.objects.filter(
-                TSA_ID=entry.TSA_ID,
-                Session_ID=entry.Session_ID
-            )
-            
-            # Count unique classes for this session
-            total_classes = session_attendance.values('Date').distinct().count()
-            
+            key = (entry.TSA_ID_id, entry.Session_ID_id)
+            stats = session_stats.get(key, {})
+            total_students = student_counts.get(entry.TSA_ID_id, 0)
+            total_classes = stats.get('total_classes', 0)
+
             # Calculate attendance statistics
-            present_count = session_attendance.filter(Status=True).count()
+            present_count = stats.get('present_count', 0)
             total_possible_attendance = total_classes * total_students
             attendance_percentage = (present_count / total_possible_attendance * 100) if total_possible_attendance > 0 else 0
-            
-            # Get recent attendance trend (last 5 classes)
-            recent_attendance = session_attendance.values('Date').annotate(
-                present_count=Count('id', filter=Q(Status=True)),
-                total_count=Count('id')
-            ).order_by('-Date')[:5]
-            
-            recent_trend = []
-            for record in recent_attendance:
-                recent_trend.append({
-                    'date': str(record['Date']),
-                    'attendance_percentage': round((record['present_count'] / record['total_count'] * 100), 2) if record['total_count'] > 0 else 0
-                })
+
+            recent_trend = recent_trends.get(key, [])
             
             schedule_entry = {
                 
@@ -473,42 +832,49 @@ def get_tsa_students(request, tsa_id):
 def get_teacher_analytics(request, teacher_id):
     try:
         # Get all TSA IDs for this teacher
-        teacher_tsas = Teacher_Subject_Assignment.objects.filter(Teacher_ID=teacher_id)
-        
+        teacher_tsas = list(Teacher_Subject_Assignment.objects.filter(Teacher_ID=teacher_id).select_related('Subject_Code'))
+        tsa_ids = [tsa.TSA_ID for tsa in teacher_tsas]
+
+        # Precomputed attendance totals, enrollment counts and timetable
+        # sessions for all of the teacher's TSAs at once
+        summaries = TSA_Attendance_Summary.objects.in_bulk(tsa_ids)
+        student_counts = dict(Student_TSA_Enrollment.objects.filter(TSA_ID__in=tsa_ids).values('TSA_ID').annotate(
+            students=Count('pk')
+        ).values_list('TSA_ID', 'students'))
+        tsa_session_ids = {}
+        for tsa_id, session_id in TimeTables.objects.filter(TSA_ID__in=tsa_ids).values_list('TSA_ID', 'Session_ID'):
+            tsa_session_ids.setdefault(tsa_id, []).append(session_id)
+
         analytics = []
         for tsa in teacher_tsas:
-            # Get all students enrolled in this TSA
-            enrolled_students = Student_TSA_Enrollment.objects.filter(TSA_ID=tsa)
-            total_students = enrolled_students.count()
-            
-            # Get attendance records for this TSA
-            attendance_records = Attendance.objects.filter(TSA_ID=tsa)
-            
-            # Count unique classes (unique Date and Session_ID combinations)
-            total_classes = attendance_records.values('Date', 'Session_ID').distinct().count()
-            
+            summary = summaries.get(tsa.TSA_ID)
+            total_students = student_counts.get(tsa.TSA_ID, 0)
+
+            # Unique classes are distinct (Date, Session_ID) combinations
+            total_classes = summary.Total_Sessions if summary else 0
+            total_records = summary.Total_Records if summary else 0
+
             # Calculate attendance statistics
-            present_count = attendance_records.filter(Status=True).count()
+            present_count = summary.Present_Count if summary else 0
             attendance_percentage = (present_count / (total_classes * total_students) * 100) if total_classes > 0 and total_students > 0 else 0
-            
+
             # Get subject details
             subject = tsa.Subject_Code
-            session_ids = TimeTables.objects.filter(TSA_ID=tsa).values_list('Session_ID__Session_ID', flat=True)
             analytics_entry = {
                 'TSA_ID': tsa.TSA_ID,
                 'Subject_Code': subject.Subject_Code,
                 'Subject_Name': subject.Subject_Name,
                 'Is_Lab': tsa.IsLab,
                 'Is_Elective': tsa.IsElective,
-                'Class_ID': tsa.Class_ID.Class_ID if tsa.Class_ID else None,
+                'Class_ID': tsa.Class_ID_id,
                 'Statistics': {
                     'Total_Students': total_students,
                     'Total_Classes': total_classes,
-                    'Total_Attendance_Records': attendance_records.count(),
+                    'Total_Attendance_Records': total_records,
                     'Present_Count': present_count,
                     'Attendance_Percentage': round(attendance_percentage, 2)
                 },
-                'Session_IDs': list(session_ids)
+                'Session_IDs': tsa_session_ids.get(tsa.TSA_ID, [])
             }
             analytics.append(analytics_entry)
         
@@ -538,36 +904,162 @@ def mark_attendance(request):
                 "status": true/false
             },
             ...
-        ]
+        ],
+        "upsert": true/false (optional)
     }
+
+    With "upsert", rows that already exist for (Date, Session_ID, Student_ID)
+    are updated in the same statement instead of failing, so corrections can
+    resend the roster. An Idempotency-Key header (or "idempotency_key") makes
+    retries of one submission replay the stored response without touching
+    the database.
     """
     try:
         data = request.data
-        
-        # Fetch foreign key objects
-        session_obj = Session.objects.get(pk=data['Session_ID'])
-        class_obj = Classes.objects.get(pk=data['Class_ID'])
-        tsa_obj = Teacher_Subject_Assignment.objects.get(pk=data['TSA_ID'])
 
-        attendance_list = []
+        cache_key = None
+        idempotency_key = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
+        if idempotency_key:
+            cache_key = f'mark-attendance:{idempotency_key}'
+            fingerprint = hashlib.sha256(json.dumps(
+                {key: value for key, value in data.items() if key != 'idempotency_key'},
+                sort_keys=True, default=str
+            ).encode()).hexdigest()
+            replay = cache.get(cache_key)
+            if replay is not None:
+                if replay['fingerprint'] != fingerprint:
+                    return Response(
+                        {"error": "Idempotency key was already used for a different submission."},
+                        status=status.HTTP_422_UNPROCESSABLE_ENTITY
+                    )
+                return Response(replay['body'], status=replay['status'], headers={'Idempotent-Replay': 'true'})
+
+        attendance_data = data['attendance_data']
+        student_ids = [item['student_id'] for item in attendance_data]
 
-        for item in data['attendance_data']:
-            student_obj = Students.objects.get(pk=item['student_id'])
+        # Validate every student against the TSA enrollment in one query
+        enrolled_ids = set(Student_TSA_Enrollment.objects.filter(
+            TSA_ID=data['TSA_ID'], Student_ID__in=student_ids
+        ).values_list('Student_ID', flat=True))
+        not_enrolled = [student_id for student_id in student_ids if student_id not in enrolled_ids]
+        if not_enrolled:
+            return Response(
+                {"error": "Students not enrolled in this TSA.", "student_ids": not_enrolled},
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
-            attendance = Attendance(
+        # Build rows from raw foreign keys; the database checks Session and Class
+        attendance_list = [
+            Attendance(
                 Date=data['Date'],
                 Day=data['Day'],
-                Student_ID=student_obj,
-                Session_ID=session_obj,
-                Class_ID=class_obj,
-                TSA_ID=tsa_obj,
+                Student_ID_id=item['student_id'],
+                Session_ID_id=data['Session_ID'],
+                Class_ID_id=data['Class_ID'],
+                TSA_ID_id=data['TSA_ID'],
                 Status=item['status']
             )
-            attendance_list.append(attendance)
+            for item in attendance_data
+        ]
+
+        upsert = str(data.get('upsert', '')).lower() in ('1', 'true', 'yes')
+        _write_attendance(attendance_list, upsert)
+
+        # Confirmed matches from recent group photos feed the students' galleries
+        try:
+            promote_confirmed(data['TSA_ID'], [item['student_id'] for item in attendance_data if item['status']])
+        except Exception as e:
+            print(f"ERROR updating face gallery for TSA {data['TSA_ID']}: {str(e)}")
+
+        response_data = {"message": "Attendance marked successfully.", "records": len(attendance_list), "upsert": upsert}
+        if cache_key:
+            cache.set(cache_key, {
+                'fingerprint': fingerprint,
+                'status': status.HTTP_201_CREATED,
+                'body': response_data,
+            }, ATTENDANCE_IDEMPOTENCY_TTL)
+        return Response(response_data, status=status.HTTP_201_CREATED)
+
+    except Exception as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+@api_view(['PATCH'])
+def correct_attendance(request, date, session_id):
+    """
+    Correct individual statuses in the register of one session.
+
+    Expected request data:
+    {
+        "changes": [
+            {
+                "student_id": "STUDENT_ID",
+                "status": true/false
+            },
+            ...
+        ]
+    }
 
-        Attendance.objects.bulk_create(attendance_list)
+    Only rows whose status actually changes are written, with a single
+    UPDATE. Returns the changed rows.
+    """
+    try:
+        attendance_date = datetime.date.fromisoformat(date)
+        changes = {item['student_id']: bool(item['status']) for item in request.data['changes']}
+        if not changes:
+            return Response({"error": "No changes provided."}, status=status.HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic():
+            current = list(Attendance.objects.select_for_update().filter(
+                Date=attendance_date, Session_ID=session_id, Student_ID__in=list(changes)
+            ).values_list('pk', 'Student_ID', 'TSA_ID', 'Status'))
+
+            missing = set(changes) - {student_id for _, student_id, _, _ in current}
+            if missing:
+                return Response(
+                    {"error": "No attendance record for these students in this session.", "student_ids": sorted(missing)},
+                    status=status.HTTP_404_NOT_FOUND
+                )
+
+            changed = [
+                (pk, student_id, tsa_id, old_status, changes[student_id])
+                for pk, student_id, tsa_id, old_status in current
+                if old_status != changes[student_id]
+            ]
+            if changed:
+                present = [pk for pk, _, _, _, new_status in changed if new_status]
+                Attendance.objects.filter(pk__in=[pk for pk, _, _, _, _ in changed]).update(
+                    Status=Case(When(pk__in=present, then=Value(True)), default=Value(False), output_field=BooleanField())
+                )
+                attendance_written.send(sender=Attendance, changes=[
+                    (tsa_id, student_id, attendance_date, session_id, old_status, new_status)
+                    for _, student_id, tsa_id, old_status, new_status in changed
+                ])
 
-        return Response({"message": "Attendance marked successfully."}, status=status.HTTP_201_CREATED)
+        # Students a teacher corrects to present confirm their recent matches
+        confirmed = defaultdict(list)
+        for _, student_id, tsa_id, _, new_status in changed:
+            if new_status:
+                confirmed[tsa_id].append(student_id)
+        for tsa_id, student_ids in confirmed.items():
+            try:
+                promote_confirmed(tsa_id, student_ids)
+            except Exception as e:
+                print(f"ERROR updating face gallery for TSA {tsa_id}: {str(e)}")
+
+        return Response({
+            "date": str(attendance_date),
+            "session_id": session_id,
+            "changed": [
+                {
+                    "student_id": student_id,
+                    "tsa_id": tsa_id,
+                    "status": new_status,
+                    "previous_status": old_status
+                }
+                for _, student_id, tsa_id, old_status, new_status in changed
+            ],
+            "unchanged": len(current) - len(changed)
+        }, status=status.HTTP_200_OK)
 
     except Exception as e:
         return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
@@ -576,13 +1068,20 @@ def mark_attendance(request):
 def get_teacher_attendance_register(request, teacher_id, tsa_id):
     try:
         # Verify that the TSA belongs to the teacher
-        tsa = Teacher_Subject_Assignment.objects.get(TSA_ID=tsa_id, Teacher_ID=teacher_id)
+        tsa = Teacher_Subject_Assignment.objects.select_related('Subject_Code', 'Class_ID').get(
+            TSA_ID=tsa_id, Teacher_ID=teacher_id
+        )
         
         # Get all students enrolled in this TSA
         enrolled_students = Student_TSA_Enrollment.objects.filter(TSA_ID=tsa_id).select_related('Student_ID')
         
-        # Get all unique dates for this TSA
-        unique_dates = Attendance.objects.filter(TSA_ID=tsa_id).values('Date').distinct().order_by('Date')
+        # Fetch the whole register in one query: date -> status per student
+        attendance_by_student = defaultdict(dict)
+        for student_id, record_date, record_status in Attendance.objects.filter(TSA_ID=tsa_id).values_list(
+            'Student_ID', 'Date', 'Status'
+        ).order_by('pk'):
+            attendance_by_student[student_id][str(record_date)] = record_status
+        unique_dates = sorted({date for records in attendance_by_student.values() for date in records})
         
         # Get subject details
         subject = tsa.Subject_Code
@@ -596,7 +1095,7 @@ def get_teacher_attendance_register(request, teacher_id, tsa_id):
             'class_id': tsa.Class_ID.Class_ID if tsa.Class_ID else None,
             'is_lab': tsa.IsLab,
             'is_elective': tsa.IsElective,
-            'dates': [str(date['Date']) for date in unique_dates],
+            'dates': unique_dates,
             'attendance_data': []
         }
         
@@ -609,14 +1108,7 @@ def get_teacher_attendance_register(request, teacher_id, tsa_id):
                 'attendance': {}
             }
             
-            # Get attendance records for this student
-            attendance_records = Attendance.objects.filter(
-                TSA_ID=tsa_id,
-                Student_ID=student.Student_ID
-            ).values('Date', 'Status')
-            
-            # Create a dictionary of date -> status
-            attendance_dict = {str(record['Date']): record['Status'] for record in attendance_records}
+            attendance_dict = attendance_by_student.get(student.Student_ID, {})
             
             # Fill in attendance status for each date
             for date in response_data['dates']:
@@ -686,19 +1178,30 @@ def get_department_analytics(request, teacher_id):
             else:
                 class_counts[class_id] = 1
         
+        # Attendance of the department's students per semester and per class,
+        # summed from the precomputed per-student summaries
+        department_summaries = Attendance_Summary.objects.filter(
+            Student_ID__students_current_class__Branch_ID=branch_id
+        )
+        semester_totals = {
+            row['semester']: row
+            for row in department_summaries.values(
+                semester=F('Student_ID__students_current_class__Semester')
+            ).annotate(total=Sum('Total_Sessions'), present=Sum('Present_Count'))
+        }
+        class_totals = {
+            row['class_id']: row
+            for row in department_summaries.values(
+                class_id=F('Student_ID__students_current_class__Class_ID')
+            ).annotate(total=Sum('Total_Sessions'), present=Sum('Present_Count'))
+        }
+
         # Calculate attendance statistics for each semester
         semester_attendance = {}
         for semester in semester_counts.keys():
-            # Get all students in this semester
-            semester_students = current_classes.filter(Semester=semester)
-            student_ids = [sc.Student_ID.Student_ID for sc in semester_students]
-            
-            # Get attendance records for these students
-            attendance_records = Attendance.objects.filter(Student_ID__in=student_ids)
-            
-            # Calculate attendance percentage
-            total_attendance = attendance_records.count()
-            present_attendance = attendance_records.filter(Status=True).count()
+            totals = semester_totals.get(semester, {})
+            total_attendance = totals.get('total') or 0
+            present_attendance = totals.get('present') or 0
             
             attendance_percentage = (present_attendance / total_attendance * 100) if total_attendance > 0 else 0
             
@@ -710,16 +1213,9 @@ def get_department_analytics(request, teacher_id):
         # Calculate attendance statistics for each class
         class_attendance = {}
         for class_id in class_counts.keys():
-            # Get all students in this class
-            class_students = current_classes.filter(Class_ID=class_id)
-            student_ids = [sc.Student_ID.Student_ID for sc in class_students]
-            
-            # Get attendance records for these students
-            attendance_records = Attendance.objects.filter(Student_ID__in=student_ids)
-            
-            # Calculate attendance percentage
-            total_attendance = attendance_records.count()
-            present_attendance = attendance_records.filter(Status=True).count()
+            totals = class_totals.get(class_id, {})
+            total_attendance = totals.get('total') or 0
+            present_attendance = totals.get('present') or 0
             
             attendance_percentage = (present_attendance / total_attendance * 100) if total_attendance > 0 else 0
             
@@ -755,34 +1251,41 @@ def get_department_tsa_analytics(request, teacher_id):
         current_tsa_ids = Student_TSA_Enrollment.objects.values_list('TSA_ID', flat=True).distinct()
         
         # Get TSA details for these IDs
-        tsa_details = Teacher_Subject_Assignment.objects.filter(
+        tsa_details = list(Teacher_Subject_Assignment.objects.filter(
             TSA_ID__in=current_tsa_ids,
             Teacher_ID__Branch_ID=branch_id  # Only TSAs from this branch
         ).select_related(
             'Teacher_ID',
             'Subject_Code',
             'Class_ID'
+        ))
+        tsa_ids = [tsa.TSA_ID for tsa in tsa_details]
+
+        # Enrollment counts and the precomputed attendance of enrolled
+        # students for every TSA at once
+        student_counts = dict(Student_TSA_Enrollment.objects.filter(TSA_ID__in=tsa_ids).values('TSA_ID').annotate(
+            students=Count('pk')
+        ).values_list('TSA_ID', 'students'))
+        enrolled_in_tsa = Student_TSA_Enrollment.objects.filter(
+            TSA_ID=OuterRef('TSA_ID'),
+            Student_ID=OuterRef('Student_ID')
         )
-        
+        attendance_totals = {
+            row['TSA_ID']: row
+            for row in Attendance_Summary.objects.filter(TSA_ID__in=tsa_ids).filter(
+                Exists(enrolled_in_tsa)
+            ).values('TSA_ID').annotate(total=Sum('Total_Sessions'), present=Sum('Present_Count'))
+        }
+
         tsa_analytics = []
         
         for tsa in tsa_details:
-            # Get all students enrolled in this TSA
-            enrolled_students = Student_TSA_Enrollment.objects.filter(TSA_ID=tsa.TSA_ID)
-            total_students = enrolled_students.count()
-            
-            # Get student IDs
-            student_ids = [enrollment.Student_ID.Student_ID for enrollment in enrolled_students]
-            
-            # Get attendance records for these students in this TSA
-            attendance_records = Attendance.objects.filter(
-                TSA_ID=tsa.TSA_ID,
-                Student_ID__in=student_ids
-            )
+            total_students = student_counts.get(tsa.TSA_ID, 0)
             
             # Calculate attendance percentage
-            total_attendance = attendance_records.count()
-            present_attendance = attendance_records.filter(Status=True).count()
+            totals = attendance_totals.get(tsa.TSA_ID, {})
+            total_attendance = totals.get('total') or 0
+            present_attendance = totals.get('present') or 0
             
             attendance_percentage = (present_attendance / total_attendance * 100) if total_attendance > 0 else 0
             